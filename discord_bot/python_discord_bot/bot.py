@@ -13,6 +13,8 @@ import discord
 from discord import app_commands
 from discord.ext import commands, tasks, voice_recv
 from pmb_core.audio import transform
+from pmb_core.db import channel, latency
+from pmb_core.db.commands import CONTROL, NORMAL, STOPPING_TYPES, is_control, superseded
 from pmb_core.db.mongodb import MongoInterface
 
 from python_discord_bot import config, playback
@@ -223,6 +225,47 @@ def _chunk_lines(lines, limit):
         yield "\n".join(buffer)
 
 
+def _log_failure(what):
+    """A done-callback for a future nothing else reads, logging how it failed."""
+
+    def done(future):
+        if not future.cancelled() and future.exception() is not None:
+            log.error("%s failed", what, exc_info=future.exception())
+
+    return done
+
+
+class _LoopFeed:
+    """A pmb_core ``CommandFeed`` for the event loop. ``feed.wait`` blocks, so a
+    thread of its own waits on it and wakes the loop; waiting on the feed never
+    ties up one of the default executor's workers, which every other
+    ``asyncio.to_thread`` call in the bot shares. ``claimed`` hands the thread
+    back to the feed for the next wait."""
+
+    def __init__(self, feed, loop, name):
+        self._feed = feed
+        self._loop = loop
+        self._due = asyncio.Event()
+        self._taken = threading.Event()  # the loop has acted on the last wakeup
+        self._taken.set()
+        threading.Thread(target=self._run, name=name, daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._taken.wait()
+            self._taken.clear()
+            self._feed.wait()
+            self._loop.call_soon_threadsafe(self._due.set)
+
+    async def wait(self):
+        await self._due.wait()
+        self._due.clear()
+
+    def claimed(self, found):
+        self._feed.claimed(found)
+        self._taken.set()
+
+
 class DiscordBot(commands.Bot):
     def __init__(self):
         intents = discord.Intents.default()
@@ -236,7 +279,28 @@ class DiscordBot(commands.Bot):
         self._song_current = None
         self._song_signal = asyncio.Event()
         self._skip_event = asyncio.Event()
+        self._song_next = None  # pre-render of the head of the queue, if any
         self._song_worker_task = None
+        # Generated queues: ids of queued commands already being prerendered.
+        self._prerendered = set()
+        self._prerender_task = None
+        # When to claim from pending_commands (see pmb_core.db.commands and
+        # _LoopFeed); opened once Mongo is connected.
+        self._command_feed = None
+        # Commands the web sends straight to the bot (see pmb_core.db.channel)
+        # run as they arrive; their copies claimed from Mongo are then dropped by
+        # id. The lock runs the two paths one command at a time, in order.
+        self._command_channel = None
+        self._seen_commands = channel.Seen()
+        self._command_lock = asyncio.Lock()
+        # Control commands (stop, skip, restart, leave) have a lane of their own,
+        # claimed on a second feed and run without waiting for _command_lock, so
+        # a stop isn't stuck behind a batch of plays. A stop drops the plays
+        # queued before it (_stopped_at) and any still resolving (_stop_serial).
+        self._control_feed = None
+        self._control_lock = asyncio.Lock()
+        self._stopped_at = None
+        self._stop_serial = 0
         # Entrance sounds: play a user's configured clip when they join the
         # bot's channel, debounced per user so quick rejoins don't spam.
         self._entrance_cooldown = {}
@@ -263,6 +327,14 @@ class DiscordBot(commands.Bot):
     async def setup_hook(self):
         await asyncio.to_thread(self.mongo.connect)
         await asyncio.to_thread(self.mongo.refresh)
+        loop = asyncio.get_running_loop()
+        self._command_feed = _LoopFeed(self.mongo.command_feed(), loop, "pmb-feed")
+        self._control_feed = _LoopFeed(
+            self.mongo.command_feed(), loop, "pmb-control-feed"
+        )
+        self._command_channel = self.mongo.command_channel(
+            "discord", playback.AUDIO_DIR, self._on_direct_commands
+        )
         register_commands(self)
         if config.GUILD_ID:
             guild = discord.Object(id=config.GUILD_ID)
@@ -274,6 +346,7 @@ class DiscordBot(commands.Bot):
         await asyncio.to_thread(self._write_song_state)
         self._song_worker_task = self.loop.create_task(self._song_worker())
         self.poll_commands.start()
+        self.poll_control.start()
         self.publish_voice_state.start()
         if config.CLIP_CAPTURE_ENABLED:
             self.refresh_capture_optin.start()
@@ -578,16 +651,28 @@ class DiscordBot(commands.Bot):
         voice_key=None,
         gain_db=0,
         reverse=False,
+        trace=None,
+        stop_serial=None,
     ):
+        # `stop_serial`: the bot's stop count when the command began; a stop
+        # since (on the control lane, while this resolved or rendered) cancels it.
         volume = await asyncio.to_thread(self.mongo.get_volume)
+        if stop_serial is not None and stop_serial != self._stop_serial:
+            return
         volume = volume * transform.gain_db_to_multiplier(gain_db)
         t = time.monotonic()
-        source = playback.build_source(file_name, speed, shift, volume, reverse)
+        # Off the event loop: a cold clip is rendered (and its render cached to
+        # disk), which would otherwise stall the gateway and every other voice.
+        source = await asyncio.to_thread(
+            playback.build_source, file_name, speed, shift, volume, reverse, trace
+        )
         log.info(
-            "[timing] ffmpeg spawn for %s: %.0fms",
+            "[timing] build source for %s: %.0fms",
             file_name,
             (time.monotonic() - t) * 1000,
         )
+        if stop_serial is not None and stop_serial != self._stop_serial:
+            return
         player = self.get_player(voice_client)
         if interrupt:
             player.play_now(voice_key, source)
@@ -824,7 +909,8 @@ class DiscordBot(commands.Bot):
             volume = base_volume * transform.gain_db_to_multiplier(
                 doc.get("gain_db", 0)
             )
-            source = playback.build_source(
+            source = await asyncio.to_thread(
+                playback.build_source,
                 doc["file"],
                 float(c.get("speed", 1.0)),
                 float(c.get("pitch", 0)),
@@ -839,24 +925,130 @@ class DiscordBot(commands.Bot):
             except asyncio.TimeoutError:
                 pass
 
-    @tasks.loop(seconds=0.1)
+    @tasks.loop(seconds=0)
     async def poll_commands(self):
-        for _ in range(20):
-            command = await asyncio.to_thread(self.mongo.get_next_pending_command)
-            if command is None:
-                return
+        # The feed says when there's a command to claim (pushed by the web, or
+        # an idle poll backing off when push isn't available), so an idle bot
+        # isn't claiming every 100ms.
+        await self._command_feed.wait()
+        # Everything queued is claimed in one leased batch (a queue generation
+        # is a burst of commands) and handled in order. The ones handled are
+        # acked in one write; any left by an error are re-claimed once their
+        # lease runs out.
+        batch = []
+        try:
+            batch = await asyncio.to_thread(
+                self.mongo.claim_pending_commands, lane=NORMAL
+            )
+        finally:
+            self._command_feed.claimed(bool(batch))
+        claimed_at = time.time()
+        if not batch:
+            return
+        async with self._command_lock:
+            fresh = self._seen_commands.fresh(batch)
+            handled = [c for c in batch if c not in fresh]  # already run directly
             try:
-                await self._handle_pending(command)
+                await self._run_commands(fresh, "mongo", claimed_at, handled)
             finally:
-                await asyncio.to_thread(self.mongo.mark_command_done, command["_id"])
+                await asyncio.to_thread(self.mongo.ack_commands, handled)
+
+    @tasks.loop(seconds=0)
+    async def poll_control(self):
+        # The control lane, claimed like poll_commands but handled alongside
+        # whatever batch that is still working through.
+        await self._control_feed.wait()
+        # Nothing may escape: tasks.loop stops for good on an exception, and
+        # nothing else claims this lane, so no stop would be claimed from Mongo
+        # again. An unacked batch is claimed again once its lease runs out.
+        batch = []
+        try:
+            batch = await asyncio.to_thread(
+                self.mongo.claim_pending_commands, lane=CONTROL
+            )
+        except Exception:
+            log.exception("Claiming control commands failed")
+        finally:
+            self._control_feed.claimed(bool(batch))
+        claimed_at = time.time()
+        if not batch:
+            return
+        try:
+            await self._run_control_commands(batch, "mongo", claimed_at)
+        except Exception:
+            log.exception("Running control commands failed")
+
+    @poll_control.before_loop
+    async def _before_poll_control(self):
+        await self.wait_until_ready()
+
+    def _on_direct_commands(self, commands):
+        # On the channel's thread: run them on the event loop, control commands
+        # first and on their own lane.
+        claimed_at = time.time()
+        control = [c for c in commands if is_control(c)]
+        if control:
+            asyncio.run_coroutine_threadsafe(
+                self._run_control_commands(control, "direct", claimed_at), self.loop
+            ).add_done_callback(_log_failure("Running direct control commands"))
+        commands = [c for c in commands if not is_control(c)]
+        if commands:
+            asyncio.run_coroutine_threadsafe(
+                self._run_direct_commands(commands, claimed_at), self.loop
+            ).add_done_callback(_log_failure("Running direct commands"))
+
+    async def _run_control_commands(self, commands, via, claimed_at):
+        settle = (
+            self.mongo.ack_commands if via == "mongo" else self.mongo.mark_commands_done
+        )
+        async with self._control_lock:
+            fresh = self._seen_commands.fresh(commands)
+            # A claimed copy of one already run directly is still acked.
+            handled = [c for c in commands if c not in fresh] if via == "mongo" else []
+            try:
+                await self._run_commands(fresh, via, claimed_at, handled)
+            finally:
+                if handled:
+                    await asyncio.to_thread(settle, handled)
+
+    async def _run_direct_commands(self, commands, claimed_at):
+        async with self._command_lock:
+            handled = []
+            try:
+                await self._run_commands(
+                    self._seen_commands.fresh(commands), "direct", claimed_at, handled
+                )
+            finally:
+                if handled:
+                    await asyncio.to_thread(self.mongo.mark_commands_done, handled)
+
+    async def _run_commands(self, commands, via, claimed_at, handled):
+        """Handle ``commands`` in order, adding each to ``handled`` as it starts.
+        Each one's latency trace (see pmb_core.db.latency) is written once it's
+        handled, or for a clip play once the mixer has read its first frame."""
+        writer = self.mongo.latency_log()
+        for command in commands:
+            handled.append(command)
+            trace = latency.Trace(command, "discord", writer, via)
+            trace.mark("claimed", claimed_at)
+            await self._handle_pending(command, trace)
+            if trace.type not in latency.CLIP_PLAYS:
+                trace.finish()
 
     @poll_commands.before_loop
     async def _before_poll(self):
         await self.wait_until_ready()
         await self._rejoin_last_channel()
 
-    async def _handle_pending(self, command):
+    async def _handle_pending(self, command, trace=None):
         cmd_type = command.get("type", "play")
+        if superseded(command, self._stopped_at):
+            log.info("Dropped %s queued before a stop", cmd_type)
+            return
+        if cmd_type in STOPPING_TYPES and command.get("created_at") is not None:
+            created = command["created_at"]
+            self._stopped_at = max(self._stopped_at or created, created)
+        stop_serial = self._stop_serial
         if cmd_type == "announce":
             await self.announce(command.get("message", ""))
             return
@@ -910,8 +1102,11 @@ class DiscordBot(commands.Bot):
             return
         if cmd_type == "stop":
             # Clear the song queue + current song too, then panic the mixer.
+            self._stop_serial += 1
             self._song_pending.clear()
             self._skip_event.set()
+            playback.cancel_song_render()
+            self._discard_next_song()
             await asyncio.to_thread(self._write_song_state)
             voice_client = self.active_voice_client()
             if voice_client is not None:
@@ -925,11 +1120,13 @@ class DiscordBot(commands.Bot):
             # the song worker, which serialises playback one song at a time.
             self._song_pending.append(command)
             self._song_signal.set()
+            self._prerender_next_song()
             await asyncio.to_thread(self._write_song_state)
             return
 
         if cmd_type == "skip_song":
             self._skip_event.set()
+            playback.cancel_song_render()
             return
 
         if cmd_type == "clip_capture":
@@ -956,6 +1153,9 @@ class DiscordBot(commands.Bot):
                 waited,
             )
 
+        if cmd_type == "queue_play":
+            await self._prerender_queue()
+
         if cmd_type == "play":
             name = command.get("clip_name") or command.get("clip_ref")
             await self.announce(
@@ -969,6 +1169,8 @@ class DiscordBot(commands.Bot):
         if doc is None:
             log.warning("Clip not found: %s", command.get("clip_ref"))
             return
+        if trace is not None:
+            trace.mark("resolved")
         # A single play gets its own per-user voice (overlaps others, restarts
         # on repeat); queue items play sequentially on the shared queue voice.
         await self.play_file(
@@ -980,6 +1182,8 @@ class DiscordBot(commands.Bot):
             voice_key=command.get("requested_by") or "web",
             gain_db=doc.get("gain_db", 0),
             reverse=reverse,
+            trace=trace,
+            stop_serial=stop_serial,
         )
         log.info(
             "[timing] %s resolve+build+enqueue %.0fms",
@@ -987,6 +1191,45 @@ class DiscordBot(commands.Bot):
             (time.monotonic() - t0) * 1000,
         )
 
+    async def _prerender_queue(self):
+        """A generated queue arrives as one queue_play command per item. On the
+        first of them, render the rest of the queue in a worker thread (one
+        decode per clip) so each later item is a cache hit as it comes up."""
+        pending = await asyncio.to_thread(self.mongo.get_pending_commands, "queue_play")
+        # Forget ids that have since been played or cancelled.
+        self._prerendered &= {c["_id"] for c in pending}
+        upcoming = [c for c in pending if c["_id"] not in self._prerendered]
+        if not upcoming:
+            return
+        self._prerendered.update(c["_id"] for c in upcoming)
+
+        def work():
+            try:
+                items = []
+                for c in upcoming:
+                    doc = self.resolve_clip(c["clip_ref"])
+                    if doc is not None:
+                        items.append(
+                            (
+                                doc["file"],
+                                float(c.get("speed", 1.0)),
+                                float(c.get("pitch", 0)),
+                                bool(c.get("reverse", False)),
+                            )
+                        )
+                t = time.monotonic()
+                playback.prerender(items)
+                log.info(
+                    "[timing] prerendered %d queued clips in %.0fms",
+                    len(items),
+                    (time.monotonic() - t) * 1000,
+                )
+            except Exception:
+                log.exception("Prerendering the queue failed")
+
+        # Keep a reference so the task isn't garbage-collected mid-run.
+        self._prerender_task = asyncio.create_task(asyncio.to_thread(work))
+
     def _write_song_state(self):
         """Mirror the current song + upcoming queue to the `song_state` singleton
         so the web can render the now-playing mini-player. Blocking (pymongo)."""
@@ -1026,26 +1269,77 @@ class DiscordBot(commands.Bot):
                 log.exception("song worker: failed to play %s", command.get("song"))
             finally:
                 self._song_current = None
-                await asyncio.to_thread(self._write_song_state)
+                slot = self._song_next
+                if slot is None or slot["player"] is None:
+                    # (A queued pre-render is already playing; it publishes
+                    # itself straight away.)
+                    await asyncio.to_thread(self._write_song_state)
+
+    def _prerender_next_song(self):
+        """While a song plays, pre-render the head of the queue (at most one),
+        dropping a pre-render of anything that's no longer the head. Once it's
+        ready, _play_one_song queues it on the mixer to follow the current
+        song without a gap."""
+        head = self._song_pending[0] if self._song_pending else None
+        slot = self._song_next
+        if slot is not None and slot["command"] is head:
+            return
+        self._discard_next_song()
+        if head is not None and self._song_current is not None:
+            self._song_next = {
+                "command": head,
+                "task": asyncio.ensure_future(
+                    self._prepare_song(head, playback.SONG_NEXT_TAG)
+                ),
+                "player": None,  # set once queued on a player's mixer
+                "done": asyncio.Event(),
+            }
 
-    async def _play_one_song(self, command):
-        """Render one MIDI song with a clip as the instrument and play it to
-        completion (or until skipped)."""
-        voice_client = self.active_voice_client()
-        if voice_client is None:
-            log.warning(
-                "play_song: not in a voice channel; dropping %s", command.get("song")
-            )
+    def _discard_next_song(self):
+        slot, self._song_next = self._song_next, None
+        if slot is None:
+            return
+        playback.cancel_song_render(playback.SONG_NEXT_TAG)
+        if slot["player"] is not None:
+            slot["player"].discard_next("__song__")
+
+        def release(task):
+            # A render that finishes after being dropped still owns a source.
+            if not task.cancelled() and task.exception() is None and task.result():
+                task.result()["source"].cleanup()
+
+        if slot["player"] is None:
+            slot["task"].add_done_callback(release)
+
+    def _queue_next_song(self, player):
+        """Queue a finished pre-render on `player` to follow the current song."""
+        slot = self._song_next
+        if slot is None or slot["player"] is not None or not slot["task"].done():
             return
+        if slot["task"].cancelled() or slot["task"].exception() is not None:
+            return
+        song = slot["task"].result()
+        if song is None:
+            return
+        done = slot["done"]
+        player.play_next(
+            "__song__", song["source"], lambda: self.loop.call_soon_threadsafe(done.set)
+        )
+        slot["player"] = player
+
+    async def _prepare_song(self, command, tag=playback.SONG_TAG):
+        """Resolve a play_song command's clips and render it up to its first
+        window. Returns {source, duration, song_name, clip_name, requested_by},
+        or None if there's nothing to play."""
         song_file = command.get("song")
         clip_ref = command.get("clip_ref")
         if not song_file or not clip_ref:
             log.warning("play_song: missing song or clip_ref")
-            return
+            return None
         doc = await asyncio.to_thread(self.resolve_clip, clip_ref)
         if doc is None:
             log.warning("play_song: clip not found: %s", clip_ref)
-            return
+            return None
 
         transpose = int(command.get("transpose", 0))
         speed = float(command.get("speed", 1.0))
@@ -1053,8 +1347,9 @@ class DiscordBot(commands.Bot):
         max_seconds = float(command.get("max_seconds", 0) or 0)
         base_volume = await asyncio.to_thread(self.mongo.get_volume)
 
-        # Resolve per-line instrument clips → {program: {file, gain_db}}. Each
-        # line's own gain stacks with its clip's stored gain (like the default).
+        # Resolve per-line instrument clips → {program: {file, gain_db, pan}}.
+        # Each line's own gain stacks with its clip's stored gain (like the
+        # default); a panned line makes the song render in stereo.
         instruments = {}
         for ins in command.get("instruments") or []:
             cdoc = await asyncio.to_thread(self.resolve_clip, ins.get("clip_ref"))
@@ -1063,6 +1358,7 @@ class DiscordBot(commands.Bot):
             instruments[int(ins["program"])] = {
                 "file": cdoc["file"],
                 "gain_db": float(ins.get("gain", 0)) + float(cdoc.get("gain_db", 0)),
+                "pan": float(ins.get("pan", 0)),
             }
 
         t0 = time.monotonic()
@@ -1076,51 +1372,106 @@ class DiscordBot(commands.Bot):
             base_volume,
             max_seconds,
             instruments,
+            tag,
         )
         log.info(
-            "[timing] song render %s on %s: %.0fms (%.1fs)",
+            "[timing] song first window %s on %s: %.0fms (%.1fs)%s",
             song_file,
             clip_ref,
             (time.monotonic() - t0) * 1000,
             duration,
+            " (pre-render)" if tag == playback.SONG_NEXT_TAG else "",
         )
         if source is None:
             log.warning("play_song: nothing to render for %s", song_file)
+            return None
+        return {
+            "source": source,
+            "duration": duration,
+            "song_name": command.get("song_name") or song_file,
+            "clip_name": command.get("clip_name") or clip_ref,
+            "requested_by": command.get("requested_by", "web"),
+        }
+
+    async def _play_one_song(self, command):
+        """Render one MIDI song with a clip as the instrument (or take its
+        pre-render) and play it to completion (or until skipped). A pre-render
+        that was queued on the mixer is already playing by the time this runs:
+        it took over the voice when the previous song ended."""
+        slot, self._song_next = self._song_next, None
+        if slot is not None and slot["command"] is not command:
+            self._song_next = slot
+            self._discard_next_song()
+            slot = None
+        voice_client = self.active_voice_client()
+        if voice_client is None:
+            log.warning(
+                "play_song: not in a voice channel; dropping %s", command.get("song")
+            )
+            if slot is not None:
+                self._song_next = slot
+                self._discard_next_song()
+            return
+        player = self.get_player(voice_client)
+
+        if slot is None:
+            song = await self._prepare_song(command)
+            done = asyncio.Event()
+            playing = False
+        else:
+            try:
+                song = await slot["task"]
+            except Exception:
+                log.exception("play_song: pre-render of %s failed", command.get("song"))
+                song = None
+            done = slot["done"]
+            playing = slot["player"] is player
+        if song is None:
             return
 
-        song_name = command.get("song_name") or song_file
-        clip_name = command.get("clip_name") or clip_ref
-        requested_by = command.get("requested_by", "web")
         self._song_current = {
-            "song_name": song_name,
-            "clip_name": clip_name,
-            "requested_by": requested_by,
+            "song_name": song["song_name"],
+            "clip_name": song["clip_name"],
+            "requested_by": song["requested_by"],
             "started_at": datetime.datetime.utcnow(),
-            "duration_s": round(duration, 2),
+            "duration_s": round(song["duration"], 2),
         }
-        await asyncio.to_thread(self._write_song_state)
-
-        player = self.get_player(voice_client)
         self._skip_event.clear()
-        done = asyncio.Event()
-        player.play_now(
-            "__song__", source, lambda: self.loop.call_soon_threadsafe(done.set)
-        )
+        if not playing:
+            player.play_now(
+                "__song__",
+                song["source"],
+                lambda: self.loop.call_soon_threadsafe(done.set),
+            )
+        await asyncio.to_thread(self._write_song_state)
+        self._prerender_next_song()
 
-        # Wait for the song to finish naturally, be skipped, or a safety timeout.
+        # Wait for the song to finish naturally, be skipped, or a safety timeout,
+        # queueing the next song's pre-render on the mixer as soon as it's ready.
         skip_wait = asyncio.ensure_future(self._skip_event.wait())
         done_wait = asyncio.ensure_future(done.wait())
+        deadline = time.monotonic() + song["duration"] + 5.0
         try:
-            await asyncio.wait(
-                {skip_wait, done_wait},
-                timeout=duration + 5.0,
-                return_when=asyncio.FIRST_COMPLETED,
-            )
+            while not (skip_wait.done() or done_wait.done()):
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    player.stop_voice("__song__")
+                    break
+                waits = {skip_wait, done_wait}
+                slot = self._song_next
+                if slot is not None and slot["player"] is None:
+                    if slot["task"].done():
+                        self._queue_next_song(player)
+                    else:
+                        waits.add(slot["task"])
+                await asyncio.wait(
+                    waits, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
         finally:
             skip_wait.cancel()
             done_wait.cancel()
             if self._skip_event.is_set():
-                log.info("song skipped: %s", song_name)
+                log.info("song skipped: %s", song["song_name"])
                 player.stop_voice("__song__")
                 self._skip_event.clear()
 
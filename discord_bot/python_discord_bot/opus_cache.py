@@ -0,0 +1,186 @@
+"""Pre-encoded Opus packets for cached clips and songs.
+
+discord.py Opus-encodes every 20ms PCM frame the player reads, so a clip that
+has been played hundreds of times is encoded hundreds of times. A clip or song
+render's packet sequence is stored next to the PCM caches, on the shared volume:
+
+    audio/.opus_packets/<sha1>.opus
+
+keyed by the PCM entry's own cache key, the volume it was played at (unlike the
+PCM caches, packets have the volume baked in) and the encoder settings. While a
+single voice with packets is playing, the mixer hands discord.py those packets
+as they are (see playback._MixerStream.read) and nothing is encoded; as soon as
+voices overlap it goes back to mixing PCM.
+
+Packets are recorded off the player thread: a clip's are encoded in the
+background the first time it plays (that play is encoded live as before), a
+song's as its PCM passes through the render thread. Each packet is stored with
+a 2-byte length prefix, one per 20ms frame of the (frame-padded) PCM, so packet
+``i`` always lines up with PCM frame ``i``.
+"""
+
+import audioop
+import hashlib
+import logging
+import os
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import discord
+from pmb_core.audio.render_cache import RenderCache
+
+log = logging.getLogger("pmb.discord.opus")
+
+DIR_NAME = ".opus_packets"
+SUFFIX = ".opus"
+
+# Opus at 128kbps is ~16KB/s, a twelfth of the stereo PCM it stands in for.
+OPUS_CACHE_MAX_BYTES = int(os.getenv("OPUS_CACHE_MAX_BYTES", str(128 * 1024 * 1024)))
+
+# The voice client's encoder is created with the same bitrate (GuildPlayer), so
+# passthrough packets and live-encoded ones sound alike.
+OPUS_BITRATE = 128
+
+# 20ms of 48kHz 16-bit stereo, what one packet encodes.
+FRAME_BYTES = 3840
+
+# Bump when the stored format or the encoder settings change.
+FORMAT_VERSION = 1
+
+_LENGTH = struct.Struct("<H")
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+# Clip packets are encoded one at a time in the background; a key is only
+# queued once however many times it's played while it waits.
+_encoding = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pmb-opus")
+_pending = set()
+_pending_lock = threading.Lock()
+_unavailable_logged = False
+
+
+def for_audio_dir(audio_dir):
+    """The process-wide packet cache living under ``audio_dir``."""
+    directory = Path(audio_dir) / DIR_NAME
+    with _caches_lock:
+        cache = _caches.get(str(directory))
+        if cache is None:
+            cache = _caches[str(directory)] = RenderCache(
+                directory, max_bytes=OPUS_CACHE_MAX_BYTES, suffix=SUFFIX
+            )
+        return cache
+
+
+def key(pcm_key, volume):
+    """Packet cache key for the PCM entry ``pcm_key`` played at ``volume``."""
+    raw = "{0}|{1:.4f}|{2}kbps|v{3}".format(
+        pcm_key, float(volume), OPUS_BITRATE, FORMAT_VERSION
+    )
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def new_encoder():
+    """An encoder matching the voice client's, or None if libopus isn't loadable
+    (then nothing is recorded and playback just encodes live)."""
+    global _unavailable_logged
+    try:
+        return discord.opus.Encoder(bitrate=OPUS_BITRATE)
+    except discord.opus.OpusNotLoaded:
+        if not _unavailable_logged:
+            _unavailable_logged = True
+            log.warning("opus: libopus not loadable, packet cache disabled")
+        return None
+
+
+def load(cache, packet_key, frames):
+    """The stored packets for ``packet_key`` if there are exactly ``frames`` of
+    them (anything else is stale or torn), else None."""
+    data = cache.get(packet_key)
+    if data is None:
+        cache.misses += 1
+        return None
+    packets = []
+    pos = 0
+    try:
+        while pos < len(data):
+            (size,) = _LENGTH.unpack_from(data, pos)
+            packets.append(data[pos + 2 : pos + 2 + size])
+            pos += 2 + size
+    except struct.error:
+        packets = None
+    if packets is None or len(packets) != frames:
+        cache.misses += 1
+        return None
+    cache.hits += 1
+    return packets
+
+
+def packets_for_clip(cache, packet_key, pcm):
+    """The packets for a frame-padded clip render, or None on a miss — in which
+    case they're encoded in the background, ready for the next play."""
+    packets = load(cache, packet_key, len(pcm) // FRAME_BYTES)
+    if packets is None and pcm:
+        with _pending_lock:
+            if packet_key in _pending:
+                return None
+            _pending.add(packet_key)
+        _encoding.submit(_record_clip, cache, packet_key, pcm)
+    return packets
+
+
+def _record_clip(cache, packet_key, pcm):
+    try:
+        recorder = Recorder(cache, packet_key)
+        recorder.feed(pcm)
+        recorder.commit()
+    except Exception:
+        log.exception("opus: encoding a clip's packets failed")
+    finally:
+        with _pending_lock:
+            _pending.discard(packet_key)
+
+
+class Recorder:
+    """Encodes PCM into 20ms packets as it's fed and writes them to the cache;
+    ``commit`` stores the sequence (the last partial frame padded with silence,
+    as the player pads it), ``discard`` drops it. ``channels=1`` PCM is upmixed
+    to stereo before encoding. Does nothing if libopus isn't available."""
+
+    def __init__(self, cache, packet_key, channels=2):
+        self._encoder = new_encoder()
+        self._writer = (
+            cache.open_writer(packet_key) if self._encoder is not None else None
+        )
+        self._channels = channels
+        self._frame = FRAME_BYTES // 2 * channels
+        self._buf = bytearray()
+
+    def feed(self, pcm):
+        if self._writer is None:
+            return
+        self._buf += pcm
+        whole = len(self._buf) - len(self._buf) % self._frame
+        for pos in range(0, whole, self._frame):
+            self._encode(bytes(self._buf[pos : pos + self._frame]))
+        del self._buf[:whole]
+
+    def commit(self):
+        if self._writer is None:
+            return
+        if self._buf:
+            self._encode(bytes(self._buf) + b"\x00" * (self._frame - len(self._buf)))
+            self._buf.clear()
+        self._writer.commit()
+
+    def discard(self):
+        if self._writer is not None:
+            self._writer.discard()
+
+    def _encode(self, frame):
+        if self._channels == 1:
+            frame = audioop.tostereo(frame, 2, 1, 1)
+        packet = self._encoder.encode(frame, self._encoder.SAMPLES_PER_FRAME)
+        self._writer.write(_LENGTH.pack(len(packet)) + packet)
@@ -1,17 +1,20 @@
 import asyncio
 import audioop
-import io
 import logging
 import os
-import statistics
-import subprocess as sp
 import threading
 import time
+import weakref
+from collections import OrderedDict
 from pathlib import Path
 
 import discord
-from pmb_core.audio import transform
-from pmb_core.audio.midi import parse_midi
+import numpy as np
+from pmb_core.audio import (
+    executor, loudness, mixdown, render_cache, song_cache, song_render_cache, transform,
+)
+
+from python_discord_bot import opus_cache
 
 log = logging.getLogger("pmb.discord.playback")
 
@@ -25,176 +28,465 @@ FRAME_BYTES = 3840
 # Mixer voice key for sequential queue playback (one shared lane, plays in order).
 QUEUE_VOICE = "__queue__"
 
-# Song render constants. Discord wants 48kHz 16-bit STEREO (4 bytes/frame).
+# Song render constants. Discord wants 48kHz 16-bit STEREO, but songs are
+# rendered, mixed and cached in mono (the clips are mono-derived) and only
+# duplicated to stereo as the player reads them — unless a line is panned.
 SR = 48000
-BYTES_PER_FRAME = 4  # 2 channels * 2 bytes
 # Don't pitch-shift the instrument absurdly far — a ±2 octave window keeps it
 # musical-ish; out-of-range notes clamp (octave folding is deferred).
 MAX_SEMITONE_SHIFT = 24
 # Floor each note's audio so very short notes still pop rather than click out.
 MIN_NOTE_SECONDS = 0.08
-SONG_LOUDNORM = "loudnorm=I=-16:TP=-1.5:LRA=11"
-
-
-def build_source(file_name, speed, shift, volume, reverse=False):
+# Songs are mixed and finalized a window at a time while they play, staying
+# about this far ahead of the player.
+SONG_WINDOW_SECONDS = 2.0
+SONG_FEED_AHEAD_SECONDS = 4.0
+# Render-executor tags for a song's parse + clip renders, so skip/stop can cancel
+# them mid-render: one for the song about to play, one for the pre-render of the
+# next queued song (which a skip must leave alone).
+SONG_TAG = "__song__"
+SONG_NEXT_TAG = "__song_next__"
+
+# Finished clip renders (volume applied, frame-padded) kept in memory, so a
+# repeat press of the same pad starts on the next frame: no disk read, no
+# volume pass. ~2MB per 10s of stereo.
+PCM_CACHE_MAX_BYTES = int(os.getenv("DISCORD_PCM_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+def build_source(file_name, speed, shift, volume, reverse=False, trace=None):
     """Build a Discord audio source for a clip, applying speed/pitch/volume
-    (and optionally playing it backwards).
+    (and optionally playing it backwards). A latency ``trace`` is stamped
+    around the render and written once the mixer reads the first frame.
 
     Discord consumes a true 48kHz stereo stream, so we use the standard
-    (asetrate-based) filter rather than the Mumble reinterpret-rate filter.
+    (asetrate-based) semantics rather than the Mumble reinterpret-rate filter.
+    The clip is short, so it's rendered once up front (a few ms in-process, or
+    a disk read if it's in the shared render cache) and kept in an in-memory
+    LRU, so replaying it is just a new cursor over the same bytes. Its Opus
+    packets come from the packet cache (or are encoded in the background for
+    next time), so a clip playing on its own isn't re-encoded on every play.
+    Blocking (a cold render, cache reads): call it off the event loop.
     """
     path = AUDIO_DIR.joinpath(file_name)
-    audio_filter = transform.generate_standard_filter(volume, speed, shift, reverse)
-    return discord.FFmpegPCMAudio(
-        str(path),
-        options='-af "{0}"'.format(audio_filter),
+    # Like the Mumble bot's old in-memory cache: the file's mtime (so a trim or
+    # re-upload invalidates it) and every transform param, volume included.
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        mtime = 0
+    key = (str(path), round(mtime, 3), round(speed, 4), round(shift, 4), round(volume, 3), reverse)
+    if trace is not None:
+        trace.mark("render_start")
+    clip = _clips.get(key)
+    if clip is None:
+        clip = _render_clip(path, speed, shift, volume, reverse)
+        _clips.put(key, clip)
+    if trace is not None:
+        trace.mark("render_end")
+    if clip.packets is None and clip.packet_key is not None:
+        clip.packets = opus_cache.packets_for_clip(
+            opus_cache.for_audio_dir(AUDIO_DIR), clip.packet_key, clip.pcm
+        )
+    return _ClipSource(clip.pcm, clip.packets, trace.started if trace is not None else None)
+
+
+def _render_clip(path, speed, shift, volume, reverse):
+    pcm, _hit = render_cache.for_audio_dir(AUDIO_DIR).render(
+        path, render_cache.STANDARD, volume, speed, shift, reverse, channels=2
+    )
+    source_hash = render_cache.content_hash(path)
+    packet_key = None
+    if source_hash is not None:
+        pcm_key = render_cache.RenderCache.key(source_hash, render_cache.STANDARD, speed, shift, reverse, 2)
+        packet_key = opus_cache.key(pcm_key, volume)
+    return _RenderedClip(_pad_to_frame(pcm), packet_key)
+
+
+class _RenderedClip:
+    """A clip render held by the in-memory cache, with its Opus packets once
+    they're available."""
+
+    __slots__ = ("pcm", "packet_key", "packets")
+
+    def __init__(self, pcm, packet_key):
+        self.pcm = pcm
+        self.packet_key = packet_key
+        self.packets = None
+
+
+class _PcmCache:
+    """Byte-bounded LRU of rendered clips (the newest entry is always kept,
+    however big)."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes_used = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            clip = self._entries.get(key)
+            if clip is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)  # mark most-recently-used
+            self.hits += 1
+            return clip
+
+    def put(self, key, clip):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes_used -= len(old.pcm)
+            self._entries[key] = clip
+            self.bytes_used += len(clip.pcm)
+            while self.bytes_used > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)  # evict oldest
+                self.bytes_used -= len(evicted.pcm)
+
+
+_clips = _PcmCache(PCM_CACHE_MAX_BYTES)
+
+
+class _ClipSource(discord.AudioSource):
+    """A rendered clip read a 20ms frame at a time, like discord.PCMAudio. With
+    its Opus packets (one per frame), read_packet hands the mixer the next frame
+    already encoded instead — either call moves the same cursor. ``on_start`` is
+    called (on the player thread) when the first frame is read."""
+
+    def __init__(self, pcm, packets=None, on_start=None):
+        self._pcm = pcm
+        self._pos = 0
+        self._packets = packets
+        self._on_start = on_start
+
+    def _started(self):
+        if self._on_start is not None:
+            on_start, self._on_start = self._on_start, None
+            on_start()
+
+    def read(self):
+        self._started()
+        frame = self._pcm[self._pos : self._pos + FRAME_BYTES]
+        self._pos += len(frame)
+        return frame if len(frame) == FRAME_BYTES else b""
+
+    def read_packet(self):
+        """The next frame's Opus packet, or None if there isn't one (the caller
+        reads PCM instead)."""
+        index = self._pos // FRAME_BYTES
+        if self._packets is None or index >= len(self._packets):
+            return None
+        self._started()
+        self._pos += FRAME_BYTES
+        return self._packets[index]
+
+    def is_opus(self):
+        return False
+
+
+def _pad_to_frame(pcm):
+    """discord.PCMAudio drops a trailing partial frame, so pad to a boundary."""
+    if len(pcm) % FRAME_BYTES:
+        pcm += b"\x00" * (FRAME_BYTES - len(pcm) % FRAME_BYTES)
+    return pcm
+
+
+def prerender(items):
+    """Warm the render cache for upcoming (file_name, speed, shift, reverse)
+    plays, e.g. the rest of a generated queue — one decode per clip. Blocking."""
+    by_file = {}
+    for file_name, speed, shift, reverse in items:
+        by_file.setdefault(file_name, []).append((speed, shift, reverse, 1.0))
+    cache = render_cache.for_audio_dir(AUDIO_DIR)
+    for file_name, variants in by_file.items():
+        cache.render_many(
+            AUDIO_DIR.joinpath(file_name), render_cache.STANDARD, variants, channels=2
+        )
+
+
+def _submit_clip_variants(clip_path, shift_volumes, tag=SONG_TAG):
+    """Queue a render of one clip at several (shift, volume) pairs to 48kHz
+    mono s16le PCM, from a single decode, on the render executor. Shifts are
+    sampler-style (pitch and length move together), since notes are capped to
+    their own length anyway. The volume bakes in a per-line gain so different
+    instrument lines can be balanced before they're mixed. Returns the job (its
+    result is the list of PCM)."""
+    return executor.get().submit(
+        render_cache.render_variants, AUDIO_DIR, clip_path, render_cache.PITCH,
+        [(1.0, shift, False, volume) for shift, volume in shift_volumes], 1,
+        tag=tag,
     )
 
 
-def _render_clip_pcm(clip_path, shift, volume=1.0):
-    """Render one clip, pitch-shifted by `shift` semitones, to 48kHz stereo
-    s16le PCM bytes. `volume` bakes in a per-line gain so different instrument
-    lines can be balanced before they're mixed."""
-    audio_filter = transform.generate_standard_filter(volume, 1.0, shift)
-    cmd = [
-        "ffmpeg", "-hide_banner", "-loglevel", "error",
-        "-i", str(clip_path),
-        "-af", audio_filter,
-        "-ar", str(SR), "-ac", "2", "-f", "s16le", "pipe:1",
-    ]
-    proc = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
-    if proc.returncode != 0:
-        log.warning("song: ffmpeg shift %s failed: %s", shift, proc.stderr.decode()[:200])
-    return proc.stdout
+def _parse_song(song_path, tag=SONG_TAG):
+    """The song's note table, parsed in the render executor on a cache miss."""
+    parsed = song_cache.load(song_path)
+    if parsed is None:
+        executor.get().submit(song_cache.warm, song_path, tag=tag).result()
+        parsed = song_cache.parse(song_path)
+    return parsed.notes
+
+
+def cancel_song_render(tag=SONG_TAG):
+    """Cancel the parse/clip renders of a song still being built (skip/stop)."""
+    executor.get().cancel(tag)
 
 
 def build_song_source(
     clip_file, song_file, transpose, speed, gain_db, base_volume,
-    max_seconds=0, instruments=None,
+    max_seconds=0, instruments=None, tag=SONG_TAG,
 ):
-    """Render a whole MIDI song into one stereo PCM source, using `clip_file` as
-    the default instrument. Returns (discord.PCMAudio, duration_seconds), or
-    (None, 0.0) if there's nothing to play.
+    """Render a MIDI song into a PCM source, using `clip_file` as the
+    default instrument. Returns (source, duration_seconds), or (None, 0.0) if
+    there's nothing to play. Returns once the first window is ready; the rest of
+    the song is mixed and finalized in the background as it plays.
 
     Each note triggers a clip pitch-shifted to that note's pitch (relative to
     the song's median pitch, so shifts stay small), laid onto a silent canvas at
-    the note's onset and capped to its duration. Overlapping notes (chords) mix
-    via audioop.add. A final loudnorm tames peaks and sets the level.
+    the note's onset and capped to its duration. Overlapping notes (chords) are
+    summed by pmb_core's mixdown. A final loudness pass tames peaks and sets the level.
 
     `instruments` optionally maps a General MIDI program number -> {"file",
-    "gain_db"} so each instrument "line" plays a different clip (at its own
-    gain). Lines with no entry use the default `clip_file`/`gain_db`. The pitch
-    timeline (one shared median root) is unchanged, so the parts keep their
-    relative pitch — only the timbre/level per line differs.
+    "gain_db", "pan"} so each instrument "line" plays a different clip (at its
+    own gain). Lines with no entry use the default `clip_file`/`gain_db`. The
+    pitch timeline (one shared median root) is unchanged, so the parts keep
+    their relative pitch — only the timbre/level per line differs.
+
+    The song is rendered and mixed in mono and upmixed as it's played, which
+    halves the mix and the cached copy. A line with a non-zero "pan" (-1 left
+    .. 1 right) makes the mix stereo instead, with that line balanced across it.
 
     `max_seconds` (0 = no limit) caps the rendered output length.
-    Blocking (spawns ffmpeg) — call via asyncio.to_thread.
+    Blocking (the clip renders and the first window) — call via
+    asyncio.to_thread. The parse and clip renders run in pmb_core's render
+    executor, one job per clip so several lines render at once; if they're
+    cancelled (cancel_song_render(tag)) this returns (None, 0.0). Finished renders
+    go in pmb_core's song render cache, so a replay with the same song, clips
+    and settings starts straight from disk — and its Opus packets, recorded as
+    it plays, in the packet cache, so a replay on its own isn't re-encoded.
     """
-    song_path = SONGS_DIR.joinpath(song_file)
-    instruments = instruments or {}
-    notes, _duration = parse_midi(str(song_path))
-    if not notes:
+    try:
+        return _build_song_source(
+            clip_file, song_file, transpose, speed, gain_db, base_volume, max_seconds, instruments,
+            tag,
+        )
+    except executor.CancelledError:
+        log.info("song: render of %s cancelled", song_file)
         return None, 0.0
 
+
+def _build_song_source(
+    clip_file, song_file, transpose, speed, gain_db, base_volume, max_seconds, instruments, tag,
+):
+    song_path = SONGS_DIR.joinpath(song_file)
+    instruments = instruments or {}
     speed = max(0.25, min(4.0, float(speed or 1.0)))
     transpose = int(transpose or 0)
-    root = int(statistics.median(n.pitch for n in notes))
-    limit_bytes = int(max(0, max_seconds) * SR) * BYTES_PER_FRAME  # 0 = no limit
-
-    def shift_for(note):
-        return max(-MAX_SEMITONE_SHIFT, min(MAX_SEMITONE_SHIFT, note.pitch - root + transpose))
-
-    def line_for(note):
-        """(clip path, gain multiplier) for a note's instrument line."""
-        ins = instruments.get(note.program)
+    limit = int(max(0, max_seconds) * SR)  # frames; 0 = no limit
+    min_note_frames = int(MIN_NOTE_SECONDS * SR)
+    window = int(SONG_WINDOW_SECONDS * SR)
+    pans = {p: max(-1.0, min(1.0, float(ins.get("pan") or 0))) for p, ins in instruments.items()}
+    channels = 2 if any(pans.values()) else 1
+    ahead = int(SONG_FEED_AHEAD_SECONDS * SR) * 2 * channels
+
+    # Per-line gains are baked in before normalising, so they're part of the key;
+    # base_volume is applied after it, so it isn't.
+    programs_used = sorted(instruments)
+    songs = song_render_cache.for_audio_dir(AUDIO_DIR)
+    song_key = song_render_cache.key(
+        song_path,
+        [AUDIO_DIR.joinpath(clip_file)] + [AUDIO_DIR.joinpath(instruments[p]["file"]) for p in programs_used],
+        render_cache.PITCH,
+        channels,
+        {
+            "speed": speed, "transpose": transpose, "limit": limit, "gain_db": float(gain_db or 0),
+            "instruments": [[p, float(instruments[p].get("gain_db", 0)), pans[p]] for p in programs_used],
+            "max_shift": MAX_SEMITONE_SHIFT, "min_note_frames": min_note_frames,
+        },
+    )
+    packet_cache = opus_cache.for_audio_dir(AUDIO_DIR)
+    packet_key = opus_cache.key(song_key, base_volume) if song_key is not None else None
+    chunks, size = song_render_cache.play(songs, song_key, base_volume, window * 2 * channels)
+    if chunks is not None:
+        log.info("song: %s cached render (%d hits / %d misses)", song_file, songs.hits, songs.misses)
+        frame_bytes = FRAME_BYTES // 2 * channels
+        packets = opus_cache.load(packet_cache, packet_key, -(-size // frame_bytes))
+        recorder = None if packets is not None else opus_cache.Recorder(packet_cache, packet_key, channels)
+        source = _StreamedSong(next(chunks), chunks, ahead, channels, packets, recorder)
+        return source, size / (2 * channels) / SR
+
+    notes = _parse_song(song_path, tag)
+    if not len(notes):
+        return None, 0.0
+    root = notes.median_pitch()
+
+    # Per-note frame offsets, caps and shifts, worked out column-wise.
+    offsets = (notes.start / speed * SR).astype(np.int64)
+    caps = np.maximum(min_note_frames, (notes.duration / speed * SR).astype(np.int64))
+    shifts = np.clip(notes.pitch - root + transpose, -MAX_SEMITONE_SHIFT, MAX_SEMITONE_SHIFT)
+    programs = notes.program
+    if limit:
+        keep = offsets < limit
+        offsets, caps, shifts, programs = offsets[keep], caps[keep], shifts[keep], programs[keep]
+
+    def line_for(program):
+        """(clip path string, gain multiplier, pan) for an instrument line."""
+        ins = instruments.get(program)
         if ins:
-            return AUDIO_DIR.joinpath(ins["file"]), transform.gain_db_to_multiplier(
-                ins.get("gain_db", 0)
-            )
-        return AUDIO_DIR.joinpath(clip_file), transform.gain_db_to_multiplier(gain_db)
+            return str(AUDIO_DIR.joinpath(ins["file"])), round(
+                transform.gain_db_to_multiplier(ins.get("gain_db", 0)), 4
+            ), pans[program]
+        return str(AUDIO_DIR.joinpath(clip_file)), round(transform.gain_db_to_multiplier(gain_db), 4), 0.0
 
     # Render each distinct (clip, shift, gain) combo once — a tune uses only a
-    # handful per line. Keyed by clip path string so different lines don't clash.
-    render_cache = {}
-
-    def render(note):
-        clip_path, vol = line_for(note)
-        key = (str(clip_path), shift_for(note), round(vol, 4))
-        pcm = render_cache.get(key)
-        if pcm is None:
-            pcm = _render_clip_pcm(clip_path, key[1], vol)
-            render_cache[key] = pcm
-        return pcm
-
-    min_note_bytes = int(MIN_NOTE_SECONDS * SR) * BYTES_PER_FRAME
-    placements = []
-    max_end = 0
-    for n in notes:
-        offset = int((n.start / speed) * SR) * BYTES_PER_FRAME
-        if limit_bytes and offset >= limit_bytes:
-            continue
-        pcm = render(n) or b""
-        if not pcm:
-            continue
-        cap = max(min_note_bytes, int((n.duration / speed) * SR) * BYTES_PER_FRAME)
-        seg = pcm[:cap]
-        if limit_bytes:
-            seg = seg[:limit_bytes - offset]  # don't ring past the cap
-        if not seg:
-            continue
-        placements.append((offset, seg))
-        max_end = max(max_end, offset + len(seg))
-
-    if max_end == 0:
+    # handful per line — with each clip's combos batched into a single decode.
+    # Keyed by clip path string so different lines don't clash.
+    pairs, pair_ids = np.unique(np.stack([programs, shifts], axis=1), axis=0, return_inverse=True)
+    pair_keys = [line_for(program) + (shift,) for program, shift in pairs.tolist()]
+    combos = {}
+    for clip_path, vol, _balance, shift in pair_keys:
+        combos.setdefault(clip_path, set()).add((shift, vol))
+    # One executor job per clip, all queued up front so the lines render in
+    # parallel across the pool's workers.
+    jobs = []
+    for clip_path, variants in combos.items():
+        variants = sorted(variants)
+        jobs.append((clip_path, variants, _submit_clip_variants(Path(clip_path), variants, tag)))
+    rendered = {}
+    for clip_path, variants, job in jobs:
+        pcms = job.result()
+        if not all(pcms):
+            log.warning("song: render of %s failed", clip_path)
+        for (shift, vol), pcm in zip(variants, pcms):
+            rendered[(clip_path, vol, shift)] = pcm
+
+    lines = [_pan(rendered[(clip_path, vol, shift)], pan, channels) for clip_path, vol, pan, shift in pair_keys]
+    mix = mixdown.Mixdown(lines, pair_ids.reshape(-1), offsets, caps, channels=channels, limit=limit)
+    if not mix.frames:
         return None, 0.0
 
-    canvas = bytearray(max_end)
-    for i, (offset, seg) in enumerate(placements):
-        region = bytes(canvas[offset:offset + len(seg)])
-        if len(region) < len(seg):
-            seg = seg[:len(region)]
-        if not seg:
-            continue
-        mixed = audioop.add(region, seg, 2)
-        canvas[offset:offset + len(mixed)] = mixed
-        # audioop holds the GIL; without periodic yields this tight mix loop
-        # starves discord.py's realtime audio thread (20ms/frame) and the
-        # gateway heartbeat → stutter. Sleep briefly every few notes so they
-        # always get a slice. (This runs in a worker thread, not the loop.)
-        if i % 8 == 7:
-            time.sleep(0.001)
-
     # Per-line gain (incl. the default line's) is already baked into each render,
-    # so finalize only applies the overall playback volume.
-    pcm_out = _finalize_song(bytes(canvas), base_volume)
-
-    # discord.PCMAudio drops a trailing partial frame, so pad to a frame boundary.
-    if len(pcm_out) % FRAME_BYTES:
-        pcm_out += b"\x00" * (FRAME_BYTES - len(pcm_out) % FRAME_BYTES)
-    duration_s = len(pcm_out) / (SR * BYTES_PER_FRAME)
-    return discord.PCMAudio(io.BytesIO(pcm_out)), duration_s
-
-
-def _finalize_song(pcm, volume):
-    """Loudness-normalise the assembled canvas, apply the overall volume, and
-    fade the last 30ms out (clean ending, no click when the cap truncates a
-    sound mid-way). Falls back to a plain volume scale if ffmpeg fails."""
-    dur = len(pcm) / (SR * BYTES_PER_FRAME)
-    fade = min(0.03, dur)
-    audio_filter = "{0},volume={1},afade=t=out:st={2:.3f}:d={3:.3f}".format(
-        SONG_LOUDNORM, volume, max(0.0, dur - fade), fade
+    # so finalize only applies the overall playback volume — on the way out of
+    # the cache recorder, so the cached copy is at unit volume.
+    chunks = song_render_cache.record(
+        songs, song_key, loudness.finalize_stream(mix.windows(window), mix.frames, 1.0, channels), base_volume
     )
-    cmd = [
-        "ffmpeg", "-hide_banner", "-loglevel", "error",
-        "-f", "s16le", "-ar", str(SR), "-ac", "2", "-i", "pipe:0",
-        "-af", audio_filter,
-        "-f", "s16le", "-ar", str(SR), "-ac", "2", "pipe:1",
-    ]
-    proc = sp.run(cmd, input=pcm, stdout=sp.PIPE, stderr=sp.PIPE)
-    if proc.returncode == 0 and proc.stdout:
-        return proc.stdout
-    log.warning("song: finalize loudnorm failed, using raw mix")
-    return audioop.mul(pcm, 2, volume)
+    first = next(chunks, b"")
+    if not first:
+        return None, 0.0
+    recorder = opus_cache.Recorder(packet_cache, packet_key, channels) if packet_key is not None else None
+    return _StreamedSong(first, chunks, ahead, channels, recorder=recorder), mix.frames / SR
+
+
+def _pan(pcm, pan, channels):
+    """A mono render as `channels`-channel PCM for the mix: as-is for a mono
+    mix, else balanced across left/right (centre = full level on both)."""
+    if channels == 1:
+        return pcm
+    mono = np.frombuffer(pcm, dtype="<i2").astype(np.float32)
+    gains = np.array([min(1.0, 1.0 - pan), min(1.0, 1.0 + pan)], dtype=np.float32)
+    return np.rint(mono[:, None] * gains).astype("<i2").tobytes()
+
+
+class _StreamedSong(discord.AudioSource):
+    """A song source fed by a background thread pulling finalized PCM chunks,
+    kept `ahead` bytes in front of the player. read() never blocks: if the
+    render falls behind it returns silence until the next chunk lands. Cleanup
+    (the song ended, was skipped or replaced) stops the render. A mono song is
+    buffered as mono and duplicated to stereo a frame at a time on read.
+
+    `packets` are the song's cached Opus packets (see _ClipSource.read_packet);
+    without them, a `recorder` encodes the song's packets from the render thread
+    as the chunks arrive, kept only if the whole song gets through."""
+
+    def __init__(self, first, chunks, ahead, channels=2, packets=None, recorder=None):
+        self._buf = bytearray(first)
+        self._ahead = ahead
+        self._channels = channels
+        self._frame = FRAME_BYTES // 2 * channels
+        self._packets = packets
+        self._frames_read = 0
+        self._cond = threading.Condition()
+        self._done = False
+        self._closed = False
+        threading.Thread(
+            target=self._fill, args=(first, chunks, recorder), name="pmb-song-render", daemon=True
+        ).start()
+
+    def _fill(self, first, chunks, recorder):
+        complete = False
+        try:
+            if recorder is not None:
+                recorder.feed(first)
+            for chunk in chunks:
+                with self._cond:
+                    while len(self._buf) > self._ahead and not self._closed:
+                        self._cond.wait(0.1)
+                    if self._closed:
+                        break
+                    self._buf += chunk
+                if recorder is not None:
+                    recorder.feed(chunk)
+            else:
+                complete = True
+        except Exception:
+            log.exception("song: render failed mid-song")
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()  # stops the mix and finalize stages
+            with self._cond:
+                self._done = True
+            if recorder is not None:
+                if complete:
+                    recorder.commit()
+                else:
+                    recorder.discard()
+
+    def read(self):
+        with self._cond:
+            if len(self._buf) >= self._frame:
+                frame = bytes(self._buf[: self._frame])
+                del self._buf[: self._frame]
+                self._frames_read += 1
+                self._cond.notify()
+                return self._stereo(frame)
+            if not self._done:
+                return SILENCE_FRAME  # underrun: keep the voice alive
+            frame = bytes(self._buf)
+            self._buf.clear()
+            self._frames_read += 1
+        return self._stereo(frame + b"\x00" * (self._frame - len(frame))) if frame else b""
+
+    def read_packet(self):
+        """The next frame's Opus packet, if the packets are cached and the frame
+        has been rendered; otherwise None (the caller reads PCM instead)."""
+        if self._packets is None:
+            return None
+        with self._cond:
+            ready = len(self._buf) >= self._frame or (self._done and self._buf)
+            if not ready or self._frames_read >= len(self._packets):
+                return None
+            del self._buf[: self._frame]
+            self._cond.notify()
+            packet = self._packets[self._frames_read]
+            self._frames_read += 1
+        return packet
+
+    def _stereo(self, frame):
+        return audioop.tostereo(frame, 2, 1, 1) if self._channels == 1 else frame
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
 
 
 class _MixerStream(discord.AudioSource):
@@ -206,27 +498,66 @@ class _MixerStream(discord.AudioSource):
     restarts just that voice. Played once and never stopped, so the connection
     stays warm. read() runs in discord.py's player thread; voices are guarded
     by a lock.
+
+    A voice that starts alone and has its Opus packets (a source with
+    read_packet) is passed through: read() returns its packets and is_opus() is
+    True, so discord.py sends them as is rather than encoding. The packets come
+    from a separate encoder, whose state differs from discord.py's, and every
+    switch between the two can click. So a voice switches at most once, when
+    another voice is mixed in, and is encoded live for the rest of its length.
+    A voice that started mixed stays live even once it's alone.
     """
 
     def __init__(self):
         self._lock = threading.Lock()
         self._voices = {}  # key -> (source, on_done)
+        self._next = {}  # key -> (source, on_done) queued to follow that voice
+        self._opus = False  # whether the last frame read() returned is Opus
+        self._fresh = weakref.WeakSet()  # sources not read from yet
+        self._solo = None  # the source being passed through, if any
 
     def set_voice(self, key, source, on_done=None):
         with self._lock:
             old = self._voices.get(key)
             self._voices[key] = (source, on_done)
+            self._fresh.add(source)
         if old is not None:
             if old[0] is not None:
                 old[0].cleanup()
             if old[1] is not None:
                 old[1]()  # unblock whoever was waiting on the replaced voice
 
+    def set_next_voice(self, key, source, on_done=None):
+        """Queue `source` to take over voice `key` the moment its current source
+        ends or is dropped — within the same frame, so there's no gap (e.g. the
+        next song in a queue). Starts it now if the voice isn't playing. Only
+        one source is queued per key; a new one replaces (and cleans up) it."""
+        with self._lock:
+            old = self._next.pop(key, None)
+            if key in self._voices:
+                self._next[key] = (source, on_done)
+            else:
+                self._voices[key] = (source, on_done)
+            self._fresh.add(source)
+        if old is not None:
+            _end_voice(old)
+
+    def discard_next_voice(self, key):
+        """Drop whatever is queued to follow voice `key` (firing its on_done)."""
+        with self._lock:
+            old = self._next.pop(key, None)
+        if old is not None:
+            _end_voice(old)
+
     def drop_voice(self, key):
         """Stop and remove a single voice (e.g. skip the song), firing its
-        on_done so anyone awaiting it is unblocked."""
+        on_done so anyone awaiting it is unblocked. A source queued with
+        set_next_voice takes over straight away."""
         with self._lock:
             old = self._voices.pop(key, None)
+            nxt = self._next.pop(key, None)
+            if nxt is not None:
+                self._voices[key] = nxt
         if old is not None:
             if old[0] is not None:
                 old[0].cleanup()
@@ -236,12 +567,28 @@ class _MixerStream(discord.AudioSource):
     def read(self):
         with self._lock:
             items = list(self._voices.items())
+            if len(items) != 1:
+                self._solo = None
+            else:
+                src = items[0][1][0]
+                if src in self._fresh and hasattr(src, "read_packet"):
+                    self._solo = src  # starting alone: pass it through
+                self._fresh.discard(src)
+        self._opus = False
         if not items:
             return SILENCE_FRAME
+        if self._solo is not None:
+            packet = self._solo.read_packet()
+            if packet:
+                self._opus = True
+                return packet
+            self._solo = None  # out of packets: live from here on
 
         mixed = None
         ended = []
         for key, (src, on_done) in items:
+            with self._lock:
+                self._fresh.discard(src)
             data = src.read()
             if not data:
                 ended.append((key, src, on_done))
@@ -249,26 +596,38 @@ class _MixerStream(discord.AudioSource):
             mixed = data if mixed is None else audioop.add(mixed, data, 2)
 
         for key, src, on_done in ended:
+            nxt = None
             with self._lock:
                 current = self._voices.get(key)
                 if current is not None and current[0] is src:
                     del self._voices[key]
+                    nxt = self._next.pop(key, None)
+                    if nxt is not None:
+                        self._voices[key] = nxt
             src.cleanup()
             if on_done is not None:
                 on_done()
+            if nxt is not None:
+                # Start the follower in this same frame.
+                with self._lock:
+                    self._fresh.discard(nxt[0])
+                data = nxt[0].read()
+                if data:
+                    mixed = data if mixed is None else audioop.add(mixed, data, 2)
 
         return mixed if mixed is not None else SILENCE_FRAME
 
     def is_opus(self):
-        return False
+        return self._opus
 
     def clear(self):
         """Drop all active voices immediately (stop playback) but keep the
         stream alive (it just emits silence). on_done fires so anyone awaiting
         a queue voice is unblocked."""
         with self._lock:
-            items = list(self._voices.items())
+            items = list(self._voices.items()) + list(self._next.items())
             self._voices.clear()
+            self._next.clear()
         for key, (src, on_done) in items:
             if src is not None:
                 src.cleanup()
@@ -277,13 +636,22 @@ class _MixerStream(discord.AudioSource):
 
     def cleanup(self):
         with self._lock:
-            voices = list(self._voices.values())
+            voices = list(self._voices.values()) + list(self._next.values())
             self._voices.clear()
+            self._next.clear()
         for src, _ in voices:
             if src is not None:
                 src.cleanup()
 
 
+def _end_voice(voice):
+    source, on_done = voice
+    if source is not None:
+        source.cleanup()
+    if on_done is not None:
+        on_done()
+
+
 class GuildPlayer:
     """Mixes per-user single plays (overlapping, restartable) with one
     sequential queue voice, over a persistent always-on stream."""
@@ -328,8 +696,18 @@ class GuildPlayer:
         self._log_start(time.monotonic())
         self._mixer.set_voice(voice_key, source, on_done)
 
+    def play_next(self, voice_key, source, on_done=None):
+        """Queue `source` to follow whatever `voice_key` is playing, gaplessly
+        (used for the pre-rendered next song). See _MixerStream.set_next_voice."""
+        self._begin_stream()
+        self._mixer.set_next_voice(voice_key, source, on_done)
+
+    def discard_next(self, voice_key):
+        self._mixer.discard_next_voice(voice_key)
+
     def stop_voice(self, voice_key):
-        """Stop a single voice immediately (used to skip the current song)."""
+        """Stop a single voice immediately (used to skip the current song). A
+        source queued with play_next starts in its place."""
         self._mixer.drop_voice(voice_key)
 
     async def enqueue(self, source):
@@ -338,7 +716,11 @@ class GuildPlayer:
 
     def _begin_stream(self):
         if self.voice_client.is_connected() and not self.voice_client.is_playing():
-            self.voice_client.play(self._mixer, after=self._stream_ended)
+            # Encode live frames at the packet cache's bitrate, so passthrough
+            # and live frames match.
+            self.voice_client.play(
+                self._mixer, after=self._stream_ended, bitrate=opus_cache.OPUS_BITRATE
+            )
 
     def _stream_ended(self, error):
         if error:
@@ -0,0 +1,95 @@
+"""Tests for the Discord bot's command plumbing that runs without a gateway."""
+
+import asyncio
+import threading
+
+from python_discord_bot import bot
+
+
+class FakeFeed:
+    """A CommandFeed whose wait blocks until the test says a command is due."""
+
+    def __init__(self):
+        self.due = threading.Event()
+        self.claims = []
+
+    def wait(self):
+        self.due.wait()
+        self.due.clear()
+
+    def claimed(self, found):
+        self.claims.append(found)
+
+
+def test_loop_feed_waits_on_its_own_thread_and_wakes_the_loop():
+    async def main():
+        feed = FakeFeed()
+        loop_feed = bot._LoopFeed(feed, asyncio.get_running_loop(), "test-feed")
+        waiting = asyncio.ensure_future(loop_feed.wait())
+        await asyncio.sleep(0.05)
+        assert not waiting.done()  # nothing due, and the loop isn't blocked
+
+        feed.due.set()
+        await asyncio.wait_for(waiting, 5)
+        loop_feed.claimed(True)  # the thread goes back to waiting on the feed
+        feed.due.set()
+        await asyncio.wait_for(loop_feed.wait(), 5)
+        assert feed.claims == [True]
+
+    asyncio.run(main())
+
+
+class FailingMongo:
+    """Claims one batch of control commands, failing the first claim."""
+
+    def __init__(self):
+        self.claims = 0
+
+    def claim_pending_commands(self, lane):
+        self.claims += 1
+        if self.claims == 1:
+            raise RuntimeError("mongo went away")
+        return [{"_id": "stop", "type": "stop"}]
+
+
+def test_a_failing_control_claim_or_command_doesnt_stop_the_control_lane(caplog):
+    async def main():
+        client = bot.DiscordBot.__new__(bot.DiscordBot)
+        client.mongo = FailingMongo()
+        feed = FakeFeed()
+        client._control_feed = bot._LoopFeed(
+            feed, asyncio.get_running_loop(), "test-control-feed"
+        )
+        ran = []
+
+        async def run_control_commands(commands, via, claimed_at):
+            ran.append(commands)
+            raise RuntimeError("stop handler broke")
+
+        client._run_control_commands = run_control_commands
+        poll = bot.DiscordBot.poll_control.coro
+        for _ in range(2):
+            feed.due.set()
+            await asyncio.wait_for(poll(client), 5)  # neither failure escapes
+        assert feed.claims == [False, True]
+        assert ran == [[{"_id": "stop", "type": "stop"}]]
+
+    asyncio.run(main())
+    assert "Claiming control commands failed" in caplog.text
+    assert "Running control commands failed" in caplog.text
+
+
+def test_a_failing_direct_command_is_logged(caplog):
+    async def main():
+        async def broken():
+            raise RuntimeError("play broke")
+
+        future = asyncio.run_coroutine_threadsafe(broken(), asyncio.get_running_loop())
+        future.add_done_callback(bot._log_failure("Running direct commands"))
+        await asyncio.wrap_future(future)
+
+    try:
+        asyncio.run(main())
+    except RuntimeError:
+        pass
+    assert "Running direct commands failed" in caplog.text
@@ -0,0 +1,73 @@
+"""Tests for the Discord bot's Opus packet cache.
+
+libopus isn't needed: the encoder is swapped for one that "encodes" a frame as
+its first six samples, which is enough to check the framing, padding and upmix.
+"""
+
+import time
+
+import numpy as np
+import pytest
+
+from python_discord_bot import opus_cache
+
+FRAME = opus_cache.FRAME_BYTES
+
+
+class FakeEncoder:
+    SAMPLES_PER_FRAME = 960
+
+    def encode(self, pcm, frame_size):
+        assert len(pcm) == FRAME and frame_size == self.SAMPLES_PER_FRAME
+        return pcm[:12]
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(opus_cache, "new_encoder", FakeEncoder)
+    return opus_cache.for_audio_dir(tmp_path)
+
+
+def test_recorded_packets_line_up_with_the_padded_frames(cache):
+    key = opus_cache.key("pcm-key", 0.5)
+    mono = np.arange(FRAME // 4 + 3, dtype="<i2").tobytes()  # a frame and a bit
+    recorder = opus_cache.Recorder(cache, key, channels=1)
+    recorder.feed(mono[:100])
+    recorder.feed(mono[100:])
+    recorder.commit()
+
+    packets = opus_cache.load(cache, key, 2)
+    assert packets == [
+        np.array([0, 0, 1, 1, 2, 2], "<i2").tobytes(),  # upmixed to stereo
+        np.array([960, 960, 961, 961, 962, 962], "<i2").tobytes(),
+    ]
+    assert opus_cache.load(cache, key, 3) is None  # a count mismatch is a miss
+    assert key != opus_cache.key("pcm-key", 1.0)
+
+
+def test_discarded_recording_is_not_stored(cache):
+    key = opus_cache.key("pcm-key", 1.0)
+    recorder = opus_cache.Recorder(cache, key)
+    recorder.feed(b"\x01" * FRAME * 2)
+    recorder.discard()
+    assert opus_cache.load(cache, key, 2) is None
+    assert not list(cache.directory.iterdir())
+
+
+def test_clip_miss_is_encoded_in_the_background_for_the_next_play(cache):
+    key = opus_cache.key("clip-key", 1.0)
+    pcm = b"\x02" * FRAME * 3
+    assert opus_cache.packets_for_clip(cache, key, pcm) is None
+    deadline = time.monotonic() + 5
+    while key in opus_cache._pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert opus_cache.packets_for_clip(cache, key, pcm) == [b"\x02" * 12] * 3
+
+
+def test_nothing_is_recorded_without_libopus(tmp_path, monkeypatch):
+    monkeypatch.setattr(opus_cache, "new_encoder", lambda: None)
+    cache = opus_cache.for_audio_dir(tmp_path)
+    recorder = opus_cache.Recorder(cache, "k")
+    recorder.feed(b"\x00" * FRAME)
+    recorder.commit()
+    assert not cache.directory.exists()
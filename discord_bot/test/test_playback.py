@@ -9,9 +9,11 @@ queue / skip logic depends on.
 
 import audioop
 import shutil
+import time
 
 import discord
 import mido
+import numpy as np
 import pytest
 
 from python_discord_bot import playback
@@ -124,6 +126,137 @@ def test_clear_fires_all_on_done():
     assert mixer.read() == playback.SILENCE_FRAME
 
 
+def test_next_voice_takes_over_in_the_same_frame():
+    # The pre-rendered next song follows the current one with no silent frame.
+    mixer = playback._MixerStream()
+    fired = []
+    mixer.set_voice("song", FakeSource([_const_frame(1)]), on_done=lambda: fired.append("a"))
+    mixer.set_next_voice("song", FakeSource([_const_frame(2)] * 2), on_done=lambda: fired.append("b"))
+
+    assert mixer.read() == _const_frame(1)
+    assert mixer.read() == _const_frame(2)  # a ended this frame, b filled it
+    assert fired == ["a"]
+    assert mixer.read() == _const_frame(2)
+    assert mixer.read() == playback.SILENCE_FRAME
+    assert fired == ["a", "b"]
+
+
+def test_drop_voice_promotes_next_and_clear_drops_both():
+    mixer = playback._MixerStream()
+    nxt = FakeSource([_const_frame(2)] * 5)
+    mixer.set_voice("song", FakeSource([_const_frame(1)] * 5))
+    mixer.set_next_voice("song", nxt)
+    mixer.drop_voice("song")  # skip: the next song starts straight away
+    assert mixer.read() == _const_frame(2)
+
+    queued = FakeSource([_const_frame(3)])
+    mixer.set_next_voice("song", queued)
+    mixer.clear()
+    assert nxt.cleaned and queued.cleaned
+    assert mixer.read() == playback.SILENCE_FRAME
+
+    # With nothing playing on the key, a queued voice just starts.
+    mixer.set_next_voice("song", FakeSource([_const_frame(4)]))
+    assert mixer.read() == _const_frame(4)
+
+
+def test_single_cached_voice_passes_opus_through_until_voices_overlap():
+    mixer = playback._MixerStream()
+    pcm = _const_frame(10) * 4
+    mixer.set_voice("a", playback._ClipSource(pcm, [b"p0", b"p1", b"p2", b"p3"]))
+
+    assert mixer.read() == b"p0" and mixer.is_opus()
+    mixer.set_voice("b", FakeSource([_const_frame(5)]))
+    assert mixer.read() == _const_frame(15) and not mixer.is_opus()  # a's frame 1, mixed
+    assert mixer.read() == _const_frame(10) and not mixer.is_opus()  # b ends this frame
+    # a is live for the rest of it, not switched back to its packets.
+    assert mixer.read() == _const_frame(10) and not mixer.is_opus()
+    assert mixer.read() == playback.SILENCE_FRAME and not mixer.is_opus()
+
+
+def test_only_a_voice_that_starts_alone_is_passed_through():
+    mixer = playback._MixerStream()
+    mixer.set_voice("b", FakeSource([_const_frame(5)]))
+    mixer.set_voice("a", playback._ClipSource(_const_frame(10) * 3, [b"p0", b"p1", b"p2"]))
+    assert mixer.read() == _const_frame(15)  # started mixed...
+    assert mixer.read() == _const_frame(10) and not mixer.is_opus()  # ...b ends
+    assert mixer.read() == _const_frame(10) and not mixer.is_opus()  # still live
+    assert mixer.read() == playback.SILENCE_FRAME  # a ends
+
+    # The next one to start alone is passed through from its first frame.
+    mixer.set_voice("c", playback._ClipSource(_const_frame(1) * 2, [b"q0", b"q1"]))
+    assert mixer.read() == b"q0" and mixer.is_opus()
+    assert mixer.read() == b"q1" and mixer.is_opus()
+
+
+def test_clip_source_reports_its_first_frame_once_either_way_it_is_read():
+    started = []
+    source = playback._ClipSource(_const_frame(1) * 2, [b"p0", b"p1"], lambda: started.append(1))
+    mixer = playback._MixerStream()
+    mixer.set_voice("a", source)
+    assert started == []  # queued isn't audible
+    assert mixer.read() == b"p0" and started == [1]
+    mixer.read()
+    assert started == [1]
+
+    started.clear()
+    source = playback._ClipSource(_const_frame(1), None, lambda: started.append(1))
+    source.read()
+    assert started == [1]
+
+
+# --- build_source / clip PCM cache -----------------------------------------------
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not available")
+def test_repeat_presses_are_served_from_memory(tmp_path, monkeypatch):
+    import os
+    import subprocess as sp
+
+    monkeypatch.setattr(playback, "AUDIO_DIR", tmp_path)
+    monkeypatch.setattr(playback, "_clips", playback._PcmCache(1 << 20))
+    clip = tmp_path / "clip.wav"
+    sp.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi",
+         "-i", "sine=frequency=440:duration=0.25", str(clip)],
+        check=True,
+    )
+
+    first = playback.build_source("clip.wav", 1.5, 2, 0.5)
+    again = playback.build_source("clip.wav", 1.5, 2, 0.5)
+    assert (playback._clips.hits, playback._clips.misses) == (1, 1)
+    assert again.read() == first.read() and len(again._pcm) % playback.FRAME_BYTES == 0
+    assert again._pcm is first._pcm  # a new cursor over the same render
+
+    playback.build_source("clip.wav", 1.5, 2, 0.25)  # another volume is another entry
+    os.utime(clip, (1, 1))  # re-uploaded: the old render no longer matches
+    playback.build_source("clip.wav", 1.5, 2, 0.5)
+    assert (playback._clips.hits, playback._clips.misses) == (1, 3)
+
+
+def test_pcm_cache_evicts_least_recently_used():
+    cache = playback._PcmCache(10)
+    for key in "abc":
+        cache.put(key, playback._RenderedClip(b"x" * 4, None))
+    assert cache.get("a") is None and cache.bytes_used == 8  # a went to fit c
+    cache.get("b")
+    cache.put("d", playback._RenderedClip(b"x" * 4, None))
+    assert cache.get("c") is None and cache.get("b") is not None
+    cache.put("big", playback._RenderedClip(b"x" * 20, None))
+    assert cache.get("big") is not None and cache.bytes_used == 20  # newest is kept
+
+
+def test_streamed_song_hands_out_cached_packets_in_step_with_its_frames():
+    frame = playback.FRAME_BYTES // 2  # mono
+    source = playback._StreamedSong(
+        b"\x01" * (frame * 2 + 4), iter([]), 10 * frame, channels=1, packets=[b"p0", b"p1", b"p2"]
+    )
+    _wait_rendered(source)
+    assert source.read_packet() == b"p0"
+    assert source.read() == b"\x01" * playback.FRAME_BYTES
+    assert source.read_packet() == b"p2"  # the padded last frame
+    assert source.read_packet() is None and source.read() == b""
+
+
 # --- build_song_source -------------------------------------------------------
 
 def _write_midi(path, notes_ticks=480):
@@ -174,9 +307,89 @@ def test_build_song_source_renders_pcm(tmp_path, monkeypatch):
         "clip.wav", "tune.mid", transpose=0, speed=1.0, gain_db=0.0, base_volume=1.0
     )
 
-    assert isinstance(source, discord.PCMAudio)
+    assert isinstance(source, discord.AudioSource)
     assert duration > 0
-    # the rendered PCM is frame-aligned (PCMAudio drops a trailing partial frame)
-    pcm = source.stream.read()
-    assert len(pcm) % playback.FRAME_BYTES == 0
-    assert len(pcm) > 0
+    # the song streams out in whole frames (silence while a window renders,
+    # b"" once it's done)
+    frames = []
+    while True:
+        frame = source.read()
+        if not frame:
+            break
+        assert len(frame) == playback.FRAME_BYTES
+        frames.append(frame)
+    assert len(frames) >= duration * 50
+
+
+def _wait_rendered(source):
+    deadline = time.monotonic() + 5
+    while not source._done and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_streamed_song_yields_whole_frames_then_ends():
+    tail = b"\x02" * (playback.FRAME_BYTES + 8)
+    source = playback._StreamedSong(b"\x01" * 8, iter([tail]), 10 * playback.FRAME_BYTES)
+    _wait_rendered(source)
+    frames = [source.read() for _ in range(3)]
+    assert frames[0] == b"\x01" * 8 + b"\x02" * (playback.FRAME_BYTES - 8)
+    assert frames[1] == b"\x02" * 16 + b"\x00" * (playback.FRAME_BYTES - 16)  # padded
+    assert frames[2] == b""
+
+
+def test_mono_streamed_song_is_upmixed_on_read():
+    mono = np.arange(playback.FRAME_BYTES // 4 + 3, dtype="<i2").tobytes()
+    source = playback._StreamedSong(mono, iter([]), 10 * playback.FRAME_BYTES, channels=1)
+    _wait_rendered(source)
+    first, last = source.read(), source.read()
+    assert len(first) == len(last) == playback.FRAME_BYTES
+    stereo = np.frombuffer(first, "<i2").reshape(-1, 2)
+    assert stereo[:, 0].tolist() == stereo[:, 1].tolist() == list(range(len(stereo)))
+    assert np.frombuffer(last, "<i2")[:8].tolist() == [960, 960, 961, 961, 962, 962, 0, 0]
+    assert source.read() == b""
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="ffmpeg not available")
+def test_panned_line_makes_the_song_stereo(tmp_path, monkeypatch):
+    import subprocess as sp
+
+    songs = tmp_path / "music"
+    songs.mkdir()
+    monkeypatch.setattr(playback, "AUDIO_DIR", tmp_path)
+    monkeypatch.setattr(playback, "SONGS_DIR", songs)
+    for name in ("clip.wav", "left.wav"):
+        sp.run(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "lavfi",
+             "-i", "sine=frequency=440:duration=0.5", str(tmp_path / name)],
+            check=True,
+        )
+    _write_midi(songs / "tune.mid")  # every note is on program 0
+
+    source, _duration = playback.build_song_source(
+        "clip.wav", "tune.mid", transpose=0, speed=1.0, gain_db=0.0, base_volume=1.0,
+        instruments={0: {"file": "left.wav", "gain_db": 0, "pan": -1.0}},
+    )
+    pcm = b""
+    while True:
+        frame = source.read()
+        if not frame:
+            break
+        pcm += frame
+    stereo = np.frombuffer(pcm, "<i2").reshape(-1, 2)
+    assert np.abs(stereo[:, 0]).max() > 1000
+    assert np.abs(stereo[:, 1]).max() == 0
+
+
+def test_streamed_song_stops_rendering_on_cleanup():
+    pulled = []
+
+    def chunks():
+        for _ in range(100):
+            pulled.append(1)
+            yield playback.SILENCE_FRAME
+
+    source = playback._StreamedSong(b"", chunks(), playback.FRAME_BYTES)
+    source.read()  # underrun or a frame, never a block
+    source.cleanup()  # e.g. the song was skipped
+    _wait_rendered(source)
+    assert source._done and len(pulled) < 100
@@ -20,12 +20,16 @@ class AudioEvent(Event):
         voice_key=None,
         append=True,
         reverses=None,
+        traces=None,
     ):
         super().__init__(data)
         self.playback_speeds = playback_speeds
         self.semitone_shifts = semitone_shifts
         # Parallel to data: whether each clip plays backwards. None → all forward.
         self.reverses = reverses
+        # Parallel to data: each clip's latency trace (pmb_core.db.latency), for
+        # web plays. None → not traced.
+        self.traces = traces
         # Mixer routing: which "voice" this plays on, and whether it appends to
         # that voice (sequential) or replaces it (interrupt/restart). Web single
         # plays key by requester + replace; queues use a shared appending voice;
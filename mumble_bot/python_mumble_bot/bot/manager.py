@@ -1,23 +1,41 @@
-import audioop
 import base64
 import datetime as dt
 import json
 import logging
+import math
 import os
+import queue
 import re
-import statistics
 import subprocess as sp
 import threading
 import time
 import wave
-from collections import OrderedDict, deque
+from collections import deque
 from pathlib import Path
 
+import numpy as np
 import requests
-from pmb_core.audio import transform
-from pmb_core.audio.midi import parse_midi
+from pmb_core.audio import (
+    executor,
+    loudness,
+    mixdown,
+    render_cache,
+    song_cache,
+    song_render_cache,
+    transform,
+)
+from pmb_core.db import channel, latency
+from pmb_core.db.commands import (
+    CONTROL,
+    NORMAL,
+    STOPPING_TYPES,
+    is_control,
+    superseded,
+)
 
+from python_mumble_bot.bot import mixer
 from python_mumble_bot.bot.constants import (
+    AUDIO_DIR,
     MUMBLE_USERNAME,
     NAME,
     ROOT_CHANNEL,
@@ -64,38 +82,54 @@ class PlaybackManager(EventManager):
     RESAMPLE_FILTER = transform.RESAMPLE_FILTER
     SETRATE_FILTER = transform.SETRATE_FILTER
 
-    # Spawning ffmpeg per play costs ~85ms (225ms cold), so cache the decoded
-    # PCM. Bounded by total bytes (~10s clip = ~1MB of 48kHz mono PCM).
-    PCM_CACHE_MAX_BYTES = 64 * 1024 * 1024
-
     SAMPLE_RATE = 48000
-    # Keep pymumble's output buffer topped to ~this much. Small = snappy
-    # interrupts/overlap; large enough to ride out the occasional scheduling gap.
-    MIX_TARGET_SECS = 0.04
 
     # MIDI-song ("jukebox") render: clamp pitch shift to ±2 octaves, floor each
     # note so short notes still pop, and loudness-normalise the assembled mix.
     SONG_MAX_SEMITONE_SHIFT = 24
     SONG_MIN_NOTE_SECONDS = 0.08
-    SONG_LOUDNORM = "loudnorm=I=-16:TP=-1.5:LRA=11"
+    # Songs are mixed and finalized a window at a time and fed to the song voice
+    # as they're ready, keeping about this much queued ahead of the playhead.
+    SONG_WINDOW_SECONDS = 2.0
+    SONG_FEED_AHEAD_SECONDS = 4.0
 
     # Songs play on their own mixer voice, serialised one-at-a-time by the song
     # worker (a "now playing" + upcoming-queue mini-player, mirrored to the
     # shared `song_state` doc so the web can show it — same as the Discord bot).
     SONG_VOICE = "__song__"
+    # The head of the queue is pre-rendered (up to its first window) while the
+    # current song plays, under its own executor tag so a skip doesn't cancel
+    # it. Once the current song has this little left and the next is ready, the
+    # next one's windows are appended to the same voice, with no gap.
+    SONG_NEXT_TAG = "__song_next__"
+    SONG_HANDOFF_SECONDS = 0.25
 
     def __init__(self, mumble, state_manager):
         self.mumble = mumble
         self.state_manager = state_manager
-        self._pcm_cache = OrderedDict()
-        self._pcm_cache_bytes = 0
+        # Renders are in-process (pmb_core.audio.engine, a few ms) and cached
+        # on the shared audio volume, so web previews warm them for us too.
+        self._render_cache = render_cache.for_audio_dir(state_manager.audio_clips_dir)
 
         # Software mixer: pymumble has no notion of overlapping voices (its
         # output is one sequential PCM stream), so we keep our own per-"voice"
-        # buffers and feed pymumble a single pre-mixed stream. A voice is
-        # {pcm, pos}; the mixer thread sums the active ones each frame.
+        # buffers (mixer.Voice) and feed pymumble a single pre-mixed stream;
+        # the mixer thread sums the active ones a block of frames at a time.
         self._voices = {}
         self._mix_lock = threading.Lock()
+        # Voices are fed incrementally (a clip chain streams in behind its first
+        # clip), so each voice has an owner token; a replace/stop/drop changes
+        # it and the old feeder's later chunks are discarded.
+        self._voice_owner = {}
+        self._voice_serial = 0
+        # Bumped by every panic-stop. A clip chain notes it before rendering, so
+        # a stop that lands mid-render (before the chain owns a voice) still
+        # discards it, and the chain renders nothing more.
+        self._stop_serial = 0
+        # Keeps pymumble's output buffer topped to an adaptive target: small
+        # for snappy interrupts/overlap, growing when the host gets jittery.
+        self._mix_clock = mixer.MixerClock()
+        self._mix_playing = False  # has the mix been feeding pymumble?
         self._mixer_thread = threading.Thread(
             target=self._mixer_loop, name="pmb-mixer", daemon=True
         )
@@ -108,6 +142,7 @@ class PlaybackManager(EventManager):
         self._song_current = None  # dict the web renders, or None when idle
         self._song_lock = threading.Lock()
         self._skip_flag = threading.Event()
+        self._song_next = None  # the pre-rendered head of the queue, if any
         self._song_state_clean = False  # cleared stale state on startup yet?
         self._song_worker_thread = threading.Thread(
             target=self._song_worker_loop, name="pmb-song-worker", daemon=True
@@ -121,11 +156,17 @@ class PlaybackManager(EventManager):
 
     def _mixer_loop(self):
         while True:
+            self._mix_clock.wait()
             try:
                 self._mix_tick()
             except Exception:
                 log.exception("mixer tick failed")
-            time.sleep(0.005)
+
+    def mixer_stats(self):
+        """The mixer clock's counters (underruns, late ticks, frames mixed) and
+        its current buffer target; logged on an underrun, and once every
+        mixer.STATS_LOG_SECONDS while the mix plays."""
+        return self._mix_clock.stats()
 
     def _mix_tick(self):
         so = getattr(self.mumble, "sound_output", None)
@@ -133,85 +174,81 @@ class PlaybackManager(EventManager):
             return
         with self._mix_lock:
             if not self._voices:
+                self._mix_playing = False
+                return
+            buffered = so.get_buffer_size()
+            if buffered <= 0 and self._mix_playing:
+                # Still had audio to play, but pymumble ran dry: a stutter.
+                self._mix_clock.underrun()
+                log.warning("mixer underrun: %s", self.mixer_stats())
+            # Top the output buffer up to the target, mixing all active voices
+            # in one block.
+            deficit = self._mix_clock.target - buffered
+            if deficit <= 0:
                 return
+            frames = math.ceil(deficit / so.get_audio_per_packet())
             frame_bytes = self._frame_bytes(so)
-            guard = 0
-            # Top the output buffer up to the target, mixing all active voices.
-            while (
-                self._voices
-                and so.get_buffer_size() < self.MIX_TARGET_SECS
-                and guard < 25
-            ):
-                guard += 1
-                mixed = None
-                finished = []
-                for key, v in self._voices.items():
-                    chunk = v["pcm"][v["pos"] : v["pos"] + frame_bytes]
-                    if not chunk:
-                        finished.append(key)
-                        continue
-                    v["pos"] += len(chunk)
-                    if len(chunk) < frame_bytes:  # pad the final partial frame
-                        chunk = chunk + b"\x00" * (frame_bytes - len(chunk))
-                    mixed = chunk if mixed is None else audioop.add(mixed, chunk, 2)
-                for key in finished:
-                    del self._voices[key]
-                if mixed is None:
-                    break
+            mixed = mixer.mix(self._voices, frames * frame_bytes, frame_bytes)
+            self._mix_playing = mixed is not None
+            if mixed is not None:
                 so.add_sound(mixed)
+                self._mix_clock.mixed(len(mixed) // frame_bytes)
+                if self._mix_clock.stats_due():
+                    log.info("mixer: %s", self.mixer_stats())
 
-    def _submit_voice(self, key, pcm, append):
-        if not pcm:
-            return
+    def _submit_voice(
+        self, key, pcm, append, token=None, on_start=None, stop_serial=None
+    ):
+        """Play `pcm` on voice `key`, replacing it or appending to it. Returns
+        the voice's owner token; pass it back (with append=True) to feed the
+        same voice more PCM. A stale token — the voice was replaced, dropped or
+        stopped since — discards the PCM and returns None, as does a stop since
+        `stop_serial` (`_stop_serial` when the feeder started). `on_start` is
+        called on the mixer thread once the first of `pcm` has been mixed."""
         with self._mix_lock:
+            if token is not None and self._voice_owner.get(key) != token:
+                return None
+            if stop_serial is not None and stop_serial != self._stop_serial:
+                return None
+            if not append or key not in self._voice_owner:
+                self._voice_serial += 1
+                self._voice_owner[key] = self._voice_serial
+            if not pcm:
+                return self._voice_owner[key]
             v = self._voices.get(key)
-            if append and v is not None and v["pos"] < len(v["pcm"]):
-                # Concatenate after the not-yet-played remainder (compact the
-                # already-played head so the buffer doesn't grow unbounded).
-                v["pcm"] = v["pcm"][v["pos"] :] + pcm
-                v["pos"] = 0
+            if append and v is not None:
+                v.append(pcm, on_start)  # queued behind the unplayed remainder
             else:
-                self._voices[key] = {"pcm": pcm, "pos": 0}
-
-    def _get_pcm(self, ref, file, pitch_filter, volume, speed, shift, reverse=False):
-        # Cache key includes the file mtime (so a trim/re-upload invalidates it)
-        # and every transform param (so pitch/speed/volume/reverse changes are distinct).
+                self._voices[key] = mixer.Voice(pcm, on_start)
+            return self._voice_owner[key]
+
+    def _get_pcms(self, file, variants):
+        # Shared on-disk render cache: keyed by clip content + transform params,
+        # rendered at unit volume with each variant's volume applied on the way
+        # out. Misses among the (speed, shift, reverse, volume) variants are
+        # rendered together from one decode. Returns [(pcm, cached), ...].
+        return self._render_cache.render_many(file, render_cache.RESAMPLE, variants)
+
+    def prerender(self, items):
+        """Warm the render cache for upcoming (clip_ref, speed, shift, reverse)
+        plays (e.g. the rest of a generated queue), one decode per clip."""
+        by_file = {}
+        t0 = time.monotonic()
         try:
-            mtime = os.path.getmtime(file)
-        except OSError:
-            mtime = 0
-        key = (
-            str(file),
-            round(mtime, 3),
-            pitch_filter,
-            round(volume, 3),
-            round(speed, 4),
-            round(shift, 4),
-            reverse,
-        )
-        pcm = self._pcm_cache.get(key)
-        if pcm is not None:
-            self._pcm_cache.move_to_end(key)  # mark most-recently-used
-            return pcm, True
-
-        pcm = transform.transform_audio(
-            file,
-            pitch_filter,
-            volume,
-            speed,
-            shift,
-            desired_output="pcm",
-            reverse=reverse,
+            for ref, speed, shift, reverse in items:
+                file = self.state_manager.find_audio_clip(ref)
+                by_file.setdefault(file, []).append((speed, shift, reverse, 1.0))
+            for file, variants in by_file.items():
+                self._get_pcms(file, variants)
+        except Exception:
+            log.exception("prerender failed")
+            return
+        log.info(
+            "[timing] prerendered %d queued clips (%d files) in %.0fms",
+            len(items),
+            len(by_file),
+            (time.monotonic() - t0) * 1000,
         )
-        self._pcm_cache[key] = pcm
-        self._pcm_cache_bytes += len(pcm)
-        while (
-            self._pcm_cache_bytes > self.PCM_CACHE_MAX_BYTES
-            and len(self._pcm_cache) > 1
-        ):
-            _, evicted = self._pcm_cache.popitem(last=False)  # evict oldest
-            self._pcm_cache_bytes -= len(evicted)
-        return pcm, False
 
     def accept(self, event):
         return (
@@ -223,7 +260,7 @@ class PlaybackManager(EventManager):
 
     def dispatch(self, event):
         if isinstance(event, AudioEvent):
-            self._play_clips(event, self.RESAMPLE_FILTER)
+            self._play_clips(event)
         elif isinstance(event, VocodeEvent):
             self._process_vocode_event(event)
         elif isinstance(event, MidiSongEvent):
@@ -259,121 +296,134 @@ class PlaybackManager(EventManager):
 
         self._play_sound(pcm)
 
-    def _play_clips(self, event, pitch_filter):
+    def _play_clips(self, event):
         key = event.voice_key or "default"
-        segment = b""
+        stop_serial = self._stop_serial
         reverses = event.reverses or [False] * len(event.data)
-        for ref, speed, shift, reverse in zip(
-            event.data, event.playback_speeds, event.semitone_shifts, reverses
+        traces = event.traces or [None] * len(event.data)
+        base_volume = self.state_manager.get_volume()
+        items = []
+        for ref, speed, shift, reverse, trace in zip(
+            event.data, event.playback_speeds, event.semitone_shifts, reverses, traces
         ):
             file = self.state_manager.find_audio_clip(ref)
             gain = transform.gain_db_to_multiplier(
                 self.state_manager.get_clip_gain_db(ref)
             )
-            volume = self.state_manager.get_volume() * gain
-            t0 = time.monotonic()
-            pcm, cached = self._get_pcm(
-                ref,
-                file,
-                pitch_filter,
-                volume,
+            if trace is not None:
+                trace.mark("resolved")
+            variant = (
                 float(speed[:-1]),
                 float(shift[:-1]),
                 reverse,
+                base_volume * gain,
             )
-            segment += pcm
-            log.info(
-                "[timing] %s %s=%.0fms pcm=%dKiB cache=%dMiB voice=%s",
-                ref,
-                "cache" if cached else "ffmpeg",
-                (time.monotonic() - t0) * 1000,
-                len(pcm) // 1024,
-                self._pcm_cache_bytes // (1024 * 1024),
-                key,
-            )
+            items.append((ref, file, variant))
+        if not items:
+            return
+
         # Replace this voice (interrupt/restart) for single web plays; append for
-        # queues / legacy events so they stay sequential.
-        self._submit_voice(key, segment, event.append)
+        # queues / legacy events so they stay sequential. Either way the voice is
+        # fed incrementally: the first clip streams in as it renders, and the
+        # rest of the chain follows, so the first audio never waits on the tail.
+        token = None
+        append = event.append
+        fed = 0
+
+        def feed(pcm, trace=None):
+            # A clip's trace goes with its first PCM: the mixer stamps (and
+            # writes) it when that's first mixed.
+            nonlocal token, append, fed
+            if not pcm:
+                return True
+            on_start = trace.started if trace is not None else None
+            token = self._submit_voice(key, pcm, append, token, on_start, stop_serial)
+            append = True
+            fed += len(pcm)
+            return token is not None  # False: replaced/stopped, stop feeding
+
+        def mark(indices, stage):
+            for i in indices:
+                if traces[i] is not None:
+                    traces[i].mark(stage)
+
+        t0 = time.monotonic()
+        first_ms = None
+        _ref, file, (speed, shift, reverse, volume) = items[0]
+        mark([0], "render_start")
+        chunks = self._render_cache.stream(
+            file, render_cache.RESAMPLE, volume, speed, shift, reverse
+        )
+        live = True
+        for chunk in chunks:
+            if first_ms is None:
+                first_ms = (time.monotonic() - t0) * 1000
+                mark([0], "render_end")
+                live = feed(chunk, traces[0])
+            else:
+                live = feed(chunk)
+            if not live:
+                chunks.close()
+                break
 
-    def _render_midi_song(self, event):
-        """Render a MIDI song into one mono PCM buffer using a clip as the
-        instrument. Returns (pcm_bytes, duration_seconds), or (None, 0.0) if
-        there's nothing to play.
+        # The rest, in order, each clip's variants batched into one decode the
+        # first time that clip comes up.
+        rendered = {}
+        for i in range(1, len(items)):
+            if not live or stop_serial != self._stop_serial:
+                live = False
+                break
+            if i not in rendered:
+                file = items[i][1]
+                batch = [j for j in range(i, len(items)) if items[j][1] == file]
+                mark(batch, "render_start")
+                results = self._get_pcms(file, [items[j][2] for j in batch])
+                mark(batch, "render_end")
+                rendered.update(zip(batch, results))
+            pcm, _cached = rendered.pop(i)
+            live = feed(pcm, traces[i])
+
+        log.info(
+            "[timing] %s first=%.0fms total=%.0fms pcm=%dKiB cache=%dMiB voice=%s%s",
+            ",".join(ref for ref, _file, _variant in items),
+            first_ms or 0,
+            (time.monotonic() - t0) * 1000,
+            fed // 1024,
+            self._render_cache.bytes_used // (1024 * 1024),
+            key,
+            "" if live else " (interrupted)",
+        )
+
+    def _render_midi_song(self, event, tag=SONG_VOICE):
+        """Render a MIDI song to mono PCM using a clip as the instrument.
+        Returns (chunks, duration_seconds), where chunks is a generator of
+        finalized PCM that mixes the song window by window as it's pulled, or
+        (None, 0.0) if there's nothing to play.
 
         Each note triggers the clip pitch-shifted to that note's pitch (relative
         to the song's median, so shifts stay small), laid onto a silent canvas at
-        its onset and capped to its duration. Overlapping notes (chords) mix via
-        audioop.add. `max_seconds` (0 = full) caps the output length.
+        its onset and capped to its duration. Overlapping notes (chords) are
+        summed by pmb_core's mixdown. `max_seconds` (0 = full) caps the output
+        length.
+
+        The parse (on a cache miss) and the clip renders run in pmb_core's
+        render executor, off this process's GIL, under `tag` (SONG_VOICE, or
+        SONG_NEXT_TAG for a pre-render) so skip/stop can cancel them; a
+        cancelled render returns (None, 0.0).
+
+        Finished renders go in pmb_core's song render cache (at unit volume),
+        so a replay with the same song, clip and settings skips all of the
+        above and starts straight from disk.
         """
         song_path = "audio/music/{0}".format(event.song_file)
         file = self.state_manager.find_audio_clip(event.clip_ref)
-        try:
-            notes, _duration = parse_midi(song_path)
-        except Exception:
-            log.exception("song: failed to parse %s", song_path)
-            return None, 0.0
-        if not notes:
-            log.warning("song: %s has no notes", song_path)
-            return None, 0.0
-
         sr = self.SAMPLE_RATE
-        bpf = 2  # mono 16-bit
         speed = max(0.25, min(4.0, float(event.speed or 1.0)))
         transpose = int(event.transpose or 0)
-        root = int(statistics.median(n.pitch for n in notes))
-        limit_bytes = int(max(0.0, event.max_seconds or 0.0) * sr) * bpf  # 0 = no limit
+        limit = int(max(0.0, event.max_seconds or 0.0) * sr)  # frames; 0 = no limit
         max_shift = self.SONG_MAX_SEMITONE_SHIFT
-
-        def shift_for(note):
-            return max(-max_shift, min(max_shift, note.pitch - root + transpose))
-
-        # Render each distinct pitch-shift once (reuses the PCM cache).
-        shift_pcm = {}
-        for n in notes:
-            if limit_bytes and int((n.start / speed) * sr) * bpf >= limit_bytes:
-                continue
-            shift = shift_for(n)
-            if shift not in shift_pcm:
-                pcm, _hit = self._get_pcm(
-                    event.clip_ref, file, self.RESAMPLE_FILTER, 1.0, 1.0, shift
-                )
-                shift_pcm[shift] = pcm
-
-        min_note_bytes = int(self.SONG_MIN_NOTE_SECONDS * sr) * bpf
-        placements = []
-        max_end = 0
-        for n in notes:
-            offset = int((n.start / speed) * sr) * bpf
-            if limit_bytes and offset >= limit_bytes:
-                continue
-            pcm = shift_pcm.get(shift_for(n)) or b""
-            if not pcm:
-                continue
-            cap = max(min_note_bytes, int((n.duration / speed) * sr) * bpf)
-            seg = pcm[:cap]
-            if limit_bytes:
-                seg = seg[: limit_bytes - offset]  # don't ring past the cap
-            if not seg:
-                continue
-            placements.append((offset, seg))
-            max_end = max(max_end, offset + len(seg))
-
-        if max_end == 0:
-            return None, 0.0
-
-        canvas = bytearray(max_end)
-        for i, (offset, seg) in enumerate(placements):
-            region = bytes(canvas[offset : offset + len(seg)])
-            if len(region) < len(seg):
-                seg = seg[: len(region)]
-            if not seg:
-                continue
-            mixed = audioop.add(region, seg, 2)
-            canvas[offset : offset + len(mixed)] = mixed
-            # audioop holds the GIL; yield every few notes so the mixer thread
-            # (5ms/tick) isn't starved during a long render → no stutter.
-            if i % 8 == 7:
-                time.sleep(0.001)
+        min_note_frames = int(self.SONG_MIN_NOTE_SECONDS * sr)
+        window = int(self.SONG_WINDOW_SECONDS * sr)
 
         gain_db = (self.state_manager.get_clip_gain_db(event.clip_ref) or 0) + (
             event.gain or 0
@@ -381,58 +431,92 @@ class PlaybackManager(EventManager):
         volume = self.state_manager.get_volume() * transform.gain_db_to_multiplier(
             gain_db
         )
+        songs = song_render_cache.for_audio_dir(self.state_manager.audio_clips_dir)
+        song_key = song_render_cache.key(
+            song_path,
+            [file],
+            render_cache.PITCH,  # how the note ladder below is rendered
+            1,
+            {
+                "speed": speed,
+                "transpose": transpose,
+                "limit": limit,
+                "max_shift": max_shift,
+                "min_note_frames": min_note_frames,
+            },
+        )
+        chunks, size = song_render_cache.play(songs, song_key, volume, window * 2)
+        if chunks is not None:
+            log.info(
+                "[song] %s on %s: cached render (%d hits / %d misses)",
+                event.song_file,
+                event.clip_ref,
+                songs.hits,
+                songs.misses,
+            )
+            return chunks, size / 2 / sr
+
+        pool = executor.get()
+        try:
+            parsed = song_cache.load(song_path)
+            if parsed is None:
+                pool.submit(song_cache.warm, song_path, tag=tag).result()
+                parsed = song_cache.parse(song_path)
+            notes = parsed.notes
+        except executor.CancelledError:
+            return None, 0.0
+        except Exception:
+            log.exception("song: failed to parse %s", song_path)
+            return None, 0.0
+        if not len(notes):
+            log.warning("song: %s has no notes", song_path)
+            return None, 0.0
+
+        root = notes.median_pitch()
+
+        # Per-note frame offsets, caps and shifts, worked out column-wise.
+        offsets = (notes.start / speed * sr).astype(np.int64)
+        caps = np.maximum(
+            min_note_frames, (notes.duration / speed * sr).astype(np.int64)
+        )
+        shifts = np.clip(notes.pitch - root + transpose, -max_shift, max_shift)
+        if limit:
+            keep = offsets < limit
+            offsets, caps, shifts = offsets[keep], caps[keep], shifts[keep]
+
+        # Render each distinct pitch-shift once, all from a single decode. Notes
+        # are capped to their own length, so the clip is pitched like a sampler
+        # (a plain resample) rather than time-stretched back to its length.
+        distinct, shift_ids = np.unique(shifts, return_inverse=True)
+        try:
+            shift_pcm = pool.submit(
+                render_cache.render_variants,
+                self.state_manager.audio_clips_dir,
+                file,
+                render_cache.PITCH,
+                [(1.0, shift, False, 1.0) for shift in distinct.tolist()],
+                tag=tag,
+            ).result()
+        except executor.CancelledError:
+            return None, 0.0
+        mix = mixdown.Mixdown(shift_pcm, shift_ids, offsets, caps, limit=limit)
+        if not mix.frames:
+            return None, 0.0
+
         log.info(
             "[song] %s on %s: %d notes, %d shifts, %.1fs",
             event.song_file,
             event.clip_ref,
             len(notes),
             len(shift_pcm),
-            len(canvas) / (sr * bpf),
-        )
-        pcm = self._finalize_song_pcm(bytes(canvas), volume)
-        duration = len(pcm) / (sr * bpf)
-        return pcm, duration
-
-    def _finalize_song_pcm(self, pcm, volume):
-        """Loudness-normalise the assembled mono canvas, apply the overall
-        volume, and fade the last 30ms out (clean end, no click when the cap
-        truncates a sound). Falls back to a plain volume scale if ffmpeg fails."""
-        sr = self.SAMPLE_RATE
-        dur = len(pcm) / (sr * 2)
-        fade = min(0.03, dur)
-        audio_filter = "{0},volume={1},afade=t=out:st={2:.3f}:d={3:.3f}".format(
-            self.SONG_LOUDNORM, volume, max(0.0, dur - fade), fade
+            mix.frames / sr,
         )
-        cmd = [
-            "ffmpeg",
-            "-hide_banner",
-            "-loglevel",
-            "error",
-            "-f",
-            "s16le",
-            "-ar",
-            str(sr),
-            "-ac",
-            "1",
-            "-i",
-            "pipe:0",
-            "-af",
-            audio_filter,
-            "-f",
-            "s16le",
-            "-ar",
-            str(sr),
-            "-ac",
-            "1",
-            "pipe:1",
-        ]
-        proc = sp.run(cmd, input=pcm, stdout=sp.PIPE, stderr=sp.PIPE)
-        if proc.returncode == 0 and proc.stdout:
-            return proc.stdout
-        log.warning(
-            "song: finalize failed (%s), using raw mix", proc.stderr.decode()[:200]
+        # Finalized at unit volume so the cached copy serves any volume.
+        chunks = loudness.finalize_stream(mix.windows(window), mix.frames, 1.0)
+        return (
+            song_render_cache.record(songs, song_key, chunks, volume),
+            mix.frames / sr,
         )
-        return audioop.mul(pcm, 2, volume)
 
     # -- song queue (now-playing + upcoming + skip) ------------------------
 
@@ -441,14 +525,124 @@ class PlaybackManager(EventManager):
         with self._song_lock:
             self._song_pending.append(event)
         self._publish_song_state()
+        self._prerender_next_song()
 
     def skip_song(self):
         """Skip the song currently playing — the worker advances to the next."""
         self._skip_flag.set()
+        executor.get().cancel(self.SONG_VOICE)  # a render still in progress
+
+    def _prerender_next_song(self):
+        """While a song plays, pre-render the head of the queue up to its first
+        window in the background (dropping a pre-render of anything that's no
+        longer the head), so at most one upcoming song is held in memory."""
+        with self._song_lock:
+            head = self._song_pending[0] if self._song_pending else None
+            slot = self._song_next
+            if slot is not None and slot["event"] is head:
+                return
+            stale, slot = slot, None
+            if head is not None and self._song_current is not None:
+                slot = {
+                    "event": head,
+                    "done": threading.Event(),
+                    "chunks": None,
+                    "duration": 0.0,
+                    "first": b"",
+                    "discarded": False,
+                }
+            self._song_next = slot
+        if stale is not None:
+            self._discard_prerender(stale)
+        if slot is not None:
+            threading.Thread(
+                target=self._prerender_song,
+                args=(slot,),
+                name="pmb-song-prerender",
+                daemon=True,
+            ).start()
+
+    def _prerender_song(self, slot):
+        t0 = time.monotonic()
+        chunks, duration, first = None, 0.0, b""
+        try:
+            chunks, duration = self._render_midi_song(
+                slot["event"], tag=self.SONG_NEXT_TAG
+            )
+            if chunks is not None:
+                first = next(chunks, b"")
+        except Exception:
+            log.exception("song: pre-render failed")
+        with self._song_lock:
+            keep = not slot["discarded"]
+            if keep:
+                slot.update(chunks=chunks, duration=duration, first=first)
+        if not keep and chunks is not None:
+            chunks.close()
+        slot["done"].set()
+        log.info(
+            "[timing] song pre-rendered %s: %.0fms%s",
+            slot["event"].song_name,
+            (time.monotonic() - t0) * 1000,
+            "" if keep else " (discarded)",
+        )
+
+    def _discard_prerender(self, slot):
+        with self._song_lock:
+            slot["discarded"] = True
+            chunks, slot["chunks"] = slot["chunks"], None
+        executor.get().cancel(self.SONG_NEXT_TAG)
+        if chunks is not None:
+            chunks.close()
+
+    def _take_prerender(self, event):
+        """The pre-render of `event` as (chunks, duration, first), waiting for
+        it if it's still running; None if it wasn't pre-rendered. A skip while
+        waiting discards it and returns (None, 0.0, b"")."""
+        with self._song_lock:
+            slot, self._song_next = self._song_next, None
+        if slot is None:
+            return None
+        if slot["event"] is not event:
+            self._discard_prerender(slot)
+            return None
+        while not slot["done"].wait(0.05):
+            if self._skip_flag.is_set():
+                self._discard_prerender(slot)
+                return None, 0.0, b""
+        with self._song_lock:
+            chunks, slot["chunks"] = slot["chunks"], None
+        return chunks, slot["duration"], slot["first"]
+
+    def _next_song_ready(self):
+        """Whether the head of the queue has been pre-rendered."""
+        with self._song_lock:
+            slot = self._song_next
+            head = self._song_pending[0] if self._song_pending else None
+        return (
+            slot is not None
+            and slot["event"] is head
+            and slot["done"].is_set()
+            and slot["chunks"] is not None
+        )
+
+    @staticmethod
+    def _chain_first(first, chunks):
+        """`chunks`, preceded by `first` (a window pulled ahead of time) if any."""
+        if first:
+            yield first
+        yield from chunks
 
     def _drop_voice(self, key):
         with self._mix_lock:
             self._voices.pop(key, None)
+            self._voice_owner.pop(key, None)
+
+    def _voice_remaining(self, key):
+        """Bytes voice `key` has left to play (0 once it has finished)."""
+        with self._mix_lock:
+            v = self._voices.get(key)
+            return v.remaining if v is not None else 0
 
     def _publish_song_state(self):
         """Mirror current + upcoming queue to the `song_state` singleton so the
@@ -480,28 +674,45 @@ class PlaybackManager(EventManager):
             return False
 
     def _song_worker_loop(self):
-        """Drain the song queue one at a time so songs never overlap."""
+        """Drain the song queue one at a time so songs never overlap. A song
+        that ends with the next one pre-rendered hands over its voice token, so
+        the next song's audio follows its tail directly."""
+        token = None
         while True:
             try:
                 with self._song_lock:
                     event = self._song_pending.pop(0) if self._song_pending else None
                 if event is None:
+                    token = None
                     # Clear any stale now-playing left by a previous run, once
                     # mongo is reachable, then idle.
                     if not self._song_state_clean and self._publish_song_state():
                         self._song_state_clean = True
                     time.sleep(0.05)
                     continue
-                self._play_one_song(event)
+                token, handoff = None, token
+                token = self._play_one_song(event, handoff)
             except Exception:
                 log.exception("song worker: tick failed")
                 time.sleep(0.1)
 
-    def _play_one_song(self, event):
-        """Render one song and play it to completion (or until skipped)."""
-        pcm, duration = self._render_midi_song(event)
-        if not pcm:
-            return
+    def _play_one_song(self, event, token=None):
+        """Render one song (or take its pre-render) and play it to completion
+        (or until skipped). The song voice starts on the first finalized window;
+        the rest are fed in behind it, staying a few seconds ahead of playback.
+
+        `token` is the previous song's voice token if that song handed over
+        mid-tail: this song's windows are appended behind it. Returns this
+        song's token if it does the same (the next song is ready as its tail
+        plays out), else None."""
+        t0 = time.monotonic()
+        prepared = self._take_prerender(event)
+        if prepared is not None:
+            chunks, duration, first = prepared
+        else:
+            (chunks, duration), first = self._render_midi_song(event), b""
+        if chunks is None:
+            return None
         with self._song_lock:
             self._song_current = {
                 "song_name": event.song_name,
@@ -512,24 +723,57 @@ class PlaybackManager(EventManager):
             }
         self._skip_flag.clear()
         self._publish_song_state()
-        # Own mixer voice, replacing (not appending) — the worker serialises, so
-        # there's never more than one song voice at a time.
-        self._submit_voice(self.SONG_VOICE, pcm, append=False)
+        self._prerender_next_song()
+        ahead = int(self.SONG_FEED_AHEAD_SECONDS * self.SAMPLE_RATE) * 2
+        handoff = int(self.SONG_HANDOFF_SECONDS * self.SAMPLE_RATE) * 2
+        started = False
+        handed_over = None
         try:
-            # The audio plays in real time over `duration`; wait that long (plus
-            # a little for pymumble's buffer tail) unless skipped.
-            deadline = time.monotonic() + duration + 0.2
-            while time.monotonic() < deadline:
+            for chunk in self._chain_first(first, chunks):
+                while (
+                    started
+                    and self._voice_remaining(self.SONG_VOICE) > ahead
+                    and not self._skip_flag.is_set()
+                ):
+                    time.sleep(0.05)
                 if self._skip_flag.is_set():
-                    log.info("song skipped: %s", event.song_name)
                     break
-                time.sleep(0.05)
+                if token is None:
+                    # Own mixer voice, replacing (not appending) — the worker
+                    # serialises, so there's never more than one song voice.
+                    token = self._submit_voice(self.SONG_VOICE, chunk, append=False)
+                elif self._submit_voice(self.SONG_VOICE, chunk, True, token) is None:
+                    break  # stopped (or replaced) under us
+                if not started:
+                    started = True
+                    log.info(
+                        "[timing] song first audio: %.0fms",
+                        (time.monotonic() - t0) * 1000,
+                    )
+            # Let the tail play out (plus a little for pymumble's buffer), or
+            # hand the voice to the next song just before it runs dry.
+            while not self._skip_flag.is_set():
+                remaining = self._voice_remaining(self.SONG_VOICE)
+                if not remaining:
+                    break
+                if remaining <= handoff and self._next_song_ready():
+                    handed_over = token
+                    break
+                time.sleep(0.01 if remaining <= handoff else 0.05)
+            if self._skip_flag.is_set():
+                log.info("song skipped: %s", event.song_name)
+            elif handed_over is None:
+                time.sleep(0.2)
         finally:
-            self._drop_voice(self.SONG_VOICE)  # cut it now (no-op if finished)
+            chunks.close()
+            if handed_over is None:
+                self._drop_voice(self.SONG_VOICE)  # cut it now (no-op if finished)
             self._skip_flag.clear()
             with self._song_lock:
                 self._song_current = None
-            self._publish_song_state()
+            if handed_over is None:
+                self._publish_song_state()
+        return handed_over
 
     def _play_music(self, event):
         piece = "audio/music/{0}".format(event.piece)
@@ -706,8 +950,15 @@ class PlaybackManager(EventManager):
             self._song_pending.clear()
             self._song_current = None
         self._skip_flag.set()  # break the current song's wait loop, if any
+        executor.get().cancel(self.SONG_VOICE)
+        with self._song_lock:
+            slot, self._song_next = self._song_next, None
+        if slot is not None:
+            self._discard_prerender(slot)
         with self._mix_lock:
+            self._stop_serial += 1
             self._voices.clear()
+            self._voice_owner.clear()
         try:
             self.mumble.sound_output.clear_buffer()
         except Exception:
@@ -765,7 +1016,11 @@ class TextMessageManager(EventManager):
             event.user.send_text_message(event.data)
 
         elif isinstance(event, ListMusicEvent):
-            songs = [s.split(".")[0] for s in os.listdir("audio/music")]
+            songs = [
+                s.split(".")[0]
+                for s in os.listdir("audio/music")
+                if not s.startswith(".")  # e.g. the parsed-song cache
+            ]
             songs.sort()
 
             self._set_channel_wrapper()
@@ -1026,8 +1281,6 @@ class CaptureManager(EventManager):
 
 
 class CommandManager(EventManager):
-    POLL_INTERVAL = 0.02
-
     def __init__(
         self,
         mongo_interface,
@@ -1039,33 +1292,168 @@ class CommandManager(EventManager):
         self.playback_manager = playback_manager
         self.text_message_manager = text_message_manager
         self.capture_manager = capture_manager
-        self._last_poll = 0
+        # Says when there's a command to claim (pushed by the web, or an idle
+        # poll backing off when push isn't available); opened on the first loop,
+        # once Mongo is connected.
+        self._feed = None
+        # Commands the web sends straight to the bot (see pmb_core.db.channel)
+        # run as they arrive, on a worker the channel's thread hands them to (so
+        # it's free to read the next datagram, a stop say); their copies claimed
+        # from Mongo are then dropped by id. The lock keeps the paths in order.
+        self._channel = None
+        self._direct = queue.Queue()
+        self._seen = channel.Seen()
+        self._run_lock = threading.Lock()
+        # Control commands (stop, skip, restart, leave) have a lane of their
+        # own: claimed by a thread on a second feed, and run on arrival from the
+        # channel, so they never wait behind a batch of plays. A stop drops the
+        # plays queued before it (``_stopped_at``) that a batch has yet to run.
+        self._control_feed = None
+        self._control_lock = threading.Lock()
+        self._stopped_at = None
+        # Ids of queued commands already handed to the prerender thread.
+        self._prerendered = set()
 
     def loop(self):
-        now = time.time()
-        if now - self._last_poll < self.POLL_INTERVAL:
+        if self._feed is None:
+            self._feed = self.mongo_interface.command_feed()
+            threading.Thread(
+                target=self._direct_loop, name="pmb-direct", daemon=True
+            ).start()
+            self._channel = self.mongo_interface.command_channel(
+                "mumble", AUDIO_DIR, self._run_direct
+            )
+            self._control_feed = self.mongo_interface.command_feed()
+            threading.Thread(
+                target=self._control_loop, name="pmb-control", daemon=True
+            ).start()
+        if not self._feed.due():
             return
-        self._last_poll = now
 
-        command = self.mongo_interface.get_next_pending_command()
-        if command is None:
+        commands = self.mongo_interface.claim_pending_commands(lane=NORMAL)
+        claimed_at = time.time()
+        self._feed.claimed(bool(commands))
+        if not commands:
             return
 
-        self.mongo_interface.mark_command_done(command["_id"])
-        cmd_type = command.get("type", "play")
+        # Acknowledged before any of the batch runs, as single commands were:
+        # a restart exits mid-batch and mustn't be handed back to the new bot.
+        self.mongo_interface.ack_commands(commands)
+        with self._run_lock:
+            self._run(self._seen.fresh(commands), "mongo", claimed_at)
 
+    def _control_loop(self):
+        while True:
+            self._control_feed.wait()
+            self._claim_control()
+
+    def _claim_control(self):
+        # Nothing may escape: the main loop doesn't claim this lane, so if the
+        # thread died no stop would be claimed from Mongo again. An unacked
+        # batch is claimed again once its lease runs out.
+        try:
+            commands = self.mongo_interface.claim_pending_commands(lane=CONTROL)
+        except Exception:
+            log.exception("claiming control commands failed")
+            commands = []
+        claimed_at = time.time()
+        self._control_feed.claimed(bool(commands))
+        if not commands:
+            return
+        try:
+            self.mongo_interface.ack_commands(commands)
+            self._run_control(commands, "mongo", claimed_at)
+        except Exception:
+            log.exception("running control commands failed")
+
+    def _run_direct(self, commands):
+        # On the channel's thread: control commands run here and now, the rest
+        # go to the direct worker.
+        claimed_at = time.time()
+        control = [c for c in commands if is_control(c)]
+        if control:
+            self._run_control(control, "direct", claimed_at)
+        commands = [c for c in commands if not is_control(c)]
+        if commands:
+            self._direct.put((commands, claimed_at))
+
+    def _direct_loop(self):
+        while True:
+            commands, claimed_at = self._direct.get()
+            try:
+                with self._run_lock:
+                    commands = self._seen.fresh(commands)
+                    if commands:
+                        # Done before it runs, like a claimed batch's ack.
+                        self.mongo_interface.mark_commands_done(commands)
+                        self._run(commands, "direct", claimed_at)
+            except Exception:
+                log.exception("running direct commands failed")
+            finally:
+                self._direct.task_done()
+
+    def _run_control(self, commands, via, claimed_at):
+        # Not under _run_lock: a stop lands while a batch is still playing.
+        with self._control_lock:
+            commands = self._seen.fresh(commands)
+            if not commands:
+                return
+            if via == "direct":
+                self.mongo_interface.mark_commands_done(commands)
+            self._run(commands, via, claimed_at)
+
+    def _run(self, commands, via, claimed_at):
+        # Each command's latency trace (pmb_core.db.latency) is written once
+        # it's handled, or for a clip play by the mixer once it's audible.
+        writer = self.mongo_interface.latency_log()
+        # A generated queue arrives as a run of queue_play commands; each run
+        # is played as one chain (see _play_queued), in its place in the batch.
+        queued = []
+        for command in commands:
+            self._log_pickup(command)
+            trace = latency.Trace(command, "mumble", writer, via)
+            trace.mark("claimed", claimed_at)
+            if command.get("type") == "queue_play":
+                queued.append((command, trace))
+                continue
+            self._play_queued(queued)
+            queued = []
+            if self._superseded(command):
+                continue
+            self._handle(command, trace)
+            if trace.type not in latency.CLIP_PLAYS:
+                trace.finish()
+        self._play_queued(queued)
+
+    def _superseded(self, command):
+        # Queued before a stop that has already run (on the control lane, say,
+        # while this batch was playing): the stop cancelled it.
+        if superseded(command, self._stopped_at):
+            log.info("dropped %s queued before a stop", command.get("type", "play"))
+            return True
+        return False
+
+    def _log_pickup(self, command):
         # How long the command sat between the web enqueuing it and the bot
-        # picking it up (bounded below by the 0.1s poll interval).
+        # picking it up.
         created = command.get("created_at")
         if isinstance(created, dt.datetime):
             waited = (dt.datetime.utcnow() - created).total_seconds() * 1000
             log.info(
                 "[timing] picked up %s %s after %.0fms in queue",
-                cmd_type,
+                command.get("type", "play"),
                 command.get("clip_ref", ""),
                 waited,
             )
 
+    def _handle(self, command, trace=None):
+        cmd_type = command.get("type", "play")
+
+        if cmd_type in STOPPING_TYPES and command.get("created_at") is not None:
+            self._stopped_at = max(
+                self._stopped_at or command["created_at"], command["created_at"]
+            )
+
         if cmd_type == "announce":
             self.text_message_manager.process(ChannelTextEvent(command["message"]))
             return
@@ -1149,24 +1537,67 @@ class CommandManager(EventManager):
             msg = f"<b>{command['requested_by']}</b> played: {cmd_str}"
             self.text_message_manager.process(ChannelTextEvent(msg))
 
-        if cmd_type == "queue_play":
-            # Queues stay sequential on a shared voice (can overlap live presses).
-            voice_key, append = "__queue__", True
-        else:
-            # Single plays key by requester: spamming interrupts your own clip,
-            # while different people overlap.
-            voice_key, append = (command.get("requested_by") or "web"), False
-
+        # Single plays key by requester: spamming interrupts your own clip,
+        # while different people overlap.
         event = AudioEvent(
             [command["clip_ref"]],
             [f"{speed}x"],
             [f"{pitch}s"],
-            voice_key=voice_key,
-            append=append,
+            voice_key=command.get("requested_by") or "web",
+            append=False,
             reverses=[reverse],
+            traces=[trace],
         )
         self.playback_manager.process(event)
 
+    def _play_queued(self, queued):
+        """Queue items claimed together, (command, trace) pairs, as one chain
+        appended to the shared queue voice (sequential, can overlap live
+        presses): the first streams in as it renders and the rest follow with
+        one decode per clip."""
+        queued = [(c, trace) for c, trace in queued if not self._superseded(c)]
+        if not queued:
+            return
+        commands = [command for command, _trace in queued]
+        self._prerender_queue()
+        event = AudioEvent(
+            [c["clip_ref"] for c in commands],
+            [f"{c.get('speed', 1.0)}x" for c in commands],
+            [f"{c.get('pitch', 0)}s" for c in commands],
+            voice_key="__queue__",
+            append=True,
+            reverses=[bool(c.get("reverse", False)) for c in commands],
+            traces=[trace for _command, trace in queued],
+        )
+        self.playback_manager.process(event)
+
+    def _prerender_queue(self):
+        """A queue longer than a claim batch is still partly pending when its
+        first items play. Render that rest in the background (one decode per
+        clip) so each later item is a cache hit as it comes up."""
+        pending = self.mongo_interface.get_pending_commands("queue_play")
+        # Forget ids that have since been played or cancelled.
+        self._prerendered &= {c["_id"] for c in pending}
+        upcoming = [c for c in pending if c["_id"] not in self._prerendered]
+        if not upcoming:
+            return
+        self._prerendered.update(c["_id"] for c in upcoming)
+        items = [
+            (
+                c["clip_ref"],
+                float(c.get("speed", 1.0)),
+                float(c.get("pitch", 0)),
+                bool(c.get("reverse", False)),
+            )
+            for c in upcoming
+        ]
+        threading.Thread(
+            target=self.playback_manager.prerender,
+            args=(items,),
+            name="pmb-prerender",
+            daemon=True,
+        ).start()
+
 
 class StateManager(EventManager):
     def __init__(self, mongo_interface, audio_clips_dir=Path("audio/")):
@@ -0,0 +1,189 @@
+"""Software mixer voices for the PlaybackManager.
+
+pymumble has one sequential output stream, so overlapping clips are mixed here.
+A voice is a queue of s16le buffers read through a cursor: feeding it more PCM
+appends a buffer (nothing already queued is copied), and mixing reads straight
+out of the queued buffers through NumPy views. Each tick mixes a whole block of
+frames at once, summing every active voice into one int32 accumulator and
+saturating back to s16le once, so the per-voice cost is one vectorised add per
+tick rather than a slice, a pad and an ``audioop.add`` per frame.
+
+The mixer thread runs on a ``MixerClock``: ticks are scheduled against
+deadlines rather than a fixed sleep, lateness is measured on every tick, and
+the amount kept buffered in pymumble adapts to it, from a low-latency floor up
+to a safe ceiling (and back down once the host is quiet again). Underruns, late
+ticks and frames mixed are counted for ``stats()``.
+"""
+
+import time
+from collections import deque
+
+import numpy as np
+
+TICK_SECONDS = 0.005
+# Buffered-ahead target: never below the floor (interrupts stay snappy), never
+# above the ceiling (a late-arriving clip still starts promptly).
+TARGET_FLOOR_SECONDS = 0.04
+TARGET_CEILING_SECONDS = 0.2
+# How long a burst of lateness keeps the target raised (half-life of the
+# remembered peak), so one bad second doesn't cost latency for the rest of the day.
+PEAK_HALF_LIFE_SECONDS = 10.0
+# While the mix is playing, its counters are logged this often, so the late
+# ticks and the adapted target show up on a healthy host too, not only when a
+# stutter logs them.
+STATS_LOG_SECONDS = 60.0
+
+
+class Voice:
+    """One voice's queued PCM. ``remaining`` is how many bytes are left to play."""
+
+    __slots__ = ("_buffers", "_pos", "remaining", "_starts", "_queued", "_mixed")
+
+    def __init__(self, pcm=b"", on_start=None):
+        self._buffers = deque()  # int16 views of the queued buffers
+        self._pos = 0  # sample offset into the head buffer
+        self.remaining = 0
+        self._starts = deque()  # (sample offset, callback), see append
+        self._queued = 0  # samples ever queued
+        self._mixed = 0  # samples ever mixed
+        self.append(pcm, on_start)
+
+    def append(self, pcm, on_start=None):
+        """Queue ``pcm`` behind whatever hasn't played yet (O(1): the buffer is
+        viewed, not copied). ``on_start`` is called, on the mixer thread, once
+        the first of it has been mixed."""
+        samples = np.frombuffer(pcm, dtype="<i2", count=len(pcm) // 2)
+        if len(samples):
+            if on_start is not None:
+                self._starts.append((self._queued, on_start))
+            self._buffers.append(samples)
+            self.remaining += samples.nbytes
+            self._queued += len(samples)
+
+    def mix_into(self, acc):
+        """Add this voice's next ``len(acc)`` samples into the int32 ``acc``,
+        consuming them. Returns how many samples it had (fewer at its end)."""
+        filled = 0
+        while filled < len(acc) and self._buffers:
+            head = self._buffers[0]
+            take = min(len(acc) - filled, len(head) - self._pos)
+            acc[filled : filled + take] += head[self._pos : self._pos + take]
+            filled += take
+            self._pos += take
+            if self._pos == len(head):
+                self._buffers.popleft()
+                self._pos = 0
+        self.remaining -= filled * 2
+        self._mixed += filled
+        while self._starts and self._starts[0][0] < self._mixed:
+            self._starts.popleft()[1]()
+        return filled
+
+
+def mix(voices, nbytes, frame_bytes):
+    """Mix the next ``nbytes`` of every voice in the ``voices`` dict, removing
+    the ones that run out. Returns the mixed s16le PCM, trimmed to the last
+    whole frame anything played in (a voice's final partial frame is padded
+    with silence), or None if no voice had anything left."""
+    acc = np.zeros(nbytes // 2, dtype=np.int32)
+    played = 0
+    finished = []
+    for key, voice in voices.items():
+        played = max(played, voice.mix_into(acc))
+        if not voice.remaining:
+            finished.append(key)
+    for key in finished:
+        del voices[key]
+    if not played:
+        return None
+    frame_samples = frame_bytes // 2
+    played = -(-played // frame_samples) * frame_samples
+    return np.clip(acc[:played], -32768, 32767).astype("<i2").tobytes()
+
+
+class MixerClock:
+    """Deadline scheduler and adaptive buffer target for the mixer thread.
+
+    ``wait`` sleeps until the next tick is due and measures how late it woke.
+    The buffer has to cover the longest gap between two top-ups, so the target
+    follows the recent peak lateness (decaying with ``PEAK_HALF_LIFE_SECONDS``):
+    ``target = tick + 2 x peak``, clamped to [floor, ceiling]. An underrun (the
+    buffer ran dry mid-stream) counts as lateness as long as the whole target,
+    which pushes the target up straight away.
+    """
+
+    def __init__(
+        self,
+        tick=TICK_SECONDS,
+        floor=TARGET_FLOOR_SECONDS,
+        ceiling=TARGET_CEILING_SECONDS,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.tick = tick
+        self.floor = floor
+        self.ceiling = ceiling
+        self.target = floor
+        self._clock = clock
+        self._sleep = sleep
+        self._decay = 0.5 ** (tick / PEAK_HALF_LIFE_SECONDS)
+        self._deadline = None
+        self._peak = 0.0
+        self.ticks = 0
+        self.late_ticks = 0
+        self.underruns = 0
+        self.frames_mixed = 0
+        self.max_late = 0.0
+        self._stats_due = None
+
+    def wait(self):
+        """Sleep until the next tick's deadline; returns how late it woke (s)."""
+        now = self._clock()
+        if self._deadline is None:
+            self._deadline = now
+        if self._deadline > now:
+            self._sleep(self._deadline - now)
+            now = self._clock()
+        late = max(0.0, now - self._deadline)
+        self.ticks += 1
+        if late > self.tick:
+            self.late_ticks += 1
+            # Fell a whole tick behind: resync rather than firing a burst of
+            # catch-up ticks.
+            self._deadline = now + self.tick
+        else:
+            self._deadline += self.tick
+        self.max_late = max(self.max_late, late)
+        self._observe(late)
+        return late
+
+    def underrun(self):
+        self.underruns += 1
+        self._observe(self.target)
+
+    def mixed(self, frames):
+        self.frames_mixed += frames
+
+    def _observe(self, late):
+        self._peak = max(late, self._peak * self._decay)
+        self.target = min(self.ceiling, max(self.floor, self.tick + 2 * self._peak))
+
+    def stats_due(self, every=STATS_LOG_SECONDS):
+        """True once every ``every`` seconds of calls; the first call starts
+        the period."""
+        now = self._clock()
+        if self._stats_due is not None and now < self._stats_due:
+            return False
+        due = self._stats_due is not None
+        self._stats_due = now + every
+        return due
+
+    def stats(self):
+        return {
+            "ticks": self.ticks,
+            "late_ticks": self.late_ticks,
+            "underruns": self.underruns,
+            "frames_mixed": self.frames_mixed,
+            "target_ms": round(self.target * 1000, 1),
+            "max_late_ms": round(self.max_late * 1000, 1),
+        }
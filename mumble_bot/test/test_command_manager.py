@@ -0,0 +1,223 @@
+"""Tests for CommandManager — turning claimed pending_commands into events.
+
+Commands are claimed from Mongo in leased batches; a batch is acknowledged
+before any of it runs, and a generated queue (a run of queue_play commands) is
+played as one chain. Commands the web sends directly run as they arrive, and
+their claimed copies are dropped. Control commands skip the queue, and a stop
+drops the plays queued before it. The Mongo and playback sides are faked, so
+this runs without a database or a Mumble server.
+"""
+
+import threading
+from datetime import datetime
+
+from pmb_core.db.commands import NORMAL
+
+from python_mumble_bot.bot.event import AudioEvent, ChannelTextEvent
+from python_mumble_bot.bot.manager import CommandManager
+
+
+class FakeFeed:
+    def __init__(self):
+        self.claims = []
+
+    def due(self):
+        return True
+
+    def wait(self):
+        threading.Event().wait()  # the control lane's thread: nothing comes
+
+    def claimed(self, found):
+        self.claims.append(found)
+
+
+class FakeMongo:
+    def __init__(self, batches):
+        self.batches = list(batches)
+        self.log = []
+        self.lanes = []
+        self.latency = None
+
+    def command_feed(self):
+        return FakeFeed()
+
+    def command_channel(self, name, audio_dir, handle):
+        self.direct = handle
+
+    def latency_log(self):
+        return self.latency
+
+    def claim_pending_commands(self, lane=None):
+        self.lanes.append(lane)
+        self.log.append("claim")
+        return self.batches.pop(0) if self.batches else []
+
+    def ack_commands(self, commands):
+        self.log.append(("ack", [c["_id"] for c in commands]))
+
+    def mark_commands_done(self, commands):
+        self.log.append(("done", [c["_id"] for c in commands]))
+
+    def get_pending_commands(self, cmd_type):
+        return []
+
+
+class Recorder:
+    def __init__(self, log):
+        self.log = log
+
+    def process(self, event):
+        self.log.append(event)
+
+    def stop(self):
+        self.log.append("stop")
+
+
+def _queue_play(i, ref):
+    return {"_id": i, "type": "queue_play", "clip_ref": ref, "speed": 1.5, "pitch": i}
+
+
+def test_a_batch_is_acked_first_and_a_queue_run_plays_as_one_chain():
+    batch = [
+        {"_id": 0, "type": "announce", "message": "queued: a b"},
+        _queue_play(1, "a"),
+        _queue_play(2, "b"),
+        {"_id": 3, "type": "stop"},
+        _queue_play(4, "c"),
+    ]
+    mongo = FakeMongo([batch])
+    log = mongo.log
+    manager = CommandManager(mongo, Recorder(log), Recorder(log))
+
+    manager.loop()
+
+    assert log[:2] == ["claim", ("ack", [0, 1, 2, 3, 4])]
+    announce, chain, stop, tail = log[2:]
+    assert isinstance(announce, ChannelTextEvent)
+    assert isinstance(chain, AudioEvent)
+    assert chain.data == ["a", "b"] and chain.semitone_shifts == ["1s", "2s"]
+    assert chain.voice_key == "__queue__" and chain.append
+    assert stop == "stop"  # played in its place: after a and b, before c
+    assert tail.data == ["c"]
+    assert manager._feed.claims == [True]
+    assert mongo.lanes == [NORMAL]  # control commands have a lane of their own
+
+
+def test_an_empty_claim_only_reports_the_miss():
+    mongo = FakeMongo([])
+    manager = CommandManager(mongo, Recorder(mongo.log), Recorder(mongo.log))
+    manager.loop()
+    assert mongo.log == ["claim"]
+    assert manager._feed.claims == [False]
+
+
+def test_a_direct_command_runs_on_arrival_and_its_claimed_copy_is_dropped():
+    play = {"_id": 7, "type": "play", "clip_ref": "a", "requested_by": "jake"}
+    stop = {"_id": 8, "type": "stop"}
+    mongo = FakeMongo([[], [dict(play), dict(stop)]])
+    log = mongo.log
+    manager = CommandManager(mongo, Recorder(log), Recorder(log))
+    manager.loop()  # opens the channel
+    del log[:]
+
+    mongo.direct([dict(play)])
+    manager._direct.join()  # handed to the direct worker
+    assert log[0] == ("done", [7])  # before it runs, like a batch's ack
+    assert isinstance(log[-1], AudioEvent) and log[-1].data == ["a"]
+    del log[:]
+
+    manager.loop()  # the Mongo copy of the play is acked but not run again
+    assert log == ["claim", ("ack", [7, 8]), "stop"]
+
+    mongo.direct([dict(stop)])  # nor is a late direct copy
+    assert log == ["claim", ("ack", [7, 8]), "stop"]
+
+
+class FakeWriter:
+    def __init__(self):
+        self.docs = []
+
+    def write(self, doc):
+        self.docs.append(doc)
+
+
+def test_traces_follow_plays_to_the_mixer_and_other_commands_end_at_claim():
+    def traced(i, **command):
+        return {"_id": i, "trace": {"id": "t{0}".format(i)}, **command}
+
+    batch = [
+        traced(1, type="stop"),
+        traced(2, type="queue_play", clip_ref="a"),
+        traced(3, type="queue_play", clip_ref="b"),
+    ]
+    mongo = FakeMongo([batch])
+    mongo.latency = FakeWriter()
+    log = mongo.log
+    CommandManager(mongo, Recorder(log), Recorder(log)).loop()
+
+    (stop,) = mongo.latency.docs  # written once handled
+    assert stop["trace"] == "t1" and stop["via"] == "mongo" and "claimed" in stop
+    chain = log[-1]
+    assert [t.id for t in chain.traces] == ["t2", "t3"]
+    chain.traces[0].mark("resolved").started()  # as the playback manager does
+    assert mongo.latency.docs[-1]["trace"] == "t2"
+    assert {"claimed", "resolved", "first_frame"} <= set(mongo.latency.docs[-1])
+
+
+def test_a_direct_stop_runs_mid_batch_and_drops_the_plays_queued_before_it():
+    def play(i, second):
+        return {
+            "_id": i,
+            "type": "play",
+            "clip_ref": str(i),
+            "requested_by": "jake",
+            "created_at": datetime(2026, 1, 1, 0, 0, second),
+        }
+
+    stop = {"_id": 9, "type": "stop", "created_at": datetime(2026, 1, 1, 0, 0, 5)}
+    mongo = FakeMongo([[], [play(1, 1), play(2, 2), play(3, 6)]])
+    log = mongo.log
+    manager = CommandManager(mongo, Recorder(log), Recorder(log))
+    manager.loop()
+    del log[:]
+
+    with manager._run_lock:  # a batch of plays is still running
+        mongo.direct([dict(stop)])
+        assert log == [("done", [9]), "stop"]
+
+    manager.loop()  # the rest of the backlog: only the play after the stop
+    (played,) = [e for e in log if isinstance(e, AudioEvent)]
+    assert played.data == ["3"]
+
+
+def test_a_failing_control_command_doesnt_stop_the_control_lane():
+    class Failing(Recorder):
+        def stop(self):
+            super().stop()
+            raise RuntimeError("mumble went away")
+
+    mongo = FakeMongo([[{"_id": 1, "type": "stop"}], [{"_id": 2, "type": "stop"}]])
+    manager = CommandManager(mongo, Failing(mongo.log), Recorder(mongo.log))
+    manager._control_feed = FakeFeed()
+
+    manager._claim_control()
+    manager._claim_control()
+    assert mongo.log == ["claim", ("ack", [1]), "stop", "claim", ("ack", [2]), "stop"]
+
+
+def test_direct_plays_are_handed_off_so_the_channel_never_waits_on_a_batch():
+    play = {"_id": 7, "type": "play", "clip_ref": "a", "requested_by": "jake"}
+    mongo = FakeMongo([[]])
+    log = mongo.log
+    manager = CommandManager(mongo, Recorder(log), Recorder(log))
+    manager.loop()
+    del log[:]
+
+    with manager._run_lock:  # a long batch is running
+        mongo.direct([dict(play)])  # returns at once
+        mongo.direct([{"_id": 8, "type": "stop"}])
+        assert log == [("done", [8]), "stop"]
+
+    manager._direct.join()
+    assert log[2] == ("done", [7])
+    assert isinstance(log[-1], AudioEvent) and log[-1].data == ["a"]
@@ -0,0 +1,208 @@
+"""Tests for the PlaybackManager's software mixer voices."""
+
+import logging
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from python_mumble_bot.bot import mixer
+from python_mumble_bot.bot.manager import PlaybackManager
+
+
+def _pcm(*samples):
+    return np.array(samples, dtype="<i2").tobytes()
+
+
+def test_voice_reads_across_appended_buffers():
+    voice = mixer.Voice(_pcm(1, 2, 3))
+    voice.append(_pcm(4, 5))
+    voice.append(b"")
+    assert voice.remaining == 10
+    acc = np.zeros(4, dtype=np.int32)
+    assert voice.mix_into(acc) == 4
+    assert acc.tolist() == [1, 2, 3, 4]
+    assert voice.remaining == 2
+    acc = np.zeros(4, dtype=np.int32)
+    assert voice.mix_into(acc) == 1
+    assert acc.tolist() == [5, 0, 0, 0]
+    assert voice.remaining == 0
+
+
+def test_voice_reports_when_each_marked_buffer_is_first_mixed():
+    started = []
+    voice = mixer.Voice(_pcm(1, 2), on_start=lambda: started.append("a"))
+    voice.append(_pcm(3, 4), on_start=lambda: started.append("b"))
+    voice.append(_pcm(5, 6))
+    voice.mix_into(np.zeros(2, dtype=np.int32))
+    assert started == ["a"]
+    voice.mix_into(np.zeros(1, dtype=np.int32))
+    assert started == ["a", "b"]  # on its first sample, not its last
+    voice.mix_into(np.zeros(8, dtype=np.int32))
+    assert started == ["a", "b"]
+
+
+def test_mix_sums_voices_and_saturates_once():
+    voices = {
+        "a": mixer.Voice(_pcm(30000, -30000, 100, 7, 9)),
+        "b": mixer.Voice(_pcm(30000, -30000, -50)),
+        "c": mixer.Voice(_pcm(-30000, 30000)),
+    }
+    out = mixer.mix(voices, 8, 2)
+    # Summed in int32 before clipping: 30000+30000-30000 doesn't clip.
+    assert np.frombuffer(out, "<i2").tolist() == [30000, -30000, 50, 7]
+    assert list(voices) == ["a"]  # the finished voices were removed
+    assert mixer.mix(voices, 8, 2) == _pcm(9)
+    assert voices == {}
+    assert mixer.mix(voices, 8, 2) is None
+
+
+def test_mix_pads_the_final_partial_frame_only():
+    voices = {"a": mixer.Voice(_pcm(*range(1, 6)))}
+    out = np.frombuffer(mixer.mix(voices, 16, 8), "<i2").tolist()
+    assert out == [1, 2, 3, 4, 5, 0, 0, 0]  # two 4-sample frames, not 8 samples
+
+
+def test_mix_cost_stays_flat_as_voices_grow():
+    frame = 1920  # 20ms of 48kHz mono
+
+    def tick_seconds(count):
+        voices = {
+            i: mixer.Voice(np.full(frame * 200, 100, "<i2").tobytes())
+            for i in range(count)
+        }
+        t0 = time.perf_counter()
+        for _ in range(100):
+            mixer.mix(voices, 2 * frame, frame)
+        return time.perf_counter() - t0
+
+    tick_seconds(2)  # warm up
+    # 30 voices over a 40ms block stays well inside a 5ms mixer tick.
+    assert tick_seconds(30) / 100 < 0.005
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 100.0
+        self.lag = 0.0  # extra oversleep on the next sleep
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds + self.lag
+        self.lag = 0.0
+
+
+def _clock(t):
+    return mixer.MixerClock(
+        tick=0.005, floor=0.04, ceiling=0.2, clock=t.clock, sleep=t.sleep
+    )
+
+
+def test_clock_ticks_on_deadlines_and_stays_at_the_floor():
+    t = FakeTime()
+    clock = _clock(t)
+    start = t.now
+    for _ in range(10):
+        clock.wait()
+        t.now += 0.001  # the tick's own work doesn't push the schedule back
+    assert t.now == pytest.approx(start + 9 * 0.005 + 0.001)
+    assert clock.target == 0.04
+    assert clock.stats()["late_ticks"] == 0
+
+
+def test_clock_adapts_the_target_to_lateness_and_decays_back():
+    t = FakeTime()
+    clock = _clock(t)
+    clock.wait()
+    t.lag = 0.05  # a 50ms scheduling stall
+    clock.wait()
+    assert clock.late_ticks == 1
+    assert clock.target == pytest.approx(0.105)
+    for _ in range(int(60 / 0.005)):  # a quiet minute
+        clock.wait()
+    assert clock.target == 0.04
+    assert clock.stats()["max_late_ms"] == 50.0
+
+
+def test_underrun_raises_the_target_up_to_the_ceiling():
+    clock = _clock(FakeTime())
+    clock.underrun()
+    assert clock.target == pytest.approx(0.085)
+    for _ in range(5):
+        clock.underrun()
+    assert clock.target == 0.2
+    assert clock.stats()["underruns"] == 6
+
+
+class FakeSoundOutput:
+    channels = 1
+
+    def __init__(self):
+        self.sent = []
+        self.buffered = 0.0
+
+    def get_audio_per_packet(self):
+        return 0.02
+
+    def get_buffer_size(self):
+        return self.buffered
+
+    def add_sound(self, pcm):
+        self.sent.append(pcm)
+        self.buffered += len(pcm) / 2 / 48000
+
+
+def test_clock_says_stats_are_due_once_a_period():
+    t = FakeTime()
+    clock = _clock(t)
+    assert not clock.stats_due(every=60)  # starts the period
+    t.now += 59
+    assert not clock.stats_due(every=60)
+    t.now += 1
+    assert clock.stats_due(every=60)
+    assert not clock.stats_due(every=60)
+
+
+def test_mix_tick_tops_up_to_the_target_and_counts_underruns():
+    m = PlaybackManager.__new__(PlaybackManager)
+    m.mumble = type("Mumble", (), {"sound_output": FakeSoundOutput()})()
+    m._voices = {"k": mixer.Voice(b"\x01\x00" * 48000)}
+    m._mix_lock = threading.Lock()
+    m._mix_clock = _clock(FakeTime())
+    m._mix_playing = False
+    so = m.mumble.sound_output
+
+    m._mix_tick()
+    assert so.buffered == pytest.approx(0.04)  # two 20ms packets
+    m._mix_tick()
+    assert len(so.sent) == 1  # already at the target
+    assert m.mixer_stats()["underruns"] == 0
+
+    so.buffered = 0.0  # pymumble drained it all before we came back
+    m._mix_tick()
+    stats = m.mixer_stats()
+    assert stats["underruns"] == 1 and stats["target_ms"] == 85.0
+    assert so.buffered == pytest.approx(0.1)  # topped up to the raised target
+    assert stats["frames_mixed"] == 7
+
+
+def test_mix_tick_logs_the_mixer_stats_once_a_period(caplog):
+    t = FakeTime()
+    m = PlaybackManager.__new__(PlaybackManager)
+    m.mumble = type("Mumble", (), {"sound_output": FakeSoundOutput()})()
+    m._voices = {"k": mixer.Voice(b"\x01\x00" * 48000 * 120)}
+    m._mix_lock = threading.Lock()
+    m._mix_clock = _clock(t)
+    m._mix_playing = False
+    so = m.mumble.sound_output
+
+    with caplog.at_level(logging.INFO, logger="pmb.mumble"):
+        m._mix_tick()  # starts the period
+        t.now += mixer.STATS_LOG_SECONDS
+        so.buffered = 0.01
+        m._mix_tick()
+    reports = [r for r in caplog.records if r.getMessage().startswith("mixer: ")]
+    assert len(reports) == 1 and "'late_ticks': 0" in reports[0].getMessage()
@@ -12,6 +12,7 @@ import threading
 
 sys.path.append(os.path.relpath("./python_mumble_bot"))
 
+from python_mumble_bot.bot import mixer
 from python_mumble_bot.bot.event import MidiSongEvent
 from python_mumble_bot.bot.manager import PlaybackManager
 
@@ -46,13 +47,23 @@ def _mgr():
     m._song_current = None
     m._song_lock = threading.Lock()
     m._skip_flag = threading.Event()
+    m._song_next = None
     m._voices = {}
     m._mix_lock = threading.Lock()
+    m._voice_owner = {}
+    m._voice_serial = 0
+    m._stop_serial = 0
     m.state_manager = FakeState()
     m.mumble = FakeMumble()
     return m
 
 
+def _queued(m, key):
+    """Play out what voice `key` has queued (mixed alone, so it comes back as-is)."""
+    voices = {key: m._voices[key]}
+    return mixer.mix(voices, m._voices[key].remaining, 2)
+
+
 def _state(m):
     return m.state_manager.mongo_interface.db.song_state.doc
 
@@ -156,3 +167,132 @@ def test_publish_is_noop_when_mongo_unavailable():
 
     m.state_manager.mongo_interface.db.song_state.replace_one = boom
     assert m._publish_song_state() is False  # no crash
+
+
+def test_voice_feeds_incrementally_until_replaced():
+    # A clip chain streams into its voice chunk by chunk; once someone replaces
+    # the voice, the old chain's remaining chunks must not leak onto it.
+    m = _mgr()
+    token = m._submit_voice("k", b"\x01\x00", append=False)
+    assert m._submit_voice("k", b"\x02\x00", append=True, token=token) == token
+    assert _queued(m, "k") == b"\x01\x00\x02\x00"
+
+    m._submit_voice("k", b"\x09\x00", append=False)
+    assert m._submit_voice("k", b"\x03\x00", append=True, token=token) is None
+    assert _queued(m, "k") == b"\x09\x00"
+
+
+def test_stop_and_drop_invalidate_voice_feeders():
+    m = _mgr()
+    song = m._submit_voice(m.SONG_VOICE, b"\x01\x00", append=False)
+    chain = m._submit_voice("k", b"\x01\x00", append=False)
+    m._drop_voice(m.SONG_VOICE)
+    assert m._submit_voice(m.SONG_VOICE, b"\x02\x00", True, token=song) is None
+    m.stop()
+    assert m._submit_voice("k", b"\x02\x00", True, token=chain) is None
+    assert m._voices == {}
+
+
+def test_a_stop_discards_a_clip_whose_render_started_before_it():
+    m = _mgr()
+    started = m._stop_serial
+    m.stop()  # lands while the clip's first chunk is still rendering
+    assert m._submit_voice("k", b"\x01\x00", False, stop_serial=started) is None
+    assert m._voices == {}
+    assert m._submit_voice("k", b"\x01\x00", False, stop_serial=m._stop_serial)
+
+
+def test_song_plays_from_first_window_and_skip_stops_rendering():
+    # The song voice starts on the first finalized window, later windows are
+    # appended behind it, and a skip stops pulling (and rendering) the rest.
+    m = _mgr()
+    pulled = []
+
+    def chunks():
+        for i in range(1, 100):
+            pulled.append(i)
+            if i == 3:
+                # By now the voice holds the first windows, in order.
+                assert _queued(m, m.SONG_VOICE) == b"\x01\x00\x02\x00"
+                m.skip_song()
+            yield bytes([i, 0])
+
+    gen = chunks()
+    m._render_midi_song = lambda event: (gen, 99 / 48000)
+    m._play_one_song(_event())
+
+    assert pulled == [1, 2, 3]
+    assert gen.gi_frame is None  # closed
+    assert m.SONG_VOICE not in m._voices
+    assert _state(m)["current"] is None
+
+
+def _song(fill, chunks=10, size=4800):
+    def gen():
+        for _ in range(chunks):
+            yield bytes([fill, 0]) * (size // 2)
+
+    return gen()
+
+
+def test_next_song_is_prerendered_and_follows_on_the_same_voice():
+    # While A plays, B (the head of the queue) is pre-rendered under its own
+    # tag; A hands its voice over just before running dry and B is appended
+    # behind A's tail, so the voice never empties between them.
+    m = _mgr()
+    renders = []
+    songs = {"A": 1, "B": 2}
+
+    def render(event, tag=m.SONG_VOICE):
+        renders.append((event.song_name, tag))
+        return _song(songs[event.song_name]), 0.5
+
+    m._render_midi_song = render
+    played, gaps, done = [], [], threading.Event()
+
+    def drain():  # a real-time-ish mixer: 10ms of audio every 10ms
+        started = False
+        while not done.is_set():
+            with m._mix_lock:
+                pcm = mixer.mix(m._voices, 960, 960)
+            if pcm is not None:
+                started = True
+                played.append(pcm)
+            elif started:
+                gaps.append(len(played))
+            threading.Event().wait(0.01)
+
+    drainer = threading.Thread(target=drain, daemon=True)
+    drainer.start()
+    a, b = _event(song_name="A"), _event(song_name="B")
+    m.enqueue_song(a)
+    m.enqueue_song(b)
+    m._song_pending.pop(0)
+    token = m._play_one_song(a)
+    assert token is not None  # handed over
+    assert m._song_pending.pop(0) is b
+    assert m._play_one_song(b, token) is None
+    done.set()
+    drainer.join()
+
+    assert renders == [("A", m.SONG_VOICE), ("B", m.SONG_NEXT_TAG)]
+    audio = b"".join(played)
+    assert audio == b"\x01\x00" * 24000 + b"\x02\x00" * 24000
+    assert gaps == [] or min(gaps) >= len(played)  # only after B's last byte
+    assert m._song_next is None
+
+
+def test_stop_discards_the_prerendered_song():
+    m = _mgr()
+    gen = _song(2)
+    m._render_midi_song = lambda event, tag=m.SONG_VOICE: (gen, 0.5)
+    m._song_current = {"song_name": "A"}  # something is playing
+    m.enqueue_song(_event(song_name="B"))
+    slot = m._song_next
+    assert slot is not None and slot["done"].wait(5)
+    assert slot["first"]  # rendered up to its first window
+
+    m.stop()
+
+    assert m._song_next is None
+    assert gen.gi_frame is None  # the pre-render was closed
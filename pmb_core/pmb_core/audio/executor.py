@@ -0,0 +1,339 @@
+"""Process-pool render executor shared by both bots.
+
+Song renders are CPU-heavy Python (mido parsing, the WSOLA stretch loop) and,
+run on a thread, they hold the GIL long enough to starve the realtime audio
+threads: the Mumble mixer ticks every 5ms and discord.py's player every 20ms.
+This runs them in a small pool of worker processes instead, so a render can
+use other cores and never competes with playback for the interpreter.
+
+* Results come back through shared memory rather than the pipe: the worker
+  writes the PCM into a ``SharedMemory`` block the parent named up front, and
+  only the lengths are pickled. A job may return one PCM buffer, a list of
+  them, or None (for jobs run for their side effect, like warming a cache).
+* Jobs can be cancelled. A queued job is just dropped; a running one has its
+  worker terminated (and replaced), so a skipped song stops burning CPU.
+* Jobs carry an optional ``tag`` so a bot can cancel everything belonging to
+  one song (``cancel(tag)``) or everything at once (``cancel()``).
+* ``stats()`` reports queue depth, running jobs and lifetime counters.
+
+Workers are started with ``spawn`` (never ``fork``: both bots are heavily
+threaded) and lazily, on the first submit. ``RENDER_WORKERS=0`` runs jobs
+inline on the calling thread instead, which is also what happens if the pool
+can't be started.
+
+    job = executor.get().submit(render_cache.render_variants, audio_dir, ...)
+    pcms = job.result()
+"""
+
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+log = logging.getLogger(__name__)
+
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(min(2, os.cpu_count() or 1))))
+
+CancelledError = concurrent.futures.CancelledError
+
+
+class RenderError(Exception):
+    """A job raised in its worker. The message carries the remote error."""
+
+
+class RenderJob:
+    def __init__(self, fn, args, tag=None):
+        self.fn = fn
+        self.args = args
+        self.tag = tag
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self._future = concurrent.futures.Future()
+
+    def result(self, timeout=None):
+        """The job's PCM (bytes, a list of bytes if the job returned a list,
+        or None if it returned None). Raises CancelledError if it was
+        cancelled, RenderError if it failed."""
+        return self._future.result(timeout)
+
+    def cancel(self):
+        """Cancel the job (a running one's worker is killed). Returns False if
+        it had already finished."""
+        return self._future.cancel()
+
+    def cancelled(self):
+        return self._future.cancelled()
+
+    def done(self):
+        return self._future.done()
+
+
+class RenderExecutor:
+    def __init__(self, workers=None):
+        self.workers = RENDER_WORKERS if workers is None else workers
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._running = set()
+        self._slots = []
+        self._counts = {"completed": 0, "cancelled": 0, "failed": 0}
+
+    def submit(self, fn, *args, tag=None):
+        """Run ``fn(*args)`` in a worker. ``fn`` must be importable (a
+        module-level function) and return PCM (bytes-like, or a list of them)
+        or None."""
+        job = RenderJob(fn, args, tag)
+        if self.workers <= 0 or not self._ensure_started():
+            self._run_inline(job)
+            return job
+        with self._cond:
+            self._queue.append(job)
+            self._cond.notify()
+        return job
+
+    def cancel(self, tag=None):
+        """Cancel every queued and running job (only ``tag``'s, if given).
+        Returns how many were cancelled."""
+        with self._cond:
+            jobs = [
+                j
+                for j in list(self._queue) + list(self._running)
+                if tag is None or j.tag == tag
+            ]
+        return sum(1 for j in jobs if j.cancel())
+
+    def stats(self):
+        with self._cond:
+            return {
+                "workers": len(self._slots),
+                "queued": sum(1 for j in self._queue if not j.cancelled()),
+                "running": len(self._running),
+                **self._counts,
+            }
+
+    def shutdown(self):
+        self.cancel()
+        with self._cond:
+            slots, self._slots = self._slots, []
+            for slot in slots:
+                slot.closing = True
+            self._cond.notify_all()
+        for slot in slots:
+            slot.thread.join(timeout=5)
+
+    def _ensure_started(self):
+        with self._cond:
+            if self._slots:
+                return True
+            try:
+                ctx = multiprocessing.get_context("spawn")
+                self._slots = [_Slot(self, ctx, i) for i in range(self.workers)]
+            except Exception:
+                log.exception("render pool failed to start; rendering inline")
+                self.workers = 0
+                return False
+            for slot in self._slots:
+                slot.thread.start()
+            return True
+
+    def _run_inline(self, job):
+        if not job._future.set_running_or_notify_cancel():
+            return
+        job.started_at = time.monotonic()
+        try:
+            out = job.fn(*job.args)
+        except Exception as e:
+            error = RenderError("{0}: {1}".format(type(e).__name__, e))
+            error.__cause__ = e
+            self._finish(job, error=error)
+        else:
+            if isinstance(out, (list, tuple)):
+                out = [bytes(p) for p in out]
+            elif out is not None:
+                out = bytes(out)
+            self._finish(job, result=out)
+
+    def _next_job(self, slot):
+        with self._cond:
+            while True:
+                if slot.closing:
+                    return None
+                while self._queue and self._queue[0].cancelled():
+                    self._queue.popleft()
+                    self._counts["cancelled"] += 1
+                if self._queue:
+                    job = self._queue.popleft()
+                    job.started_at = time.monotonic()
+                    self._running.add(job)
+                    return job
+                self._cond.wait()
+
+    def _finish(self, job, result=None, error=None):
+        with self._cond:
+            self._running.discard(job)
+            if job.cancelled():
+                self._counts["cancelled"] += 1
+                return
+            self._counts["failed" if error is not None else "completed"] += 1
+        try:
+            if error is not None:
+                job._future.set_exception(error)
+            else:
+                job._future.set_result(result)
+        except concurrent.futures.InvalidStateError:
+            pass  # cancelled in the meantime
+        log.info(
+            "[timing] render job %s: %.0fms (%.0fms queued) | %s",
+            getattr(job.fn, "__name__", job.fn),
+            (time.monotonic() - job.started_at) * 1000,
+            (job.started_at - job.submitted_at) * 1000,
+            self.stats(),
+        )
+
+
+class _Slot:
+    """One worker process plus the parent thread that feeds it."""
+
+    def __init__(self, executor, ctx, index):
+        self.executor = executor
+        self.ctx = ctx
+        self.closing = False
+        self.process = None
+        self.conn = None
+        self.thread = threading.Thread(
+            target=self._loop, name="pmb-render-{0}".format(index), daemon=True
+        )
+
+    def _spawn(self):
+        parent, child = self.ctx.Pipe()
+        self.process = self.ctx.Process(target=_worker_main, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        self.conn = parent
+
+    def _kill(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join(timeout=5)
+            self.conn.close()
+        self.process = self.conn = None
+
+    def _loop(self):
+        try:
+            while True:
+                job = self.executor._next_job(self)
+                if job is None:
+                    return
+                self._run(job)
+        finally:
+            if self.conn is not None:
+                try:
+                    self.conn.send(None)
+                except OSError:
+                    pass
+            self._kill()
+
+    def _run(self, job):
+        name = "pmb_{0}".format(uuid.uuid4().hex[:24])
+        try:
+            if self.process is None or not self.process.is_alive():
+                self._spawn()
+            self.conn.send((name, job.fn, job.args))
+            while not self.conn.poll(0.05):
+                if job.cancelled() or not self.process.is_alive():
+                    break
+            if job.cancelled():
+                self._kill()  # don't wait for it: the render is unwanted
+                _unlink(name)
+                self.executor._finish(job)
+                return
+            status, payload = self.conn.recv()
+        except (EOFError, OSError) as e:
+            self._kill()
+            _unlink(name)
+            self.executor._finish(
+                job, error=RenderError("worker died: {0!r}".format(e))
+            )
+            return
+        if status == "error":
+            self.executor._finish(job, error=RenderError(payload))
+            return
+        if payload is None:
+            self.executor._finish(job)
+            return
+        lengths, single = payload
+        self.executor._finish(job, result=_collect(name, lengths, single))
+
+
+def _collect(name, lengths, single):
+    """Copy a job's PCM out of its shared-memory block and free the block."""
+    shm = SharedMemory(name=name)
+    try:
+        out = []
+        pos = 0
+        for n in lengths:
+            out.append(bytes(shm.buf[pos : pos + n]))
+            pos += n
+    finally:
+        shm.close()
+        shm.unlink()
+    return out[0] if single else out
+
+
+def _unlink(name):
+    try:
+        shm = SharedMemory(name=name)
+    except (FileNotFoundError, OSError):
+        return
+    shm.close()
+    shm.unlink()
+
+
+def _worker_main(conn):
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            return
+        if msg is None:
+            return
+        name, fn, args = msg
+        try:
+            out = fn(*args)
+            if out is None:
+                conn.send(("ok", None))
+                continue
+            single = not isinstance(out, (list, tuple))
+            views = [memoryview(p).cast("B") for p in ([out] if single else out)]
+            lengths = [len(v) for v in views]
+            shm = SharedMemory(name=name, create=True, size=max(1, sum(lengths)))
+            # The parent frees the block; don't let this process's resource
+            # tracker "clean it up" as a leak when the worker exits.
+            resource_tracker.unregister(shm._name, "shared_memory")
+            pos = 0
+            for v in views:
+                shm.buf[pos : pos + len(v)] = v
+                pos += len(v)
+            del views
+            shm.close()
+            conn.send(("ok", (lengths, single)))
+        except Exception as e:
+            conn.send(("error", "{0}: {1}".format(type(e).__name__, e)))
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get():
+    """The process-wide executor (created on first use)."""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = RenderExecutor()
+        return _default
@@ -0,0 +1,374 @@
+"""Song finalize stage: loudness-normalise, apply volume, fade out the end.
+
+Both bots finish a song render the same way: normalise to the jukebox target
+(EBU R128 integrated loudness of ``TARGET_LUFS``, true peak under
+``TARGET_TRUE_PEAK``), the playback volume, and a 30ms fade so a length cap
+never ends on a click. This used to be a second ffmpeg process running
+``loudnorm`` over the whole song; it's now done in-process by ``Normalizer``:
+
+* Loudness is measured the BS.1770 way: K-weighted mean square per 100ms
+  sub-block, 400ms gating blocks at 75% overlap, an absolute gate at -70 LUFS
+  and a relative gate 10 LU below. The K-weighting is applied in the frequency
+  domain, one FFT per sub-block, which is within a few hundredths of a LU of the
+  time-domain filter on music.
+* A song arriving a window at a time is held back ``LOOKAHEAD_SECONDS`` (like
+  loudnorm's dynamic mode): each 100ms of output gets the gain that brings the
+  integrated loudness of everything up to 3s past it onto the target, ramped
+  from the previous sub-block's gain, so the level settles within the first
+  few seconds and then holds.
+* Peaks are found on a 4x oversampled signal (true peak) and pulled under the
+  ceiling by a lookahead limiter whose gain ramps in and out over
+  ``LIMITER_SECONDS``.
+
+``finalize_stream`` runs a ``Normalizer`` over an iterable of windows;
+``finalize`` is the same thing over a whole buffer. Output doesn't depend on
+how the song is split into windows, so the two give identical bytes.
+"""
+
+import numpy as np
+
+from pmb_core.audio import engine
+
+SAMPLE_RATE = engine.SAMPLE_RATE
+TARGET_LUFS = -16.0
+TARGET_TRUE_PEAK = -1.5
+# Describes the finalize stage to the song render cache key: change it (or the
+# targets) and finished songs rendered the old way stop matching.
+SONG_LOUDNORM = "r128:I={0}:TP={1}".format(TARGET_LUFS, TARGET_TRUE_PEAK)
+FADE_SECONDS = 0.03
+
+# Measurement sub-block (100ms) and the gating block it builds (4 x 100ms).
+BLOCK_FRAMES = SAMPLE_RATE // 10
+GATE_BLOCKS = 4
+ABSOLUTE_GATE_LUFS = -70.0
+RELATIVE_GATE_LU = -10.0
+LOOKAHEAD_SECONDS = 3.0
+# Never boost a near-silent song by more than this.
+MAX_GAIN_DB = 30.0
+
+LIMITER_SECONDS = 0.005
+
+# BS.1770 K-weighting at 48kHz: a high shelf (head effects) then the RLB
+# high-pass, as (b, a) biquad coefficients.
+_K_SHELF = (
+    (1.53512485958697, -2.69169618940638, 1.19839281085285),
+    (1.0, -1.69065929318241, 0.73248077421585),
+)
+_K_HIGHPASS = ((1.0, -2.0, 1.0), (1.0, -1.99004745483398, 0.99007225036621))
+
+# True-peak interpolator: windowed-sinc fractional delays for the 3 in-between
+# phases of a 4x oversample, 12 taps each.
+_TP_PHASES = 4
+_TP_TAPS = 12
+
+_k_power = {}
+
+
+def _k_weights(n):
+    """|H(f)|^2 of the K-weighting filter at the rfft bins of an n-frame block,
+    with the one-sided spectrum's doubling folded in. Memoised for full
+    sub-blocks (only a song's last block is any other size)."""
+    weights = _k_power.get(n)
+    if weights is None:
+        z = np.exp(-1j * np.pi * np.arange(n // 2 + 1) / (n / 2))
+        response = np.ones_like(z)
+        for b, a in (_K_SHELF, _K_HIGHPASS):
+            response *= np.polyval(b[::-1], z) / np.polyval(a[::-1], z)
+        weights = np.abs(response) ** 2 * 2.0
+        weights[0] /= 2.0
+        if n % 2 == 0:
+            weights[-1] /= 2.0
+        if n == BLOCK_FRAMES:
+            _k_power[n] = weights
+    return weights
+
+
+def _block_power(samples):
+    """K-weighted mean square of one sub-block, summed over channels (int16
+    scale samples in, full-scale-relative power out)."""
+    n = len(samples)
+    spectrum = np.fft.rfft(samples.astype(np.float64) / 32768.0, axis=0)
+    power = np.abs(spectrum) ** 2 * _k_weights(n)[:, None]
+    return float(power.sum()) / (n * n)
+
+
+def _lufs(power):
+    return -0.691 + 10.0 * np.log10(np.maximum(power, 1e-20))
+
+
+def _integrated(powers):
+    """Gated integrated loudness (LUFS) of a run of sub-block powers, or None if
+    it's all below the absolute gate."""
+    powers = np.asarray(powers)
+    if len(powers) >= GATE_BLOCKS:
+        kernel = np.ones(GATE_BLOCKS) / GATE_BLOCKS
+        blocks = np.convolve(powers, kernel, mode="valid")
+    else:
+        blocks = np.array([powers.mean()]) if len(powers) else powers
+    blocks = blocks[_lufs(blocks) > ABSOLUTE_GATE_LUFS]
+    if not len(blocks):
+        return None
+    relative = _lufs(blocks.mean()) + RELATIVE_GATE_LU
+    blocks = blocks[_lufs(blocks) > relative]
+    return float(_lufs(blocks.mean()))
+
+
+class _Gate:
+    """``_integrated`` for a run of sub-block powers that only ever grows:
+    ``add`` each sub-block's power as it's measured, and ``loudness`` is the
+    gated loudness of them all so far, without going back over them. The
+    gating blocks over the absolute gate are kept in a histogram by loudness
+    (each bin's count and power sum), so the relative gate is a sum over the
+    bins above it plus an exact look at the one bin it falls in."""
+
+    BIN_LU = 0.1
+    TOP_LUFS = 10.0  # louder blocks (there are none in int16) share the top bin
+
+    def __init__(self):
+        bins = int(round((self.TOP_LUFS - ABSOLUTE_GATE_LUFS) / self.BIN_LU))
+        self._counts = np.zeros(bins, dtype=np.int64)
+        self._sums = np.zeros(bins)
+        self._members = [[] for _ in range(bins)]
+        self._count = 0
+        self._sum = 0.0
+        self._recent = []  # the last GATE_BLOCKS - 1 sub-block powers
+        self.added = 0
+        self._power_sum = 0.0  # of all of them: a short song's one block
+
+    def _bin(self, lufs):
+        index = int((lufs - ABSOLUTE_GATE_LUFS) // self.BIN_LU)
+        return min(len(self._counts) - 1, max(0, index))
+
+    def add(self, power):
+        self.added += 1
+        self._power_sum += power
+        self._recent.append(power)
+        if len(self._recent) < GATE_BLOCKS:
+            return
+        block = float(np.mean(self._recent))
+        del self._recent[0]
+        lufs = _lufs(block)
+        if not lufs > ABSOLUTE_GATE_LUFS:
+            return
+        index = self._bin(lufs)
+        self._counts[index] += 1
+        self._sums[index] += block
+        self._members[index].append(block)
+        self._count += 1
+        self._sum += block
+
+    def loudness(self):
+        if self.added < GATE_BLOCKS:
+            if not self.added:
+                return None
+            return _integrated([self._power_sum / self.added])
+        if not self._count:
+            return None
+        relative = _lufs(self._sum / self._count) + RELATIVE_GATE_LU
+        index = self._bin(relative)
+        count = int(self._counts[index + 1 :].sum())
+        total = float(self._sums[index + 1 :].sum())
+        for block in self._members[index]:
+            if _lufs(block) > relative:
+                count += 1
+                total += block
+        return float(_lufs(total / count))
+
+
+def integrated_loudness(pcm, channels=1):
+    """Integrated loudness of s16le PCM in LUFS (None if it's silent)."""
+    samples = engine.from_pcm(pcm, channels)
+    return _integrated(
+        [
+            _block_power(samples[pos : pos + BLOCK_FRAMES])
+            for pos in range(0, len(samples), BLOCK_FRAMES)
+        ]
+    )
+
+
+def _tp_filters():
+    taps = np.arange(_TP_TAPS) - (_TP_TAPS // 2 - 1)
+    window = np.kaiser(_TP_TAPS + 2, 5.0)[1:-1]
+    filters = []
+    for phase in range(1, _TP_PHASES):
+        h = np.sinc(taps - phase / _TP_PHASES) * window
+        filters.append(h / h.sum())
+    return np.array(filters).T  # (taps, phases)
+
+
+_TP_FILTERS = _tp_filters()
+_TP_LEAD = _TP_TAPS // 2 - 1  # taps before the interpolated point
+
+
+def _true_peaks(samples):
+    """Per-frame true peak: the largest magnitude on either side of each frame
+    in a 4x oversampled version of ``samples`` (frames, channels). The first
+    and last few frames only see the real samples."""
+    peaks = np.abs(samples).max(axis=1)
+    n = len(samples)
+    if n < _TP_TAPS:
+        return peaks
+    # All 3 phases of every channel at once, accumulated one tap at a time.
+    columns = samples.T
+    span = n - _TP_TAPS + 1
+    acc = np.zeros((_TP_FILTERS.shape[1],) + (samples.shape[1], span))
+    for tap, coefs in enumerate(_TP_FILTERS):
+        acc += coefs[:, None, None] * columns[None, :, tap : tap + span]
+    interp = np.abs(acc).max(axis=(0, 1))
+    between = np.zeros(n)
+    between[_TP_LEAD : _TP_LEAD + len(interp)] = interp
+    peaks = np.maximum(peaks, between)
+    peaks[1:] = np.maximum(peaks[1:], between[:-1])
+    return peaks
+
+
+def _sliding_min(values, width):
+    """``out[i] = min(values[i : i + width])``, padding past the end with 1.0
+    (van Herk/Gil-Werman, so it's linear in ``len(values)``)."""
+    n = len(values)
+    blocks = -(-(n + width) // width)
+    padded = np.ones(blocks * width)
+    padded[:n] = values
+    grid = padded.reshape(blocks, width)
+    prefix = np.minimum.accumulate(grid, axis=1).reshape(-1)
+    suffix = np.minimum.accumulate(grid[:, ::-1], axis=1)[:, ::-1].reshape(-1)
+    return np.minimum(suffix[:n], prefix[width - 1 : width - 1 + n])
+
+
+class Normalizer:
+    """Streaming loudness normaliser + true-peak limiter for one song.
+
+    ``feed`` s16le PCM as it's mixed and get back whatever is finalized so far;
+    ``close`` returns the rest. ``frames`` is the song's expected length, where
+    the fade-out ends.
+    """
+
+    def __init__(self, frames, volume, channels=1, lookahead=LOOKAHEAD_SECONDS):
+        self.frames = frames
+        self.volume = volume
+        self.channels = channels
+        self._lookahead = max(1, int(round(lookahead * SAMPLE_RATE / BLOCK_FRAMES)))
+        self._ceiling = 32768.0 * 10 ** (TARGET_TRUE_PEAK / 20)
+        self._width = max(1, int(LIMITER_SECONDS * SAMPLE_RATE))
+        self._context = self._width + _TP_TAPS
+
+        self._leftover = b""
+        self._pending = np.zeros((0, channels), dtype=np.float32)
+        self._measured = 0  # frames of _pending already measured
+        self._powers = []
+        self._gate = _Gate()  # fed _powers up to each block's lookahead
+        self._emitted = 0  # sub-blocks output so far
+        self._position = 0  # frames output so far
+        self._gain = None
+        # The tail of what's been output (gained, pre-limiter), for context.
+        self._history = np.zeros((self._context, channels), dtype=np.float64)
+        self._closed = False
+
+    def feed(self, pcm):
+        data = self._leftover + bytes(pcm)
+        usable = len(data) - len(data) % (2 * self.channels)
+        self._leftover = data[usable:]
+        if usable:
+            self._pending = np.concatenate(
+                [self._pending, engine.from_pcm(data[:usable], self.channels)]
+            )
+        self._measure()
+        return self._drain()
+
+    def close(self):
+        self._closed = True
+        self._measure()
+        return self._drain()
+
+    def _measure(self):
+        while True:
+            available = len(self._pending) - self._measured
+            if available < BLOCK_FRAMES and not (self._closed and available > 0):
+                return
+            size = min(BLOCK_FRAMES, available)
+            block = self._pending[self._measured : self._measured + size]
+            self._powers.append(_block_power(block))
+            self._measured += size
+
+    def _drain(self):
+        out = []
+        while self._emitted < len(self._powers):
+            known = len(self._powers) - self._emitted
+            if not self._closed and known <= self._lookahead:
+                break
+            out.append(self._emit_block())
+        return b"".join(out)
+
+    def _block_gain(self, index):
+        upto = min(index + self._lookahead + 1, len(self._powers))
+        for power in self._powers[self._gate.added : upto]:
+            self._gate.add(power)
+        loudness = self._gate.loudness()
+        if loudness is None:
+            return 1.0
+        gain_db = min(MAX_GAIN_DB, TARGET_LUFS - loudness)
+        return 10 ** (gain_db / 20)
+
+    def _emit_block(self):
+        gain = self._block_gain(self._emitted)
+        previous = gain if self._gain is None else self._gain
+        self._gain = gain
+        size = min(BLOCK_FRAMES, len(self._pending))
+        ramp = previous + (gain - previous) * (np.arange(1, size + 1) / size)
+        block = self._pending[:size].astype(np.float64) * ramp[:, None]
+        ahead = self._pending[size : size + self._context].astype(np.float64) * gain
+        self._pending = self._pending[size:]
+        self._measured -= size
+        self._emitted += 1
+
+        # Lookahead limiter: the gain each frame needs to keep its true peak
+        # under the ceiling, held over the next ``width`` frames and averaged
+        # over the last ``width``, so it ramps down before a peak and back up
+        # after it — and every frame ends up at or under what it needed.
+        context = np.concatenate([self._history, block, ahead])
+        peaks = _true_peaks(context)
+        needed = np.minimum(1.0, self._ceiling / np.maximum(peaks, 1e-9))
+        held = np.concatenate(
+            [np.ones(self._width - 1), _sliding_min(needed, self._width)]
+        )
+        sums = np.concatenate([[0.0], np.cumsum(held)])
+        start = len(self._history)
+        ends = np.arange(start, start + size) + self._width
+        limit = (sums[ends] - sums[ends - self._width]) / self._width
+
+        self._history = np.concatenate([self._history, block])[-self._context :]
+        out = block * (limit * self.volume)[:, None]
+        out *= self._fade(size)[:, None]
+        self._position += size
+        return engine.to_pcm(out)
+
+    def _fade(self, size):
+        positions = np.arange(self._position, self._position + size)
+        fade = max(1, min(int(FADE_SECONDS * SAMPLE_RATE), self.frames))
+        return np.clip((self.frames - positions) / fade, 0.0, 1.0)
+
+
+def finalize(pcm, volume, channels=1):
+    """Finalize a whole song buffer (s16le)."""
+    frames = len(pcm) // (2 * channels)
+    return b"".join(finalize_stream([pcm], frames, volume, channels))
+
+
+def finalize_stream(windows, frames, volume, channels=1):
+    """Finalize a song that arrives as an iterable of s16le ``windows``
+    totalling ``frames`` frames. A generator of finalized chunks, the first
+    once ``LOOKAHEAD_SECONDS`` of song have arrived; closing it early (e.g. the
+    song was skipped) stops pulling windows."""
+    normalizer = Normalizer(frames, volume, channels)
+    try:
+        for window in windows:
+            chunk = normalizer.feed(window)
+            if chunk:
+                yield chunk
+        chunk = normalizer.close()
+        if chunk:
+            yield chunk
+    finally:
+        close = getattr(windows, "close", None)
+        if close is not None:
+            close()
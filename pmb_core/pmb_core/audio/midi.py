@@ -1,15 +1,22 @@
 """Minimal MIDI reader for the "play a clip as an instrument" feature.
 
 MIDI is the only song format the bots play (the old MusicXML path is dormant).
-We flatten a Standard MIDI File into a simple list of notes on an absolute
-seconds timeline; each bot then renders it by pitch-shifting an instrument clip
-onto a PCM canvas (mono for Mumble, stereo for Discord).
+We flatten a Standard MIDI File into notes on an absolute seconds timeline; each
+bot then renders it by pitch-shifting an instrument clip onto a PCM canvas (mono
+for Mumble, stereo for Discord).
 
 ``mido`` does the heavy lifting: iterating a ``MidiFile`` yields messages whose
 ``.time`` is already in seconds (tempo-adjusted), so we just accumulate it.
+
+``parse_midi_table`` returns the notes as a ``NoteTable`` — one structured NumPy
+array with a column per field — so the renderers can work out offsets, shifts
+and lines for a big orchestral file in a few vectorised passes instead of a
+Python loop over tens of thousands of objects. ``parse_midi`` still returns the
+old list of ``MidiNote`` for anything that wants plain objects.
 """
 
 import mido
+import numpy as np
 
 # General MIDI percussion lives on channel 9 (0-indexed). Its "pitches" are drum
 # voices, not a melody, so rendering them as pitched clips sounds wrong — skip.
@@ -156,6 +163,20 @@ def gm_instrument_name(program):
     return "Program {0}".format(program)
 
 
+# One row per note. Times are seconds; the ints are widened past their MIDI
+# ranges so arithmetic on a column (pitch - root + transpose...) can't wrap.
+NOTE_DTYPE = np.dtype(
+    [
+        ("pitch", "<i4"),
+        ("start", "<f8"),
+        ("duration", "<f8"),
+        ("velocity", "<i4"),
+        ("channel", "<i4"),
+        ("program", "<i4"),
+    ]
+)
+
+
 class MidiNote:
     __slots__ = ("pitch", "start", "duration", "velocity", "channel", "program")
 
@@ -180,20 +201,128 @@ class MidiNote:
             )
         )
 
+    @classmethod
+    def from_row(cls, row):
+        """A MidiNote from one row of a ``NoteTable``."""
+        return cls(
+            int(row["pitch"]),
+            float(row["start"]),
+            float(row["duration"]),
+            int(row["velocity"]),
+            int(row["channel"]),
+            int(row["program"]),
+        )
+
 
-def parse_midi(path, include_drums=False):
-    """Parse a .mid file into a flat, time-sorted list of MidiNote.
+class NoteTable:
+    """A song's notes as a structured array (``NOTE_DTYPE``), sorted by
+    (start, pitch). Columns are exposed as attributes (``table.pitch`` is an
+    int array, ``table.start`` a float one...); iterating or indexing yields
+    ``MidiNote`` objects, so code written against ``parse_midi`` keeps working.
+    """
+
+    __slots__ = ("notes", "track_count")
+
+    def __init__(self, notes=None, track_count=0):
+        self.notes = np.zeros(0, dtype=NOTE_DTYPE) if notes is None else notes
+        self.track_count = track_count
+
+    def __len__(self):
+        return len(self.notes)
+
+    def __iter__(self):
+        for row in self.notes:
+            yield MidiNote.from_row(row)
+
+    def __getitem__(self, index):
+        return MidiNote.from_row(self.notes[index])
+
+    def __repr__(self):
+        return "NoteTable({0} notes, {1:.2f}s)".format(len(self), self.end)
+
+    @property
+    def pitch(self):
+        return self.notes["pitch"]
+
+    @property
+    def start(self):
+        return self.notes["start"]
+
+    @property
+    def duration(self):
+        return self.notes["duration"]
+
+    @property
+    def velocity(self):
+        return self.notes["velocity"]
 
-    Returns ``(notes, duration_seconds)``. Notes from all tracks are merged onto
-    one timeline (polyphony is fine — the renderer mixes overlaps).
+    @property
+    def channel(self):
+        return self.notes["channel"]
+
+    @property
+    def program(self):
+        return self.notes["program"]
+
+    @property
+    def end(self):
+        """When the last note finishes (the song's length), in seconds."""
+        if not len(self.notes):
+            return 0.0
+        return float((self.start + self.duration).max())
+
+    def median_pitch(self):
+        """The song's median pitch — the root the renderers shift clips from.
+        (Truncated like ``int(statistics.median(...))``, which it replaces.)"""
+        return int(np.median(self.pitch))
+
+    def to_notes(self):
+        return list(self)
+
+    def summary(self):
+        """Lightweight metadata for the library (see ``summarize_midi``)."""
+        return {
+            "duration_s": round(self.end, 2),
+            "note_count": len(self),
+            "track_count": self.track_count,
+        }
+
+    def lines(self):
+        """The instrument "lines" (see ``song_lines``), grouped in one pass."""
+        if not len(self.notes):
+            return []
+        programs, first, inverse, counts = np.unique(
+            self.program, return_index=True, return_inverse=True, return_counts=True
+        )
+        # Distinct (line, channel) pairs, sorted by line then channel.
+        pairs = np.unique(inverse.astype(np.int64) * 16 + self.channel)
+        pair_line, pair_channel = pairs // 16, pairs % 16
+        bounds = np.searchsorted(pair_line, np.arange(len(programs) + 1))
+        # Busiest first; ties keep the order the instruments first play in.
+        order = np.lexsort((first, -counts))
+        return [
+            {
+                "program": int(programs[i]),
+                "instrument": gm_instrument_name(int(programs[i])),
+                "note_count": int(counts[i]),
+                "channels": pair_channel[bounds[i] : bounds[i + 1]].tolist(),
+            }
+            for i in order
+        ]
+
+
+def parse_midi_table(path, include_drums=False):
+    """Parse a .mid file into a ``NoteTable``. Notes from all tracks are merged
+    onto one timeline (polyphony is fine — the renderer mixes overlaps).
+    ``path`` may also be an already-open ``mido.MidiFile``.
     """
-    mid = mido.MidiFile(path)
+    mid = path if isinstance(path, mido.MidiFile) else mido.MidiFile(path)
 
     now = 0.0
     # open_notes[(channel, pitch)] = [(start, velocity), ...] (a stack, so
     # repeated note-ons on the same pitch pair with note-offs in LIFO order).
     open_notes = {}
-    notes = []
+    rows = []
     # Current GM program per channel (program_change updates it; default 0). Each
     # note records the program active on its channel so the renderer can group
     # notes into instrument "lines".
@@ -222,23 +351,29 @@ def parse_midi(path, include_drums=False):
                 start, velocity, program = stack.pop()
                 duration = now - start
                 if duration > 0:
-                    notes.append(
-                        MidiNote(
-                            msg.note, start, duration, velocity, msg.channel, program
-                        )
+                    rows.append(
+                        (msg.note, start, duration, velocity, msg.channel, program)
                     )
 
     # Close any notes left hanging at end-of-file (malformed/truncated MIDI).
     for (channel, pitch), stack in open_notes.items():
         for start, velocity, program in stack:
             if now - start > 0:
-                notes.append(
-                    MidiNote(pitch, start, now - start, velocity, channel, program)
-                )
+                rows.append((pitch, start, now - start, velocity, channel, program))
+
+    notes = np.array(rows, dtype=NOTE_DTYPE)
+    notes = notes[np.lexsort((notes["pitch"], notes["start"]))]
+    return NoteTable(notes, len(mid.tracks))
+
+
+def parse_midi(path, include_drums=False):
+    """Parse a .mid file into a flat, time-sorted list of MidiNote.
 
-    notes.sort(key=lambda n: (n.start, n.pitch))
-    duration = max((n.start + n.duration for n in notes), default=0.0)
-    return notes, duration
+    Returns ``(notes, duration_seconds)``. A list-of-objects view of
+    ``parse_midi_table``, kept for callers that don't need the columns.
+    """
+    table = parse_midi_table(path, include_drums)
+    return table.to_notes(), table.end
 
 
 def song_lines(path):
@@ -249,39 +384,9 @@ def song_lines(path):
 
         {"program": int, "instrument": str, "note_count": int, "channels": [..]}
     """
-    notes, _duration = parse_midi(path)
-    lines = {}
-    for n in notes:
-        line = lines.get(n.program)
-        if line is None:
-            line = {
-                "program": n.program,
-                "instrument": gm_instrument_name(n.program),
-                "note_count": 0,
-                "channels": set(),
-            }
-            lines[n.program] = line
-        line["note_count"] += 1
-        line["channels"].add(n.channel)
-    out = [
-        {
-            "program": ln["program"],
-            "instrument": ln["instrument"],
-            "note_count": ln["note_count"],
-            "channels": sorted(ln["channels"]),
-        }
-        for ln in lines.values()
-    ]
-    out.sort(key=lambda ln: ln["note_count"], reverse=True)
-    return out
+    return parse_midi_table(path).lines()
 
 
 def summarize_midi(path):
     """Lightweight metadata for the library (used at upload time)."""
-    mid = mido.MidiFile(path)
-    notes, duration = parse_midi(path)
-    return {
-        "duration_s": round(duration, 2),
-        "note_count": len(notes),
-        "track_count": len(mid.tracks),
-    }
+    return parse_midi_table(path).summary()
@@ -0,0 +1,109 @@
+"""Song canvas mixer: lays rendered clips onto one PCM timeline.
+
+A song is thousands of placements of a handful of renders (one per distinct
+pitch shift / instrument line), each cut to its note's length. They are summed
+into an int32 accumulator, so overlapping notes never clip part-way through,
+and saturated back to s16le once at the end. Each add is a single NumPy slice
+operation that runs outside the GIL, so the bots' realtime audio threads keep
+running while a long song mixes and don't need sleep-yields.
+
+A song can also be mixed a window at a time (``Mixdown.windows``) so playback
+can start before the whole song is mixed. Placements are grouped by source,
+which keeps each render hot in cache while its notes are laid down. A single
+scatter-add over every sample (np.add.at or bincount) was measured and is far
+slower: it has to build index arrays as large as the song itself.
+"""
+
+import numpy as np
+
+
+class Mixdown:
+    """A song's placements, ready to be mixed whole or window by window.
+
+    ``sources`` is a list of s16le renders (bytes or int16 arrays). Placement
+    ``i`` plays ``sources[source_ids[i]]`` from its start for ``lengths[i]``
+    frames (or until the render runs out), starting at frame ``offsets[i]``.
+    ``limit`` (frames, 0 = none) cuts everything off at that point, so nothing
+    rings past a length cap. ``frames`` is the length of the mix: up to the end
+    of the last sound.
+    """
+
+    def __init__(self, sources, source_ids, offsets, lengths, channels=1, limit=0):
+        self.channels = channels
+        self._renders = [
+            np.frombuffer(src, dtype="<i2").reshape(-1, channels) for src in sources
+        ]
+        source_ids = np.asarray(source_ids, dtype=np.int64)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if self._renders:
+            available = np.array([len(r) for r in self._renders], dtype=np.int64)
+            lengths = np.minimum(
+                np.asarray(lengths, dtype=np.int64), available[source_ids]
+            )
+        else:
+            lengths = np.zeros(len(offsets), dtype=np.int64)
+        if limit:
+            lengths = np.minimum(lengths, limit - offsets)
+        keep = lengths > 0
+        # In onset order, so a window only has to look at the notes starting in it.
+        order = np.argsort(offsets[keep], kind="stable")
+        self._ids = source_ids[keep][order]
+        self._offsets = offsets[keep][order]
+        self._lengths = lengths[keep][order]
+        self.frames = int((self._offsets + self._lengths).max()) if len(order) else 0
+
+    def render(self):
+        """The whole mix as s16le bytes (b"" if nothing was placed)."""
+        return b"".join(self.windows(self.frames))
+
+    def windows(self, window_frames):
+        """Yield the mix as s16le chunks of ``window_frames`` (the last may be
+        shorter). Each window mixes the notes starting in it; whatever they ring
+        past its end is carried into the next ones, so the output is identical
+        to a whole-song mix however it's cut."""
+        window_frames = max(1, int(window_frames))
+        # Accumulator from the current window's start to the furthest sound
+        # placed so far.
+        carry = np.zeros((0, self.channels), dtype=np.int32)
+        first = 0  # next placement to lay down
+        for start in range(0, self.frames, window_frames):
+            end = min(start + window_frames, self.frames)
+            last = int(np.searchsorted(self._offsets, end))
+            if last > first:
+                reach = int(
+                    (self._offsets[first:last] + self._lengths[first:last]).max()
+                )
+                if reach - start > len(carry):
+                    grown = np.zeros((reach - start, self.channels), dtype=np.int32)
+                    grown[: len(carry)] = carry
+                    carry = grown
+                self._lay(carry, start, first, last)
+                first = last
+            if len(carry) < end - start:
+                grown = np.zeros((end - start, self.channels), dtype=np.int32)
+                grown[: len(carry)] = carry
+                carry = grown
+            yield _saturate(carry[: end - start])
+            carry = carry[end - start :]
+
+    def _lay(self, canvas, origin, first, last):
+        # Grouped by source, which keeps each render hot while its notes go down.
+        ids = self._ids[first:last]
+        order = np.argsort(ids, kind="stable")
+        for sid, offset, n in zip(
+            ids[order].tolist(),
+            (self._offsets[first:last][order] - origin).tolist(),
+            self._lengths[first:last][order].tolist(),
+        ):
+            canvas[offset : offset + n] += self._renders[sid][:n]
+
+
+def mix(sources, source_ids, offsets, lengths, channels=1, limit=0):
+    """Mix prefixes of rendered clips onto a silent canvas (see ``Mixdown``).
+    Returns s16le bytes as long as the last sound (b"" if nothing was placed).
+    """
+    return Mixdown(sources, source_ids, offsets, lengths, channels, limit).render()
+
+
+def _saturate(canvas):
+    return np.clip(canvas, -32768, 32767).astype("<i2").tobytes()
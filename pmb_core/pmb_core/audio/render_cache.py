@@ -0,0 +1,376 @@
+"""Content-addressed on-disk cache of rendered clips, shared by every process.
+
+A render is keyed by a hash of the clip's *content* plus the transform params,
+so it survives renames and restarts, and is stored under the audio volume that
+the bots and the web already share:
+
+    audio/.render_cache/<sha1>.s16le
+
+Renders are cached at unit volume and the caller's volume (global volume x clip
+gain) is applied on the way out. That keeps a preview in the browser (clip gain
+only) and a play in voice (global volume too) on the same entry, so whatever
+was just previewed is already warm when someone presses play.
+
+Writers never lock: each one writes a private temp file and ``os.replace``s it
+into place, so readers see a whole render or nothing, and two processes racing
+on the same key just write identical bytes twice. A hit bumps the entry's mtime,
+which makes the mtime an LRU clock every process agrees on; when the cache goes
+over ``RENDER_CACHE_MAX_BYTES`` the least recently used entries are deleted.
+
+Big entries (whole songs) needn't pass through memory in one piece:
+``open_writer`` appends to the temp file as the PCM is produced, and ``map``
+hands back a read-only memory map of an entry, so a reader pages in only the
+part it's playing.
+"""
+
+import hashlib
+import mmap
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from pmb_core.audio import engine, transform
+
+DIR_NAME = ".render_cache"
+SUFFIX = ".s16le"
+
+# ~10s of 48kHz stereo = ~2MB, so the default holds a few hundred clip renders.
+RENDER_CACHE_MAX_BYTES = int(
+    os.getenv("RENDER_CACHE_MAX_BYTES", str(512 * 1024 * 1024))
+)
+
+# Render semantics (see pmb_core.audio.engine). RESAMPLE is the Mumble path (an
+# off-rate mono stream the 48kHz consumer reinterprets), STANDARD the true
+# 48kHz path the Discord bot uses, and PITCH the sampler-style song-instrument
+# ladder (pitch and length move together; speed is ignored).
+RESAMPLE = "resample"
+STANDARD = "standard"
+PITCH = "pitch"
+
+# Bump when the engine's output changes, so old renders stop matching.
+FORMAT_VERSION = 1
+
+# Re-scan the directory every this many puts even if this process's own count
+# is under budget, to pick up what the other processes have written.
+_RESCAN_EVERY = 64
+# Temp files older than this were left by a writer that died mid-write.
+_STALE_TMP_SECONDS = 3600
+
+_hashes = {}
+_hashes_lock = threading.Lock()
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def content_hash(path):
+    """sha1 of a clip's bytes, memoised per (path, mtime, size). None if the
+    file can't be read."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    memo_key = (str(path), st.st_mtime_ns, st.st_size)
+    with _hashes_lock:
+        digest = _hashes.get(memo_key)
+    if digest is not None:
+        return digest
+    h = hashlib.sha1()
+    try:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    except OSError:
+        return None
+    digest = h.hexdigest()
+    with _hashes_lock:
+        _hashes[memo_key] = digest
+    return digest
+
+
+def for_audio_dir(audio_dir):
+    """The process-wide cache living under ``audio_dir`` (one instance per
+    directory, so its byte count isn't re-scanned on every call)."""
+    directory = Path(audio_dir) / DIR_NAME
+    with _caches_lock:
+        cache = _caches.get(str(directory))
+        if cache is None:
+            cache = _caches[str(directory)] = RenderCache(directory)
+        return cache
+
+
+class RenderCache:
+    def __init__(self, directory, max_bytes=None, suffix=SUFFIX):
+        self.directory = Path(directory)
+        self.max_bytes = RENDER_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._bytes = None  # unknown until the first scan
+        self._puts = 0
+
+    @property
+    def bytes_used(self):
+        """Best-known size of the cache (refreshed on every eviction scan)."""
+        return self._bytes or 0
+
+    @staticmethod
+    def key(source_hash, kind, speed, shift, reverse=False, channels=1):
+        if kind == PITCH:
+            kind = "{0}-{1}".format(kind, transform.PITCH_RESAMPLER)
+        raw = "{0}|{1}|{2}ch|{3:.4f}|{4:.4f}|{5}|{6}|v{7}".format(
+            source_hash,
+            kind,
+            channels,
+            float(speed),
+            float(shift),
+            int(bool(reverse)),
+            transform.ENGINE,
+            FORMAT_VERSION,
+        )
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def _path(self, key):
+        return self.directory / (key + self.suffix)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                pcm = f.read()
+        except OSError:
+            return None
+        try:
+            os.utime(path)  # mark most-recently-used (for every process)
+        except OSError:
+            pass
+        return pcm
+
+    def map(self, key):
+        """``get`` as a read-only ``mmap`` of the entry (close it when done), or
+        None. The entry stays readable through the map even if it's evicted."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # missing, or empty (can't map 0 bytes)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return mapped
+
+    def put(self, key, pcm):
+        """Store a render (atomically; best-effort — a full or read-only disk
+        just means no caching). Evicts LRU entries if over budget."""
+        writer = self.open_writer(key)
+        writer.write(pcm)
+        writer.commit()
+
+    def open_writer(self, key):
+        """An ``EntryWriter`` that stores ``key`` a piece at a time."""
+        return EntryWriter(self, key)
+
+    def _added(self, size):
+        with self._lock:
+            self._puts += 1
+            if self._bytes is not None:
+                self._bytes += size
+            rescan = (
+                self._bytes is None
+                or self._bytes > self.max_bytes
+                or self._puts % _RESCAN_EVERY == 0
+            )
+        if rescan:
+            self.evict()
+
+    def evict(self):
+        """Scan the directory and delete least-recently-used renders until it
+        fits the budget. Safe to race with other processes doing the same."""
+        entries = []
+        total = 0
+        now = time.time()
+        try:
+            scan = list(os.scandir(self.directory))
+        except OSError:
+            return
+        for entry in scan:
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if entry.name.startswith("."):
+                if now - st.st_mtime > _STALE_TMP_SECONDS:
+                    _unlink(entry.path)
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+        if total > self.max_bytes:
+            entries.sort()
+            for _mtime, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                _unlink(path)
+                total -= size
+        with self._lock:
+            self._bytes = total
+
+    def render(self, file, kind, volume, speed, shift, reverse=False, channels=1):
+        """Render ``file`` with ``kind`` semantics, via the cache. Returns
+        ``(pcm, hit)``; ``pcm`` is b"" if the clip can't be read."""
+        return self.render_many(
+            file, kind, [(speed, shift, reverse, volume)], channels
+        )[0]
+
+    def stream(self, file, kind, volume, speed, shift, reverse=False, channels=1):
+        """``render`` as a generator of PCM chunks: a hit comes back whole, a
+        miss is yielded as it renders (and stored once it's complete), so the
+        first audio is ready before a slow render has finished."""
+        source_hash = content_hash(file)
+        if source_hash is None:
+            return
+        key = self.key(source_hash, kind, speed, shift, reverse, channels)
+        pcm = self.get(key)
+        if pcm is not None:
+            self.hits += 1
+            yield engine.apply_volume(pcm, volume)
+            return
+        self.misses += 1
+        if kind == RESAMPLE:
+            chunks = transform.transform_audio_stream(
+                file, transform.RESAMPLE_FILTER, 1.0, speed, shift, reverse
+            )
+        elif kind == PITCH:
+            chunks = transform.transform_pitch_variants(
+                file, [(speed, shift, reverse, 1.0)], channels
+            )
+        else:
+            chunks = transform.transform_standard_stream(
+                file, 1.0, speed, shift, reverse, channels
+            )
+        rendered = []
+        for chunk in chunks:
+            rendered.append(chunk)
+            yield engine.apply_volume(chunk, volume)
+        pcm = b"".join(rendered)
+        if pcm:
+            self.put(key, pcm)
+
+    def render_many(self, file, kind, variants, channels=1):
+        """``render`` for several (speed, shift, reverse, volume) variants of one
+        clip: the misses are rendered together from a single decode. Returns a
+        ``(pcm, hit)`` per variant, in order."""
+        source_hash = content_hash(file)
+        if source_hash is None:
+            return [(b"", False)] * len(variants)
+        keys = [
+            self.key(source_hash, kind, speed, shift, reverse, channels)
+            for speed, shift, reverse, _volume in variants
+        ]
+        found = {}
+        for key in keys:
+            if key not in found:
+                found[key] = self.get(key)
+        # Distinct misses, rendered at unit volume (volume is applied below).
+        missing = {}
+        for key, (speed, shift, reverse, _volume) in zip(keys, variants):
+            if found[key] is None and key not in missing:
+                missing[key] = (speed, shift, reverse, 1.0)
+        if missing:
+            if kind == RESAMPLE:
+                rendered = transform.transform_audio_variants(
+                    file, transform.RESAMPLE_FILTER, list(missing.values())
+                )
+            elif kind == PITCH:
+                rendered = transform.transform_pitch_variants(
+                    file, list(missing.values()), channels
+                )
+            else:
+                rendered = transform.transform_standard_variants(
+                    file, list(missing.values()), channels
+                )
+            for key, pcm in zip(missing, rendered):
+                found[key] = pcm
+                if pcm:
+                    self.put(key, pcm)
+
+        results = []
+        for key, (_speed, _shift, _reverse, volume) in zip(keys, variants):
+            hit = key not in missing
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            results.append((engine.apply_volume(found[key], volume), hit))
+        return results
+
+
+class EntryWriter:
+    """An entry being written to its private temp file as it's produced.
+    ``commit`` moves it into place (if anything was written) and ``discard``
+    drops it; either way nothing is left behind. Best-effort like ``put``: a
+    write error just means the entry isn't stored."""
+
+    def __init__(self, cache, key):
+        self._cache = cache
+        self._key = key
+        self._tmp = cache.directory / ".{0}.{1}.tmp".format(key, uuid.uuid4().hex)
+        self._file = None
+        self._failed = False
+        self.size = 0
+
+    def write(self, pcm):
+        if self._failed or not pcm:
+            return
+        try:
+            if self._file is None:
+                self._cache.directory.mkdir(parents=True, exist_ok=True)
+                self._file = open(self._tmp, "wb")
+            self._file.write(pcm)
+            self.size += len(pcm)
+        except OSError:
+            self._failed = True
+
+    def commit(self):
+        self._close()
+        if self._file is None:
+            return  # nothing was written
+        if self._failed or not self.size:
+            _unlink(self._tmp)
+            return
+        try:
+            os.replace(self._tmp, self._cache._path(self._key))
+        except OSError:
+            _unlink(self._tmp)
+            return
+        self._cache._added(self.size)
+
+    def discard(self):
+        self._close()
+        if self._file is not None:
+            _unlink(self._tmp)
+
+    def _close(self):
+        if self._file is not None and not self._file.closed:
+            try:
+                self._file.close()
+            except OSError:
+                self._failed = True
+
+
+def render_variants(audio_dir, file, kind, variants, channels=1):
+    """``render_many`` through ``audio_dir``'s cache, returning just the PCM
+    per variant — the form the render executor runs in its workers."""
+    cache = for_audio_dir(audio_dir)
+    return [pcm for pcm, _hit in cache.render_many(file, kind, variants, channels)]
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
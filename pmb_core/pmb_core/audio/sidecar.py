@@ -0,0 +1,188 @@
+"""Canonical decoded-PCM sidecars for the clip library.
+
+Every render path (the Mumble mixer, the Discord source, the web preview) needs
+a clip as 48kHz s16le PCM before the speed/pitch engine can touch it. Rather
+than decoding the original MP3/WAV each time, the decoded PCM is written once to
+a hidden file next to the clip and memory-mapped on demand:
+
+    audio/dry_fart.mp3
+    audio/.pcm_dry_fart.mp3.1ch.s16le   (mono — always written)
+    audio/.pcm_dry_fart.mp3.2ch.s16le   (stereo — when PCM_SIDECAR_STEREO is on)
+
+Each sidecar is stamped with the mtime of the clip it was decoded from and is
+only trusted while that still matches, so a trim, revert or renormalise (which
+rewrite the clip in place) invalidates it even if nobody refreshes it, and a
+slow decode racing a rewrite can't pass off old audio as new. The web writes
+sidecars whenever it changes a clip; the bots write any that are missing on
+first use; ``backfill`` fills in the existing library:
+
+    python -m pmb_core.audio.sidecar [audio_dir]
+"""
+
+import os
+import subprocess as sp
+import sys
+from pathlib import Path
+
+import numpy as np
+
+SAMPLE_RATE = 48000
+PREFIX = ".pcm_"
+
+# Whether ingest also writes the stereo sidecar. Only the Discord stack plays
+# true stereo, so the Mumble stack leaves this off and keeps just the mono one.
+STEREO = os.getenv("PCM_SIDECAR_STEREO", "").lower() in ("1", "true", "yes")
+
+AUDIO_EXTENSIONS = (".mp3", ".wav")
+
+
+def sidecar_path(clip_path, channels=1):
+    clip_path = Path(clip_path)
+    return clip_path.with_name(
+        "{0}{1}.{2}ch.s16le".format(PREFIX, clip_path.name, channels)
+    )
+
+
+def is_fresh(clip_path, channels=1):
+    """True if the sidecar exists and was decoded from the clip as it is now."""
+    try:
+        return (
+            os.stat(sidecar_path(clip_path, channels)).st_mtime_ns
+            == os.stat(clip_path).st_mtime_ns
+        )
+    except OSError:
+        return False
+
+
+def load(clip_path, channels=1):
+    """Memory-map a fresh sidecar as an int16 array (frames * channels samples),
+    or None if it's missing or stale. The mapping stays valid even if the
+    sidecar is replaced afterwards (it pins the old inode)."""
+    if not is_fresh(clip_path, channels):
+        return None
+    path = sidecar_path(clip_path, channels)
+    try:
+        if os.path.getsize(path) == 0:
+            return np.zeros(0, dtype="<i2")
+        return np.memmap(path, dtype="<i2", mode="r")
+    except (OSError, ValueError):
+        return None
+
+
+def source_mtime(clip_path):
+    """The clip's mtime as ``store`` expects it (None if the clip is gone)."""
+    try:
+        return os.stat(clip_path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def store(clip_path, pcm, channels=1, mtime_ns=None):
+    """Write already-decoded PCM as the clip's sidecar (atomically, so a reader
+    never maps a half-written file). ``mtime_ns`` is ``source_mtime`` taken
+    before decoding started, so a rewrite mid-decode leaves the sidecar stale
+    rather than wrong. Best-effort: returns False on failure."""
+    path = sidecar_path(clip_path, channels)
+    tmp = path.with_name(path.name + ".tmp{0}".format(os.getpid()))
+    try:
+        if mtime_ns is None:
+            mtime_ns = os.stat(clip_path).st_mtime_ns
+        with open(tmp, "wb") as f:
+            f.write(pcm)
+        os.utime(tmp, ns=(mtime_ns, mtime_ns))
+        os.replace(tmp, path)
+        return True
+    except OSError:
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+        return False
+
+
+def decode(clip_path, channels=1):
+    """Decode a clip to 48kHz s16le with ffmpeg. Returns bytes, or None if
+    ffmpeg can't read it."""
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-i",
+        str(clip_path),
+        "-ac",
+        str(channels),
+        "-ar",
+        str(SAMPLE_RATE),
+        "-f",
+        "s16le",
+        "-",
+    ]
+    proc = sp.run(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
+    if proc.returncode != 0:
+        print("FFMPEG ERROR:", proc.stderr.decode()[:500])
+        return None
+    return proc.stdout
+
+
+def write(clip_path, stereo=None):
+    """Ingest step: (re)write the clip's sidecars from the current file — mono
+    always, stereo too if ``stereo`` (defaults to PCM_SIDECAR_STEREO). Returns
+    True if every requested sidecar was written."""
+    if stereo is None:
+        stereo = STEREO
+    mtime_ns = source_mtime(clip_path)
+    if mtime_ns is None:
+        return False
+    ok = True
+    for channels in (1, 2) if stereo else (1,):
+        pcm = decode(clip_path, channels)
+        ok = pcm is not None and store(clip_path, pcm, channels, mtime_ns) and ok
+    return ok
+
+
+def remove(clip_path):
+    """Delete a clip's sidecars (on delete). Missing ones are fine."""
+    for channels in (1, 2):
+        try:
+            sidecar_path(clip_path, channels).unlink()
+        except OSError:
+            pass
+
+
+def move(old_clip_path, new_clip_path):
+    """Carry a clip's sidecars over a rename (the clip keeps its mtime, so they
+    stay fresh). Missing ones are fine."""
+    for channels in (1, 2):
+        try:
+            os.replace(
+                sidecar_path(old_clip_path, channels),
+                sidecar_path(new_clip_path, channels),
+            )
+        except OSError:
+            pass
+
+
+def backfill(audio_dir, stereo=None):
+    """Write sidecars for every clip in ``audio_dir`` that lacks a fresh one
+    (hidden files — backups, sidecars, temp renders — are skipped). Returns
+    counts, like ClipsService.renormalize_all."""
+    if stereo is None:
+        stereo = STEREO
+    written = skipped = failed = 0
+    for path in sorted(Path(audio_dir).iterdir()):
+        if path.name.startswith(".") or path.suffix.lower() not in AUDIO_EXTENSIONS:
+            continue
+        channel_sets = (1, 2) if stereo else (1,)
+        if all(is_fresh(path, channels) for channels in channel_sets):
+            skipped += 1
+        elif write(path, stereo):
+            written += 1
+        else:
+            failed += 1
+    return {"written": written, "skipped": skipped, "failed": failed}
+
+
+if __name__ == "__main__":
+    audio_dir = sys.argv[1] if len(sys.argv) > 1 else "audio"
+    print(backfill(audio_dir))
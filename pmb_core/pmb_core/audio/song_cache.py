@@ -0,0 +1,117 @@
+"""Parsed-song cache: a MIDI file's note table, lines and summary, on disk.
+
+Every song play used to run the whole .mid back through mido, and the web did
+the same for every lines request. A parsed song is small and only changes when
+the file does, so it's stored once next to the songs, keyed by a hash of the
+file's *content* (so it survives renames and is shared by every process):
+
+    audio/music/.parsed/<sha1>.npz
+
+An entry is an uncompressed ``.npz`` holding the structured note array
+(``midi.NOTE_DTYPE``) and a small JSON blob with the lines and summary, so a
+hit is one file read and no Python-level work per note. Writes go through a
+private temp file and ``os.replace``, like the render cache. The web stores an
+entry when a song is uploaded and removes it when the song is deleted; the bots
+fill in anything missing the first time they play a song.
+"""
+
+import io
+import json
+import os
+import uuid
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+from pmb_core.audio import midi
+from pmb_core.audio.render_cache import content_hash
+
+DIR_NAME = ".parsed"
+SUFFIX = ".npz"
+
+# Bump when the parser's output changes, so old entries stop matching.
+FORMAT_VERSION = 1
+
+ParsedSong = namedtuple("ParsedSong", ["notes", "lines", "summary"])
+
+
+def cache_path(song_path):
+    """Where ``song_path``'s entry lives (None if the file can't be read)."""
+    digest = content_hash(song_path)
+    if digest is None:
+        return None
+    return (
+        Path(song_path).parent
+        / DIR_NAME
+        / "{0}.v{1}{2}".format(digest, FORMAT_VERSION, SUFFIX)
+    )
+
+
+def load(song_path):
+    """The cached ParsedSong for the file as it is now, or None on a miss."""
+    path = cache_path(song_path)
+    if path is None:
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as entry:
+            notes = entry["notes"]
+            meta = json.loads(entry["meta"].tobytes().decode())
+    except (OSError, ValueError, KeyError):
+        return None
+    if notes.dtype != midi.NOTE_DTYPE:
+        return None
+    summary = meta["summary"]
+    return ParsedSong(
+        midi.NoteTable(notes, summary["track_count"]), meta["lines"], summary
+    )
+
+
+def store(song_path, notes):
+    """Cache an already-parsed ``NoteTable`` for ``song_path`` and return it as
+    a ParsedSong. Best-effort: a failed write just means no caching."""
+    parsed = ParsedSong(notes, notes.lines(), notes.summary())
+    path = cache_path(song_path)
+    if path is None:
+        return parsed
+    meta = json.dumps({"lines": parsed.lines, "summary": parsed.summary}).encode()
+    buf = io.BytesIO()
+    np.savez(buf, notes=notes.notes, meta=np.frombuffer(meta, dtype=np.uint8))
+    tmp = path.with_name(".{0}.{1}.tmp".format(path.name, uuid.uuid4().hex))
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp, "wb") as f:
+            f.write(buf.getvalue())
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+    return parsed
+
+
+def parse(song_path):
+    """``song_path`` as a ParsedSong — from the cache if it's there, otherwise
+    parsed with mido and cached. Raises whatever mido does on a bad file."""
+    parsed = load(song_path)
+    if parsed is None:
+        parsed = store(song_path, midi.parse_midi_table(str(song_path)))
+    return parsed
+
+
+def warm(song_path):
+    """Make sure ``song_path`` is cached (for running the parse in a render
+    worker; the caller then ``load``s it)."""
+    parse(song_path)
+
+
+def remove(song_path):
+    """Drop ``song_path``'s entry (call before deleting the file — the key is
+    its content). Missing entries are fine."""
+    path = cache_path(song_path)
+    if path is not None:
+        try:
+            path.unlink()
+        except OSError:
+            pass
@@ -0,0 +1,129 @@
+"""Finished-song cache: whole finalized song renders, on disk.
+
+The jukebox replays the same song on the same clips with the same settings
+over and over, and every play used to redo the note placement, the mix and the
+loudness pass. A finished render is stored under the shared audio volume:
+
+    audio/.song_renders/<sha1>.s16le
+
+keyed by the song file's content hash, the content hash of every clip it plays
+on, the render kind/channels and every parameter that changes the bytes
+(transpose, speed, max_seconds, per-line gains). The playback volume is not in
+the key: finalize applies it after normalising, so renders are cached at unit
+volume and scaled on the way out, like clip renders.
+
+It's a ``render_cache.RenderCache`` in its own directory with its own budget, so
+entries are written atomically, every process shares them, and the least
+recently played songs are evicted once ``SONG_RENDER_CACHE_MAX_BYTES`` is hit.
+A song never sits in memory whole on its way in or out: ``record`` appends each
+finalized window to the entry's temp file as it's played, and ``play`` reads
+windows out of a memory map of the entry.
+
+    cache = song_render_cache.for_audio_dir(audio_dir)
+    key = song_render_cache.key(song_path, clips, kind, channels, params)
+    chunks = song_render_cache.play(cache, key, volume, window_bytes)
+    if chunks is None:  # miss: render, finalize at unit volume, and record it
+        chunks = song_render_cache.record(cache, key, finalized, volume)
+"""
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+from pmb_core.audio import engine, loudness, transform
+from pmb_core.audio.render_cache import RenderCache, content_hash
+
+DIR_NAME = ".song_renders"
+
+# A 3 minute song is ~17MB mono (Mumble) or ~35MB stereo (Discord).
+SONG_RENDER_CACHE_MAX_BYTES = int(
+    os.getenv("SONG_RENDER_CACHE_MAX_BYTES", str(1024 * 1024 * 1024))
+)
+
+# Bump when the song renderer's output changes, so old renders stop matching.
+FORMAT_VERSION = 2
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def for_audio_dir(audio_dir):
+    """The process-wide song cache living under ``audio_dir``."""
+    directory = Path(audio_dir) / DIR_NAME
+    with _caches_lock:
+        cache = _caches.get(str(directory))
+        if cache is None:
+            cache = _caches[str(directory)] = RenderCache(
+                directory, max_bytes=SONG_RENDER_CACHE_MAX_BYTES
+            )
+        return cache
+
+
+def key(song_path, clip_paths, kind, channels, params):
+    """Cache key for a song rendered on ``clip_paths`` with ``params`` (a
+    JSON-able dict of everything else that changes the output). None if the
+    song or any clip can't be read."""
+    hashes = [content_hash(p) for p in [song_path, *clip_paths]]
+    if None in hashes:
+        return None
+    raw = json.dumps(
+        {
+            "song": hashes[0],
+            "clips": hashes[1:],
+            "kind": kind,
+            "channels": channels,
+            "params": params,
+            "engine": transform.ENGINE,
+            "resampler": transform.PITCH_RESAMPLER,
+            "loudnorm": loudness.SONG_LOUDNORM,
+            "v": FORMAT_VERSION,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+
+def play(cache, key, volume, window_bytes):
+    """A hit as a generator of ``window_bytes`` chunks with ``volume`` applied
+    (so the first one is ready straight away), plus the song's length in bytes;
+    ``(None, 0)`` on a miss."""
+    mapped = cache.map(key) if key is not None else None
+    if mapped is None:
+        cache.misses += 1
+        return None, 0
+    cache.hits += 1
+    return _windows(mapped, volume, window_bytes), len(mapped)
+
+
+def record(cache, key, chunks, volume):
+    """Pass unit-volume finalized ``chunks`` through with ``volume`` applied,
+    writing each to the cache as it goes; the song is stored once the last
+    chunk is through. A song that's skipped (the generator is closed early)
+    isn't stored."""
+    writer = cache.open_writer(key) if key is not None else None
+    complete = False
+    try:
+        for chunk in chunks:
+            if writer is not None:
+                writer.write(chunk)
+            yield engine.apply_volume(chunk, volume)
+        complete = True
+    finally:
+        close = getattr(chunks, "close", None)
+        if close is not None:
+            close()
+        if writer is not None:
+            if complete:
+                writer.commit()
+            else:
+                writer.discard()
+
+
+def _windows(mapped, volume, window_bytes):
+    try:
+        for pos in range(0, len(mapped), window_bytes):
+            yield engine.apply_volume(mapped[pos : pos + window_bytes], volume)
+    finally:
+        mapped.close()
@@ -1,11 +1,40 @@
 import math
+import os
 import subprocess as sp
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from pmb_core.audio import engine, sidecar
 
 # Filter prefixes. RESAMPLE_FILTER preserves duration while shifting pitch;
 # SETRATE_FILTER changes both rate and pitch (used for musical note rendering).
 RESAMPLE_FILTER = "aresample=48000*"
 SETRATE_FILTER = "asetrate=48000/"
 
+# "numpy" (default) decodes each source once and does pitch/speed in-process via
+# pmb_core.audio.engine; "ffmpeg" keeps the old one-process-per-render path.
+ENGINE = os.getenv("PMB_TRANSFORM_ENGINE", "numpy")
+
+# Interpolator for song-instrument pitch ladders (``transform_pitch_variants``):
+# "linear" (fast, the default) or "sinc" (polyphase windowed-sinc, no aliasing
+# on big upward shifts, a few times slower — renders are cached either way).
+PITCH_RESAMPLER = os.getenv("PMB_PITCH_RESAMPLER", "linear")
+
+# Streaming renders yield PCM in pieces of this size: 100ms of 48kHz mono
+# (50ms stereo), a whole number of frames for either channel count.
+STREAM_CHUNK_BYTES = 9600
+
+# Decoded 48kHz sources for clips whose sidecar couldn't be written (e.g. a
+# read-only mount), so re-rendering at another pitch/speed doesn't decode again.
+# Keyed by (path, mtime, channels) — a trim/re-upload changes the mtime — and
+# bounded by total bytes (~10s mono clip = ~1MB).
+DECODED_CACHE_MAX_BYTES = 32 * 1024 * 1024
+_decoded = OrderedDict()
+_decoded_bytes = 0
+_decoded_lock = threading.Lock()
+
 
 def _atempo_chain(required_tempo):
     # Api limitations for speed change in range (0.5, 2).
@@ -92,6 +121,43 @@ def generate_standard_filter(volume, speed, shift, reverse=False):
     return ",".join(parts)
 
 
+def decode_pcm(file, channels=1):
+    """Decode an audio file to 48kHz s16le PCM with `channels` channels.
+
+    A fresh sidecar (see pmb_core.audio.sidecar) is memory-mapped and returned
+    as-is. Otherwise the file is decoded and the result written back as its
+    sidecar; only if that write fails is it kept in an in-process LRU, per
+    (file, mtime, channels), so it isn't decoded again. Returns a bytes-like
+    buffer, or b"" if ffmpeg can't read the file."""
+    global _decoded_bytes
+    mapped = sidecar.load(file, channels)
+    if mapped is not None:
+        return mapped if len(mapped) else b""
+
+    mtime_ns = sidecar.source_mtime(file)
+    key = (str(file), mtime_ns, channels)
+    with _decoded_lock:
+        pcm = _decoded.get(key)
+        if pcm is not None:
+            _decoded.move_to_end(key)
+            return pcm
+
+    pcm = sidecar.decode(file, channels)
+    if pcm is None:
+        return b""
+    if mtime_ns is not None and sidecar.store(file, pcm, channels, mtime_ns):
+        return pcm  # the next decode maps the sidecar
+
+    with _decoded_lock:
+        if key not in _decoded:
+            _decoded[key] = pcm
+            _decoded_bytes += len(pcm)
+        while _decoded_bytes > DECODED_CACHE_MAX_BYTES and len(_decoded) > 1:
+            _, evicted = _decoded.popitem(last=False)
+            _decoded_bytes -= len(evicted)
+    return pcm
+
+
 def transform_audio(
     file,
     pitch_filter,
@@ -102,6 +168,15 @@ def transform_audio(
     output_file=None,
     reverse=False,
 ):
+    if (
+        desired_output == "pcm"
+        and ENGINE == "numpy"
+        and pitch_filter == RESAMPLE_FILTER
+    ):
+        return transform_audio_variants(
+            file, pitch_filter, [(speed, shift, reverse, volume)]
+        )[0]
+
     filter = generate_filter(pitch_filter, volume, speed, shift, reverse)
 
     if desired_output == "pcm":
@@ -110,16 +185,207 @@ def transform_audio(
         return transform_as_wav(file, filter, output_file)
 
 
+def transform_audio_variants(file, pitch_filter, variants):
+    """Render several (speed, shift, reverse, volume) variants of one file as
+    PCM (`transform_audio` semantics), decoding the source once. Returns one
+    buffer per variant, in order."""
+    if ENGINE != "numpy" or pitch_filter != RESAMPLE_FILTER:
+        return [
+            transform_as_pcm_data(
+                file, generate_filter(pitch_filter, volume, speed, shift, reverse)
+            )
+            for speed, shift, reverse, volume in variants
+        ]
+    samples = engine.from_pcm(decode_pcm(file, channels=1))
+    return [
+        engine.to_pcm(engine.render_resample(samples, volume, speed, shift, reverse))
+        for speed, shift, reverse, volume in variants
+    ]
+
+
+def transform_standard_variants(file, variants, channels=2):
+    """`transform_standard_pcm` for several (speed, shift, reverse, volume)
+    variants of one file, decoding the source once. Returns one buffer per
+    variant, in order."""
+    if ENGINE != "numpy":
+        return [
+            _transform_standard_ffmpeg(file, volume, speed, shift, reverse, channels)
+            for speed, shift, reverse, volume in variants
+        ]
+    samples = engine.from_pcm(decode_pcm(file, channels), channels)
+    return [
+        engine.to_pcm(engine.render_standard(samples, volume, speed, shift, reverse))
+        for speed, shift, reverse, volume in variants
+    ]
+
+
+def transform_pitch_variants(file, variants, channels=1):
+    """Sampler-style renders of one file for several (speed, shift, reverse,
+    volume) variants — the shift moves pitch *and* length together and
+    ``speed`` is ignored — from a single decode, as true 48kHz PCM with
+    `channels` channels. This is what song notes use: they're capped to the
+    note's length anyway, so there's no point preserving the clip's tempo.
+    Returns one buffer per variant, in order."""
+    if ENGINE != "numpy":
+        # A speed equal to the pitch ratio makes the filter graphs' atempo a
+        # no-op, which leaves just the resample.
+        if channels == 1:
+            return [
+                transform_as_pcm_data(
+                    file,
+                    generate_filter(
+                        RESAMPLE_FILTER, volume, 2 ** (shift / 12), shift, reverse
+                    ),
+                )
+                for _speed, shift, reverse, volume in variants
+            ]
+        return [
+            _transform_standard_ffmpeg(
+                file, volume, 2 ** (shift / 12), shift, reverse, channels
+            )
+            for _speed, shift, reverse, volume in variants
+        ]
+    samples = engine.from_pcm(decode_pcm(file, channels), channels)
+    shifts = [shift for _speed, shift, _reverse, _volume in variants]
+    ladder = engine.pitch_ladder(samples, shifts, PITCH_RESAMPLER)
+    out = []
+    for rendered, (_speed, _shift, reverse, volume) in zip(ladder, variants):
+        rendered = rendered * np.float32(volume) if volume != 1.0 else rendered
+        out.append(engine.to_pcm(rendered[::-1] if reverse else rendered))
+    return out
+
+
+def transform_standard_pcm(file, volume, speed, shift, reverse=False, channels=2):
+    """True 48kHz s16le PCM with `generate_standard_filter` semantics (the
+    Discord path), rendered in-process unless ENGINE is "ffmpeg"."""
+    return transform_standard_variants(
+        file, [(speed, shift, reverse, volume)], channels
+    )[0]
+
+
+def transform_audio_stream(
+    file, pitch_filter, volume, speed, shift, reverse=False, chunk_bytes=None
+):
+    """`transform_audio` PCM as a generator of chunks, so a consumer can start
+    playing before the render has finished. The ffmpeg path yields as ffmpeg
+    writes; the engine renders a clip in a few ms, so it yields slices of the
+    finished render."""
+    chunk_bytes = chunk_bytes or STREAM_CHUNK_BYTES
+    if ENGINE == "numpy" and pitch_filter == RESAMPLE_FILTER:
+        yield from _slices(
+            transform_audio(file, pitch_filter, volume, speed, shift, reverse=reverse),
+            chunk_bytes,
+        )
+        return
+    audio_filter = generate_filter(pitch_filter, volume, speed, shift, reverse)
+    yield from _stream_ffmpeg(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-i",
+            str(file),
+            "-filter_complex",
+            audio_filter,
+            "-ac",
+            "1",
+            "-f",
+            "s16le",
+            "-",
+        ],
+        chunk_bytes,
+    )
+
+
+def transform_standard_stream(
+    file, volume, speed, shift, reverse=False, channels=2, chunk_bytes=None
+):
+    """`transform_standard_pcm` as a generator of chunks (see
+    `transform_audio_stream`)."""
+    chunk_bytes = chunk_bytes or STREAM_CHUNK_BYTES
+    if ENGINE == "numpy":
+        yield from _slices(
+            transform_standard_pcm(file, volume, speed, shift, reverse, channels),
+            chunk_bytes,
+        )
+        return
+    audio_filter = generate_standard_filter(volume, speed, shift, reverse)
+    yield from _stream_ffmpeg(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-i",
+            str(file),
+            "-af",
+            audio_filter,
+            "-ar",
+            str(engine.SAMPLE_RATE),
+            "-ac",
+            str(channels),
+            "-f",
+            "s16le",
+            "-",
+        ],
+        chunk_bytes,
+    )
+
+
+def _slices(pcm, chunk_bytes):
+    for start in range(0, len(pcm), chunk_bytes):
+        yield pcm[start : start + chunk_bytes]
+
+
+def _stream_ffmpeg(cmd, chunk_bytes):
+    """Run ffmpeg, yielding its stdout in `chunk_bytes` pieces as it's written.
+    Closing the generator early kills ffmpeg."""
+    proc = sp.Popen(cmd, stdout=sp.PIPE, stderr=sp.PIPE)
+    try:
+        while True:
+            chunk = proc.stdout.read(chunk_bytes)
+            if not chunk:
+                break
+            yield chunk
+        err = proc.stderr.read()
+        if proc.wait() != 0:
+            print("FFMPEG ERROR:", err.decode()[:500])
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+
+
+def _transform_standard_ffmpeg(file, volume, speed, shift, reverse, channels):
+    return b"".join(
+        transform_standard_stream(file, volume, speed, shift, reverse, channels)
+    )
+
+
 def transform_as_pcm_data(file, filter):
-    encode_command = (
-        "ffmpeg -hide_banner -loglevel error -i {0} "
-        "-filter_complex {1} -ac 1 -f s16le -".format(file, filter)
+    return b"".join(
+        _stream_ffmpeg(
+            [
+                "ffmpeg",
+                "-hide_banner",
+                "-loglevel",
+                "error",
+                "-i",
+                str(file),
+                "-filter_complex",
+                filter,
+                "-ac",
+                "1",
+                "-f",
+                "s16le",
+                "-",
+            ],
+            STREAM_CHUNK_BYTES,
+        )
     )
-    proc = sp.Popen(encode_command.split(" "), stdout=sp.PIPE, stderr=sp.PIPE)
-    out, err = proc.communicate()
-    if proc.returncode != 0:
-        print("FFMPEG ERROR:", err.decode()[:500])
-    return out
 
 
 def transform_as_wav(input, filter, output):
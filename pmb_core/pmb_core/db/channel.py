@@ -0,0 +1,247 @@
+"""A direct web-to-bot channel for ``pending_commands``, alongside Mongo.
+
+Even with push delivery (see ``commands``) a command reaches a bot through
+Mongo: the web inserts it, the insert (or the doorbell) wakes the bot's feed,
+and the bot claims it back. When the web and a bot share a host, the web can
+hand the command over itself. Each bot binds a Unix datagram socket on the
+shared audio volume,
+
+    audio/.command_channel/<name>.sock
+
+and announces it in the ``command_channels`` collection. Once the web has
+written a command's durable ``pending_commands`` doc it sends the command, with
+its ``_id``, to every announced socket: one datagram per enqueue, so a queue's
+commands arrive together. The bot's ``Listener`` hands them straight to the
+bot, which runs them without waiting for its feed.
+
+Mongo stays the durable log and nothing else changes: the bot still claims
+every command from it, and ``Seen`` drops whichever copy of a command arrives
+second, by ``_id``. Sending is best-effort and never blocks. No announcement, a
+stale socket (the bot is down, or on another host), a full socket buffer or an
+oversized datagram all leave the command to Mongo alone.
+``PMB_COMMAND_CHANNEL=false`` turns the channel off on either side.
+
+    listener = channel.Listener(db, "mumble", "audio", run).start()  # a bot
+    channel.Sender().send(db, [command])  # the web, after inserting it
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from pathlib import Path
+
+from bson import json_util
+from bson.errors import BSONError
+from pymongo.errors import PyMongoError
+
+log = logging.getLogger("pmb.channel")
+
+ENABLED = os.getenv("PMB_COMMAND_CHANNEL", "true").lower() in ("1", "true", "yes")
+
+CHANNELS = "command_channels"
+DIR_NAME = ".command_channel"
+
+# The biggest datagram sent or read. A bigger enqueue (a very long generated
+# queue) just goes through Mongo.
+MAX_DATAGRAM = 64 * 1024
+
+# How long the web trusts its copy of the announcements before re-reading them.
+REFRESH_SECONDS = 5.0
+
+# How many command ids a bot remembers, to drop the second copy of each.
+SEEN_MAX = 4096
+
+# How often the listener checks whether it has been stopped.
+_TIMEOUT_SECONDS = 1.0
+
+# Commands use naive UTC datetimes throughout.
+_JSON_OPTIONS = json_util.JSONOptions(tz_aware=False)
+
+
+def encode(commands):
+    return json_util.dumps(list(commands), json_options=_JSON_OPTIONS).encode()
+
+
+def decode(data):
+    return json_util.loads(data, json_options=_JSON_OPTIONS)
+
+
+class Seen:
+    """The ids of the commands a bot has taken on, so a command arriving both
+    directly and from Mongo runs once. Thread-safe."""
+
+    def __init__(self, limit=SEEN_MAX):
+        self.limit = limit
+        self._ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def fresh(self, commands):
+        """The commands not seen before, in order. They're seen from now on."""
+        fresh = []
+        with self._lock:
+            for command in commands:
+                command_id = command.get("_id")
+                if command_id in self._ids:
+                    continue
+                if command_id is not None:
+                    self._ids[command_id] = None
+                fresh.append(command)
+            while len(self._ids) > self.limit:
+                self._ids.popitem(last=False)
+        return fresh
+
+
+class Listener:
+    """A bot's end: ``start`` binds ``<audio_dir>/.command_channel/<name>.sock``
+    and announces it, then ``handle`` is called (on the listener's thread) with
+    each datagram's list of commands. ``stop`` withdraws the announcement and
+    the socket. If the socket can't be bound the bot just runs without it."""
+
+    def __init__(self, db, name, audio_dir, handle):
+        self._db = db
+        self.name = name
+        self.path = (Path(audio_dir) / DIR_NAME / "{0}.sock".format(name)).resolve()
+        self._handle = handle
+        self._sock = None
+        self._inode = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if not ENABLED or self._thread is not None:
+            return self
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.unlink(missing_ok=True)  # left by a previous run
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(str(self.path))
+            sock.settimeout(_TIMEOUT_SECONDS)
+            self._inode = os.stat(self.path).st_ino
+        except OSError:
+            log.warning(
+                "channel: couldn't bind %s, commands come through Mongo only",
+                self.path,
+                exc_info=True,
+            )
+            return self
+        self._sock = sock
+        self._thread = threading.Thread(
+            target=self._read, name="pmb-command-channel", daemon=True
+        )
+        self._thread.start()
+        try:
+            self._db[CHANNELS].replace_one(
+                {"_id": self.name},
+                {
+                    "path": str(self.path),
+                    "host": socket.gethostname(),
+                    "pid": os.getpid(),
+                    "started_at": datetime.utcnow(),
+                },
+                upsert=True,
+            )
+            log.info("channel: listening on %s", self.path)
+        except PyMongoError:
+            log.warning("channel: couldn't announce %s", self.path, exc_info=True)
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        try:
+            self._db[CHANNELS].delete_one({"_id": self.name, "path": str(self.path)})
+        except PyMongoError:
+            pass
+        if self._thread is not None:
+            # An empty datagram wakes the reader, which closes the socket.
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as wake:
+                try:
+                    wake.sendto(b"", str(self.path))
+                except OSError:
+                    pass
+            self._thread.join(_TIMEOUT_SECONDS)
+
+    def _read(self):
+        try:
+            while not self._stopped.is_set():
+                try:
+                    data = self._sock.recv(MAX_DATAGRAM)
+                except socket.timeout:
+                    continue
+                except OSError:
+                    log.warning("channel: %s failed", self.path, exc_info=True)
+                    return
+                if not data:
+                    continue
+                try:
+                    commands = decode(data)
+                except (ValueError, BSONError):
+                    commands = None
+                if not isinstance(commands, list):
+                    log.warning("channel: dropped a malformed datagram")
+                    continue
+                try:
+                    self._handle(commands)
+                except Exception:
+                    log.exception("channel: handling direct commands failed")
+        finally:
+            self._sock.close()
+            self._unlink()
+
+    def _unlink(self):
+        # Only if it's still this listener's socket, not a newer one's.
+        try:
+            if os.stat(self.path).st_ino == self._inode:
+                os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class Sender:
+    """The web's end: ``send`` hands commands that are already in Mongo to every
+    announced bot socket. Never raises, never blocks."""
+
+    def __init__(self, refresh=REFRESH_SECONDS, clock=time.monotonic):
+        self.refresh = refresh
+        self._clock = clock
+        self._paths = []
+        self._fetched_at = None
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def send(self, db, commands):
+        """Returns how many bots took the commands."""
+        if not ENABLED:
+            return 0
+        data = encode(commands)
+        if len(data) > MAX_DATAGRAM:
+            return 0
+        sent = 0
+        with self._lock:
+            for path in self._announced(db):
+                try:
+                    self._socket().sendto(data, path)
+                    sent += 1
+                except OSError:
+                    pass  # down, elsewhere or backed up: it's in Mongo anyway
+        return sent
+
+    def _announced(self, db):
+        now = self._clock()
+        if self._fetched_at is None or now - self._fetched_at >= self.refresh:
+            try:
+                docs = db[CHANNELS].find({}, {"path": 1})
+                self._paths = [doc["path"] for doc in docs if doc.get("path")]
+            except PyMongoError:
+                self._paths = []
+            self._fetched_at = now
+        return self._paths
+
+    def _socket(self):
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.setblocking(False)
+        return self._sock
@@ -0,0 +1,276 @@
+"""Push delivery of ``pending_commands`` to the bots.
+
+The bots used to poll ``pending_commands`` with ``find_one_and_update`` (Mumble
+every 20ms, Discord every 100ms) whether or not anything had been queued, and
+every web play waited for the next poll. A ``CommandFeed`` tells its consumer
+when a command has been queued instead, so it only claims when there's
+something to claim. The transports, in the order ``auto`` tries them:
+
+- ``change_stream``: a change stream on ``pending_commands`` inserts (needs a
+  replica set, even a single-member one);
+- ``tailable``: a tailable cursor on the capped ``command_signals`` collection,
+  which the web ``ring``s after every insert (works on a standalone mongod);
+- ``poll``: neither is available, so it polls, backing off exponentially from
+  ``POLL_FLOOR_SECONDS`` to ``POLL_CEILING_SECONDS`` while idle.
+
+``PMB_COMMAND_TRANSPORT`` pins one. If a push transport drops (the server went
+away, the stream was invalidated), the feed polls until it's back. Even while
+push is live the consumer claims every ``RECHECK_SECONDS``, as a safety net for
+a wakeup lost in a reconnect. The claim itself is a leased batch
+(``MongoInterface.claim_pending_commands``), so any number of consumers stay
+safe.
+
+Commands are queued in one of two lanes, by their ``priority``. The ``CONTROL``
+lane (stop, skip, restart, leave) is claimed ahead of everything else, and a
+bot claims it on a feed of its own, so a stop isn't stuck behind a backlog of
+plays the bot is still working through. A stop supersedes the plays queued
+before it (``superseded``): the bot drops any it has yet to play.
+
+    feed = commands.CommandFeed(db)
+    feed.start()
+    while True:
+        feed.wait()  # or, from a tick loop: if not feed.due(): return
+        batch = claim()
+        feed.claimed(bool(batch))
+"""
+
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+import pymongo
+from pymongo.errors import CollectionInvalid, OperationFailure, PyMongoError
+
+log = logging.getLogger("pmb.commands")
+
+AUTO = "auto"
+CHANGE_STREAM = "change_stream"
+TAILABLE = "tailable"
+POLL = "poll"
+
+TRANSPORT = os.getenv("PMB_COMMAND_TRANSPORT", AUTO)
+
+# The doorbell collection for the tailable transport: capped, so it never grows.
+SIGNALS = "command_signals"
+SIGNALS_BYTES = 1024 * 1024
+SIGNALS_MAX = 1000
+
+POLL_FLOOR_SECONDS = 0.02
+POLL_CEILING_SECONDS = 2.0
+RECHECK_SECONDS = 5.0
+
+# How long the watcher waits before reopening a stream or cursor that died, and
+# how long a blocking read on one may take (so ``stop`` is noticed).
+_RETRY_SECONDS = 1.0
+_AWAIT_MS = 1000
+
+# Priority lanes: ``CONTROL`` commands are claimed first. A doc queued before
+# there were lanes has no ``priority`` and goes with ``NORMAL``.
+CONTROL = 1
+NORMAL = 0
+CONTROL_TYPES = ("stop", "skip_song", "restart", "leave")
+
+# What a stop (or restart) cancels, if it was queued before it.
+STOPPABLE_TYPES = ("play", "queue_play", "play_song", "clip_capture")
+STOPPING_TYPES = ("stop", "restart")
+
+
+def priority(command_type):
+    return CONTROL if command_type in CONTROL_TYPES else NORMAL
+
+
+def is_control(command):
+    return command.get("type", "play") in CONTROL_TYPES
+
+
+def superseded(command, stopped_at):
+    """Whether ``command`` was queued before the stop queued at ``stopped_at``
+    (``None``: no stop yet), so shouldn't play."""
+    created = command.get("created_at")
+    return (
+        stopped_at is not None
+        and isinstance(created, datetime)
+        and command.get("type", "play") in STOPPABLE_TYPES
+        and created <= stopped_at
+    )
+
+
+def ensure_signals(db):
+    """Create the capped ``command_signals`` collection if it's missing. Returns
+    whether it's there and capped (so it can be tailed)."""
+    try:
+        db.create_collection(SIGNALS, capped=True, size=SIGNALS_BYTES, max=SIGNALS_MAX)
+    except CollectionInvalid:
+        pass  # already exists
+    except PyMongoError:
+        return False
+    try:
+        return bool(db[SIGNALS].options().get("capped"))
+    except PyMongoError:
+        return False
+
+
+def ring(db):
+    """Wake tailable-transport consumers after queuing a command. Best-effort:
+    if it's lost, the consumer's recheck still picks the command up."""
+    try:
+        db[SIGNALS].insert_one({"at": datetime.utcnow()})
+    except PyMongoError:
+        log.warning("commands: couldn't ring %s", SIGNALS, exc_info=True)
+
+
+class CommandFeed:
+    """Tells a consumer when to claim from ``pending_commands``: ``due`` (for a
+    tick loop) or ``wait`` (blocking) say it's time, and ``claimed`` reports
+    whether the claim found anything. A background thread holds the push
+    transport open; ``transport`` is the one currently in use."""
+
+    def __init__(
+        self,
+        db,
+        transport=None,
+        floor=POLL_FLOOR_SECONDS,
+        ceiling=POLL_CEILING_SECONDS,
+        recheck=RECHECK_SECONDS,
+        clock=time.monotonic,
+    ):
+        self._db = db
+        self.requested = transport or TRANSPORT
+        self.transport = POLL
+        self.floor = floor
+        self.ceiling = ceiling
+        self.recheck = recheck
+        self._clock = clock
+        self._idle = floor
+        self._next_check = clock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.requested != POLL and self._thread is None:
+            self._thread = threading.Thread(
+                target=self._watch, name="pmb-command-feed", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+    def notify(self):
+        """Claim on the next ``due``/``wait`` (a command was queued)."""
+        self._wake.set()
+
+    def due(self):
+        """Whether to claim now: woken by the transport, or the idle interval
+        is up. Never blocks."""
+        now = self._clock()
+        if self._wake.is_set() or now >= self._next_check:
+            self._wake.clear()
+            self._next_check = now + self._interval()
+            return True
+        return False
+
+    def wait(self, timeout=None):
+        """Block until it's time to claim (returns True), or ``timeout``
+        seconds pass (returns False)."""
+        deadline = None if timeout is None else self._clock() + timeout
+        while not self.due():
+            wake_at = (
+                self._next_check
+                if deadline is None
+                else min(self._next_check, deadline)
+            )
+            self._wake.wait(max(0.0, wake_at - self._clock()))
+            if deadline is not None and self._clock() >= deadline:
+                return self.due()
+        return True
+
+    def claimed(self, found):
+        """Report a claim's outcome: a hit claims again straight away (there may
+        be more queued), a miss backs the idle poll off."""
+        if found:
+            self._idle = self.floor
+            self._wake.set()
+        else:
+            self._idle = min(self.ceiling, self._idle * 2)
+        self._next_check = self._clock() + self._interval()
+
+    def _interval(self):
+        return self.recheck if self.transport != POLL else self._idle
+
+    def _set_transport(self, transport):
+        if transport != self.transport:
+            log.info("commands: delivery via %s", transport)
+            self.transport = transport
+            self._wake.set()  # catch anything queued while it switched
+
+    def _watch(self):
+        order = (
+            [CHANGE_STREAM, TAILABLE] if self.requested == AUTO else [self.requested]
+        )
+        while order and not self._stopped.is_set():
+            mode = order[0]
+            retry = True
+            try:
+                if mode == CHANGE_STREAM:
+                    self._follow_changes()
+                elif mode == TAILABLE:
+                    self._follow_signals()
+                else:
+                    raise ValueError("unknown command transport {0!r}".format(mode))
+            except PyMongoError as exc:
+                if self.transport != mode and isinstance(exc, OperationFailure):
+                    # Refused on opening (e.g. not a replica set): try the next.
+                    log.info("commands: %s unavailable (%s)", mode, exc)
+                    order.pop(0)
+                    retry = False
+                else:
+                    log.warning(
+                        "commands: %s dropped, polling until it's back",
+                        mode,
+                        exc_info=True,
+                    )
+            except (NotImplementedError, ValueError) as exc:
+                log.info("commands: %s unavailable (%s)", mode, exc)
+                order.pop(0)
+                retry = False
+            except Exception:
+                log.exception("commands: %s failed", mode)
+                order.pop(0)
+                retry = False
+            self._set_transport(POLL)
+            if retry:
+                self._stopped.wait(_RETRY_SECONDS)
+
+    def _follow_changes(self):
+        pipeline = [{"$match": {"operationType": "insert"}}]
+        with self._db.pending_commands.watch(
+            pipeline, max_await_time_ms=_AWAIT_MS
+        ) as stream:
+            self._set_transport(CHANGE_STREAM)
+            while stream.alive and not self._stopped.is_set():
+                if stream.try_next() is not None:
+                    self._wake.set()
+
+    def _follow_signals(self):
+        if not ensure_signals(self._db):
+            raise NotImplementedError("{0} isn't a capped collection".format(SIGNALS))
+        signals = self._db[SIGNALS]
+        newest = signals.find_one(sort=[("$natural", pymongo.DESCENDING)])
+        if newest is None:
+            # A tailable cursor on an empty collection dies straight away.
+            signals.insert_one({"at": datetime.utcnow()})
+            newest = signals.find_one(sort=[("$natural", pymongo.DESCENDING)])
+        cursor = signals.find(
+            {"_id": {"$gt": newest["_id"]}},
+            cursor_type=pymongo.CursorType.TAILABLE_AWAIT,
+        ).max_await_time_ms(_AWAIT_MS)
+        self._set_transport(TAILABLE)
+        while cursor.alive and not self._stopped.is_set():
+            for _signal in cursor:
+                self._wake.set()
@@ -0,0 +1,156 @@
+"""End-to-end latency tracing for ``pending_commands``.
+
+Every command the web queues carries a ``trace``: an id and the wall-clock time
+(``time.time()`` seconds; the web and the bots share a host, so a clock) the
+web accepted the request. Each side writes its own stamps for a trace to the
+capped ``latency_log`` collection. The web writes once the command is queued.
+A bot writes once it has handled the command, or for a clip play once the mixer
+has emitted the clip's first frame. The stats endpoint joins the two by trace
+id. The stages, in order:
+
+- ``accepted``: the web started handling the HTTP request;
+- ``inserted``: its ``pending_commands`` doc was written;
+- ``claimed``: a bot took it on (sent directly, or claimed from Mongo);
+- ``resolved``: the bot found the clip in its catalog;
+- ``render_start`` / ``render_end``: rendering it (or fetching it from a render
+  cache) began / its first PCM was ready;
+- ``first_frame``: the mixer emitted its first frame.
+
+Only clip plays go through every stage; other commands stop at ``claimed``.
+"""
+
+import logging
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from pymongo.errors import CollectionInvalid, PyMongoError
+
+log = logging.getLogger("pmb.latency")
+
+LATENCY_LOG = "latency_log"
+LOG_BYTES = 16 * 1024 * 1024
+LOG_MAX = 100000
+
+STAGES = [
+    "accepted",
+    "inserted",
+    "claimed",
+    "resolved",
+    "render_start",
+    "render_end",
+    "first_frame",
+]
+
+# The command types traced through to their first frame.
+CLIP_PLAYS = ("play", "queue_play")
+
+# How often a bot's writer flushes what it has buffered.
+FLUSH_SECONDS = 1.0
+
+
+def ensure_log(db):
+    """Create the capped ``latency_log`` collection if it's missing."""
+    try:
+        db.create_collection(LATENCY_LOG, capped=True, size=LOG_BYTES, max=LOG_MAX)
+    except (CollectionInvalid, NotImplementedError):
+        pass  # already exists, or a test double that can't cap
+    except PyMongoError:
+        log.warning("latency: couldn't create %s", LATENCY_LOG, exc_info=True)
+
+
+def start(accepted=None):
+    """A new command's trace, accepted at ``accepted`` (default now)."""
+    return {"id": uuid.uuid4().hex, "accepted": accepted or time.time()}
+
+
+def record(trace_id, side, command_type, stamps):
+    """The ``latency_log`` doc for one side's stamps of a trace."""
+    return {
+        "trace": trace_id,
+        "side": side,
+        "type": command_type,
+        "at": datetime.utcnow(),
+        **stamps,
+    }
+
+
+class Trace:
+    """A bot's stamps for one command, written to ``writer`` by ``finish``.
+    ``mark`` keeps a stage's first stamp and is safe from any thread. A command
+    queued without a trace (from an older web) is never written."""
+
+    def __init__(self, command, side, writer, via=None):
+        self.id = (command.get("trace") or {}).get("id")
+        self.type = command.get("type", "play")
+        self.side = side
+        self.via = via  # "direct" or "mongo": how the bot got it
+        self.stamps = {}
+        self._writer = writer
+        self._finished = False
+
+    def mark(self, stage, at=None):
+        self.stamps.setdefault(stage, at or time.time())
+        return self
+
+    def started(self):
+        """Stamp ``first_frame`` and write the trace: the mixer's callback for
+        the first frame of a traced clip."""
+        self.mark("first_frame").finish()
+
+    def finish(self):
+        if self._finished or self.id is None or self._writer is None:
+            return
+        self._finished = True
+        doc = record(self.id, self.side, self.type, dict(self.stamps))
+        if self.via is not None:
+            doc["via"] = self.via
+        self._writer.write(doc)
+
+
+class Writer:
+    """Buffers ``latency_log`` docs and inserts them from a background thread
+    every ``flush`` seconds, so stamping a stage (on the mixer thread, say)
+    never waits on Mongo. Best-effort: a failed insert is dropped."""
+
+    def __init__(self, db, flush=FLUSH_SECONDS):
+        self._db = db
+        self.flush = flush
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="pmb-latency", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def write(self, doc):
+        self._queue.put(doc)
+
+    def drain(self):
+        """Insert everything buffered now. Returns how many docs it wrote."""
+        docs = []
+        while True:
+            try:
+                docs.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if not docs:
+            return 0
+        try:
+            self._db[LATENCY_LOG].insert_many(docs, ordered=False)
+        except PyMongoError:
+            log.warning("latency: dropped %d traces", len(docs), exc_info=True)
+            return 0
+        return len(docs)
+
+    def _run(self):
+        ensure_log(self._db)
+        while True:
+            time.sleep(self.flush)
+            self.drain()
@@ -1,5 +1,6 @@
 import os
-from datetime import datetime
+import uuid
+from datetime import datetime, timedelta
 from pathlib import Path
 
 import pymongo
@@ -21,12 +22,24 @@ from pmb_core.constants import (
     NEXT_ID,
     TAGS,
 )
+from pmb_core.db import channel, commands, latency
 
 
 class MongoInterface:
     NEW_CLIPS_PATH = Path("audio/new/")
     ALL_CLIPS_PATH = Path("audio/")
 
+    # Commands are claimed in batches (a queue burst is one batch) and leased:
+    # a batch that isn't acknowledged within the lease, because its consumer
+    # died, becomes claimable again.
+    COMMAND_BATCH = 32
+    COMMAND_LEASE_SECONDS = 60
+    COMMAND_ORDER = [
+        ("priority", pymongo.DESCENDING),
+        ("created_at", pymongo.ASCENDING),
+        ("_id", pymongo.ASCENDING),
+    ]
+
     def __init__(self):
         self.client = None
         self.file_prefixes_collection = None
@@ -34,6 +47,7 @@ class MongoInterface:
         self.volume = None
         self.db_name = os.getenv(MONGODB_DATABASE, DEFAULT_DATABASE)
         self.db = None
+        self._latency_log = None
 
     def connect(self):
         self.client = pymongo.MongoClient(
@@ -195,11 +209,116 @@ class MongoInterface:
             self.db.clips.update_one({"_id": file[ID]}, {"$set": {TAGS: tags}})
         self.refresh()
 
+    def command_feed(self, transport=None):
+        """A started ``commands.CommandFeed`` telling the caller when to call
+        ``claim_pending_commands`` (instead of polling it)."""
+        return commands.CommandFeed(self.db, transport).start()
+
+    def command_channel(self, name, audio_dir, handle):
+        """A started ``channel.Listener``: commands the web sends directly to
+        this bot are passed to ``handle`` as they arrive, ahead of the copies
+        claimed from ``pending_commands``."""
+        return channel.Listener(self.db, name, audio_dir, handle).start()
+
+    def latency_log(self):
+        """This process's started ``latency.Writer``, for the bot's side of
+        each command's trace."""
+        if self._latency_log is None:
+            self._latency_log = latency.Writer(self.db).start()
+        return self._latency_log
+
     def get_next_pending_command(self):
         return self.db.pending_commands.find_one_and_update(
             {"status": "pending"},
             {"$set": {"status": "processing"}},
-            sort=[("created_at", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+            sort=self.COMMAND_ORDER,
+        )
+
+    def claim_pending_commands(self, limit=None, lane=None):
+        """Lease up to ``limit`` (default ``COMMAND_BATCH``) of the oldest
+        claimable commands (pending, or leased to a consumer whose lease ran
+        out), control commands first then oldest first, and return them;
+        ``ack_commands`` marks them done. ``lane`` (``commands.CONTROL`` or
+        ``commands.NORMAL``) claims from that lane only.
+
+        Two round trips however big the batch: read the candidates, then lease
+        the ones that are still claimable in one update. Racing consumers get
+        disjoint batches, because each command's filter is re-checked as the
+        update reaches it; only if some were taken meanwhile is a third read
+        needed, to see which this lease won."""
+        now = datetime.utcnow()
+        claimable = {
+            "$or": [
+                {"status": "pending"},
+                {"status": "processing", "lease_expires": {"$lt": now}},
+            ]
+        }
+        if lane == commands.CONTROL:
+            claimable = {**claimable, "priority": commands.CONTROL}
+        elif lane is not None:
+            claimable = {**claimable, "priority": {"$ne": commands.CONTROL}}
+        candidates = list(
+            self.db.pending_commands.find(
+                claimable, sort=self.COMMAND_ORDER, limit=limit or self.COMMAND_BATCH
+            )
+        )
+        if not candidates:
+            return []
+        lease = uuid.uuid4().hex
+        ids = [c[ID] for c in candidates]
+        result = self.db.pending_commands.update_many(
+            {"$and": [{ID: {"$in": ids}}, claimable]},
+            {
+                "$set": {
+                    "status": "processing",
+                    "lease": lease,
+                    "lease_expires": now
+                    + timedelta(seconds=self.COMMAND_LEASE_SECONDS),
+                }
+            },
+        )
+        if result.modified_count != len(ids):
+            won = {
+                c[ID] for c in self.db.pending_commands.find({"lease": lease}, {ID: 1})
+            }
+            candidates = [c for c in candidates if c[ID] in won]
+        for command in candidates:
+            command["status"] = "processing"
+            command["lease"] = lease
+        return candidates
+
+    def ack_commands(self, commands):
+        """Mark a claimed batch done, in one write. A command whose lease has
+        since passed to another consumer is left to that consumer."""
+        if not commands:
+            return
+        self.db.pending_commands.update_many(
+            {
+                ID: {"$in": [c[ID] for c in commands]},
+                "lease": {"$in": list({c["lease"] for c in commands})},
+            },
+            {"$set": {"status": "done"}, "$unset": {"lease_expires": ""}},
+        )
+
+    def mark_commands_done(self, commands):
+        """Mark commands that arrived directly (unleased) done, in one write, so
+        they aren't claimed and run again after a restart."""
+        if not commands:
+            return
+        self.db.pending_commands.update_many(
+            {ID: {"$in": [c[ID] for c in commands]}},
+            {"$set": {"status": "done"}, "$unset": {"lease_expires": ""}},
+        )
+
+    def get_pending_commands(self, cmd_type):
+        """Peek (without claiming) at the commands of one type that haven't been
+        done yet (pending, or claimed in a batch still being worked through),
+        oldest first — e.g. the rest of a generated queue, to render it ahead."""
+        return list(
+            self.db.pending_commands.find(
+                {"status": {"$in": ["pending", "processing"]}, "type": cmd_type},
+                sort=self.COMMAND_ORDER,
+            )
         )
 
     def mark_command_done(self, command_id):
@@ -0,0 +1,58 @@
+"""Tests for pmb_core.db.channel, the direct web-to-bot command channel.
+
+Real Unix sockets under ``tmp_path``; the announcements live in mongomock.
+"""
+
+import queue
+from datetime import datetime
+
+import mongomock
+import pytest
+from bson import ObjectId
+
+from pmb_core.db import channel
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient()["voice_clips"]
+
+
+@pytest.fixture
+def listener(db, tmp_path):
+    received = queue.Queue()
+    listener = channel.Listener(db, "mumble", tmp_path, received.put).start()
+    listener.received = received
+    yield listener
+    listener.stop()
+
+
+def test_sent_commands_arrive_with_their_ids_and_dates(db, listener):
+    command = {"_id": ObjectId(), "type": "play", "created_at": datetime(2026, 1, 1)}
+    assert db.command_channels.find_one({"_id": "mumble"})["path"] == str(listener.path)
+
+    assert channel.Sender().send(db, [command, {"_id": ObjectId(), "type": "stop"}])
+    first, second = listener.received.get(timeout=5)
+    assert first == command
+    assert second["type"] == "stop"
+
+
+def test_sending_is_a_no_op_when_the_bot_is_away(db, listener):
+    sender = channel.Sender(refresh=0)
+    assert channel.Sender().send(db, [{"type": "stop"}]) == 1
+    big = [{"type": "queue_play", "clip_ref": "x" * channel.MAX_DATAGRAM}]
+    assert sender.send(db, big) == 0  # too big for one datagram: Mongo only
+
+    listener.stop()
+    assert db.command_channels.count_documents({}) == 0
+    assert sender.send(db, [{"type": "stop"}]) == 0
+
+    db.command_channels.insert_one({"_id": "gone", "path": str(listener.path)})
+    assert sender.send(db, [{"type": "stop"}]) == 0  # a stale announcement
+
+
+def test_seen_drops_second_copies_and_forgets_the_oldest():
+    seen = channel.Seen(limit=2)
+    assert seen.fresh([{"_id": 1}, {"_id": 2}, {"_id": 1}]) == [{"_id": 1}, {"_id": 2}]
+    assert seen.fresh([{"_id": 2}, {"_id": 3}]) == [{"_id": 3}]
+    assert seen.fresh([{"_id": 1}]) == [{"_id": 1}]  # beyond the limit
@@ -0,0 +1,237 @@
+"""Tests for command delivery: pmb_core.db.commands (when to claim) and
+MongoInterface's leased batch claims."""
+
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+import mongomock
+import pytest
+from pymongo.errors import OperationFailure
+
+from pmb_core.db import commands
+from pmb_core.db.mongodb import MongoInterface
+
+
+class FakeTime:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeStream:
+    """A change stream yielding one insert per ``events`` item."""
+
+    def __init__(self, events):
+        self.events = events
+        self.alive = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.alive = False
+
+    def try_next(self):
+        try:
+            return self.events.get(timeout=0.01)
+        except Exception:
+            return None
+
+
+class ReplicaSetDb:
+    def __init__(self, events):
+        self.pending_commands = self
+        self._events = events
+
+    def watch(self, pipeline, max_await_time_ms=None):
+        assert pipeline == [{"$match": {"operationType": "insert"}}]
+        return FakeStream(self._events)
+
+
+def _wait_for(predicate):
+    deadline = time.monotonic() + 5
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    assert predicate()
+
+
+def test_idle_polling_backs_off_and_a_hit_resets_it():
+    clock = FakeTime()
+    feed = commands.CommandFeed(None, commands.POLL, floor=1, ceiling=5, clock=clock)
+    assert feed.due()
+    intervals = []
+    for _ in range(5):
+        feed.claimed(False)
+        start = clock.now
+        while not feed.due():
+            clock.now += 1
+        intervals.append(clock.now - start)
+    assert intervals == [2, 4, 5, 5, 5]
+
+    feed.claimed(True)
+    assert feed.due()  # drain: claim again straight away
+    feed.claimed(False)
+    clock.now += 2
+    assert feed.due()  # back at the floor (x2 for the miss)
+
+
+def test_change_stream_wakes_the_consumer_and_idles_at_the_recheck():
+    events = queue.Queue()
+    feed = commands.CommandFeed(ReplicaSetDb(events), commands.AUTO, recheck=30.0)
+    feed.start()
+    _wait_for(lambda: feed.transport == commands.CHANGE_STREAM)
+    assert feed.wait(timeout=1)  # the switch itself wakes it, to catch up
+    feed.claimed(False)
+    assert not feed.wait(timeout=0.05)  # nothing queued: no claims at all
+
+    woke = []
+    waiter = threading.Thread(target=lambda: woke.append(feed.wait(timeout=5)))
+    waiter.start()
+    events.put({"operationType": "insert"})
+    waiter.join()
+    assert woke == [True]
+    feed.stop()
+
+
+def test_falls_back_to_polling_when_push_is_unavailable():
+    class StandaloneDb:
+        def __init__(self):
+            self.pending_commands = self
+
+        def watch(self, *args, **kwargs):
+            raise OperationFailure("only supported on replica sets", code=40573)
+
+        def create_collection(self, *args, **kwargs):
+            raise NotImplementedError
+
+    feed = commands.CommandFeed(StandaloneDb())
+    feed.start()
+    feed._thread.join(timeout=5)
+    assert not feed._thread.is_alive()
+    assert feed.transport == commands.POLL
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient()["voice_clips"]
+
+
+def test_ring_is_best_effort(db):
+    commands.ring(db)
+    assert db[commands.SIGNALS].count_documents({}) == 1
+
+
+# --- MongoInterface: leased batch claims -------------------------------------
+
+
+def _mongo(db):
+    mongo = MongoInterface()
+    mongo.db = db
+    return mongo
+
+
+def _queue(db, *types, start=None):
+    start = start or datetime(2026, 1, 1)
+    db.pending_commands.insert_many(
+        [
+            {"type": t, "status": "pending", "created_at": start + timedelta(seconds=i)}
+            for i, t in enumerate(types)
+        ]
+    )
+
+
+def test_a_burst_is_claimed_in_one_batch_and_acked_in_one_write(db):
+    mongo = _mongo(db)
+    _queue(db, "announce", *["queue_play"] * 15)
+    batch = mongo.claim_pending_commands()
+    assert [c["type"] for c in batch] == ["announce"] + ["queue_play"] * 15
+    assert len({c["lease"] for c in batch}) == 1
+    assert mongo.claim_pending_commands() == []  # all leased
+    # Still visible to the queue prerender peek until it's done.
+    assert len(mongo.get_pending_commands("queue_play")) == 15
+
+    mongo.ack_commands(batch)
+    assert db.pending_commands.count_documents({"status": "done"}) == 16
+    assert mongo.get_pending_commands("queue_play") == []
+
+
+def test_batches_are_limited_and_oldest_first(db):
+    mongo = _mongo(db)
+    _queue(db, "a", "b", "c")
+    assert [c["type"] for c in mongo.claim_pending_commands(limit=2)] == ["a", "b"]
+    assert [c["type"] for c in mongo.claim_pending_commands(limit=2)] == ["c"]
+
+
+def test_an_expired_lease_is_claimable_again(db):
+    mongo = _mongo(db)
+    _queue(db, "play", "stop")
+    first, second = mongo.claim_pending_commands()
+    db.pending_commands.update_one(
+        {"_id": first["_id"]},
+        {"$set": {"lease_expires": datetime.utcnow() - timedelta(seconds=1)}},
+    )
+    (again,) = mongo.claim_pending_commands()  # the consumer of `first` died
+    assert again["_id"] == first["_id"] and again["lease"] != first["lease"]
+
+    mongo.ack_commands([first, second])  # the old lease only acks `second`
+    statuses = {c["type"]: c["status"] for c in db.pending_commands.find()}
+    assert statuses == {"play": "processing", "stop": "done"}
+
+
+def test_racing_consumers_get_disjoint_batches(db):
+    mongo, rival = _mongo(db), _mongo(db)
+    _queue(db, "a", "b", "c")
+    stolen = []
+
+    class Racy:
+        """The rival claims between this consumer's read and its lease."""
+
+        def __getattr__(self, name):
+            return getattr(db.pending_commands, name)
+
+        def update_many(self, *args, **kwargs):
+            if not stolen:
+                stolen.extend(rival.claim_pending_commands(limit=2))
+            return db.pending_commands.update_many(*args, **kwargs)
+
+    mongo.db = type("Db", (), {"pending_commands": Racy()})()
+    won = mongo.claim_pending_commands()
+    assert [c["type"] for c in stolen] == ["a", "b"]
+    assert [c["type"] for c in won] == ["c"]
+
+
+def test_control_commands_are_claimed_ahead_of_older_plays_and_in_a_lane(db):
+    mongo = _mongo(db)
+    _queue(db, "play", "play", "stop", "play")
+    for doc in db.pending_commands.find():
+        priority = commands.priority(doc["type"])
+        db.pending_commands.update_one(
+            {"_id": doc["_id"]}, {"$set": {"priority": priority}}
+        )
+    db.pending_commands.insert_one(  # queued before there were lanes
+        {"type": "legacy", "status": "pending", "created_at": datetime(2025, 1, 1)}
+    )
+    first = mongo.claim_pending_commands(limit=2)
+    assert [c["type"] for c in first] == ["stop", "play"]
+    db.pending_commands.update_many({}, {"$set": {"status": "pending"}})
+
+    (stop,) = mongo.claim_pending_commands(lane=commands.CONTROL)
+    assert stop["type"] == "stop"
+    rest = mongo.claim_pending_commands(lane=commands.NORMAL)
+    assert [c["type"] for c in rest] == ["play", "play", "play", "legacy"]
+
+
+def test_a_stop_supersedes_the_plays_queued_before_it():
+    stopped_at = datetime(2026, 1, 1, 0, 0, 1)
+    before = {"type": "play", "created_at": datetime(2026, 1, 1)}
+    after = {"type": "play", "created_at": datetime(2026, 1, 1, 0, 0, 2)}
+    assert commands.superseded(before, stopped_at)
+    assert not commands.superseded(after, stopped_at)
+    assert not commands.superseded({**before, "type": "announce"}, stopped_at)
+    assert not commands.superseded(before, None)
+    assert commands.is_control({"type": "skip_song"})
+    assert not commands.is_control({})
@@ -0,0 +1,253 @@
+"""Tests for pmb_core.audio.engine — the in-process speed/pitch renderer.
+
+Both bots now render every clip through this engine instead of an ffmpeg filter
+graph, so it has to match what ffmpeg produced: same duration, same perceived
+pitch, same level. The unit tests check that on synthetic sine tones; the
+parity tests render a real file through both the engine and the equivalent
+ffmpeg filter (`generate_filter` / `generate_standard_filter`) and compare.
+
+Pitch is measured as the FFT peak of the whole render, which is robust to the
+small phase artefacts WSOLA introduces.
+"""
+
+import math
+import shutil
+import subprocess as sp
+
+import numpy as np
+import pytest
+
+from pmb_core.audio import engine, sidecar, transform
+
+SR = engine.SAMPLE_RATE
+
+
+def _tone(freq=440.0, seconds=1.0, channels=1, amplitude=8000):
+    t = np.arange(int(SR * seconds)) / SR
+    mono = (amplitude * np.sin(2 * np.pi * freq * t)).astype(np.float32)
+    return np.repeat(mono[:, None], channels, axis=1)
+
+
+def _peak_hz(samples):
+    x = samples[:, 0]
+    spectrum = np.abs(np.fft.rfft(x * np.hanning(len(x))))
+    return np.argmax(spectrum) * SR / len(x)
+
+
+def _rms_db(samples):
+    return 20 * math.log10(math.sqrt(float((samples.astype(np.float64) ** 2).mean())))
+
+
+# --- conversions -------------------------------------------------------------
+
+
+def test_pcm_round_trip():
+    samples = _tone(channels=2)
+    pcm = engine.to_pcm(samples)
+    assert len(pcm) == len(samples) * 2 * 2
+    back = engine.from_pcm(pcm, channels=2)
+    assert back.shape == samples.shape
+    assert np.abs(back - samples).max() <= 0.5
+
+
+def test_to_pcm_saturates():
+    loud = np.array([[40000.0], [-40000.0]], dtype=np.float32)
+    assert engine.from_pcm(engine.to_pcm(loud))[:, 0].tolist() == [32767, -32768]
+
+
+# --- building blocks ---------------------------------------------------------
+
+
+def test_resample_changes_length_and_pitch():
+    out = engine.resample(_tone(440), 0.5)  # half as many samples -> octave up
+    assert len(out) == SR // 2
+    assert _peak_hz(out) == pytest.approx(880, rel=0.01)
+
+
+@pytest.mark.parametrize("ratio", [0.25, 0.5, 0.84, 1.19, 2.0])
+def test_resample_sinc_matches_linear_in_the_passband(ratio):
+    src = _tone(440, channels=2)
+    out = engine.resample_sinc(src, ratio)
+    assert out.shape == (round(SR * ratio), 2)
+    assert _peak_hz(out) == pytest.approx(440 / ratio, rel=0.01)
+    assert _rms_db(out) == pytest.approx(_rms_db(src), abs=0.5)
+
+
+def test_resample_sinc_doesnt_alias_when_pitching_up():
+    # Two octaves up, a 15kHz tone is above the new Nyquist: linear
+    # interpolation folds it back into the audible band, the sinc filters it.
+    src = _tone(15000)
+    linear = engine.resample(src, 0.25)
+    sinc = engine.resample_sinc(src, 0.25)
+    assert _rms_db(sinc) < _rms_db(linear) - 20
+
+
+def test_pitch_ladder_moves_pitch_and_length_together():
+    src = _tone(440)
+    for method in ("linear", "sinc"):
+        ladder = engine.pitch_ladder(src, [-12, 0, 7], method)
+        assert [len(out) for out in ladder] == [2 * SR, SR, round(SR * 2 ** (-7 / 12))]
+        assert ladder[1] is src
+        assert _peak_hz(ladder[2]) == pytest.approx(440 * 2 ** (7 / 12), rel=0.01)
+
+
+@pytest.mark.parametrize("tempo", [0.5, 0.8, 1.25, 2.0, 3.0])
+def test_time_stretch_keeps_pitch_and_level(tempo):
+    src = _tone(440, seconds=1.0)
+    out = engine.time_stretch(src, tempo)
+    assert len(out) == round(SR / tempo)
+    assert _peak_hz(out) == pytest.approx(440, rel=0.01)
+    assert _rms_db(out) == pytest.approx(_rms_db(src), abs=1.0)
+
+
+def test_time_stretch_identity_is_a_no_op():
+    src = _tone()
+    assert engine.time_stretch(src, 1.0) is src
+
+
+def test_empty_input_renders_empty():
+    empty = np.zeros((0, 1), dtype=np.float32)
+    assert len(engine.render_resample(empty, 1.0, 1.5, 3)) == 0
+    assert len(engine.render_standard(empty, 1.0, 1.5, 3)) == 0
+
+
+# --- full renders (the two filter semantics) ---------------------------------
+
+
+@pytest.mark.parametrize("speed,shift", [(1, 0), (1.5, 3), (0.5, -5), (2, 12)])
+def test_render_standard_duration_and_pitch(speed, shift):
+    out = engine.render_standard(_tone(440, channels=2), 1.0, speed, shift)
+    assert out.shape[1] == 2
+    assert len(out) == pytest.approx(SR / speed, rel=0.01)
+    assert _peak_hz(out) == pytest.approx(440 * 2 ** (shift / 12), rel=0.01)
+
+
+@pytest.mark.parametrize("speed,shift", [(1, 0), (1.5, 3), (0.5, -5), (2, 12)])
+def test_render_resample_duration_and_pitch(speed, shift):
+    # Played back at 48kHz, the Mumble-style render must sound `shift` higher
+    # and last 1/speed as long.
+    out = engine.render_resample(_tone(440), 1.0, speed, shift)
+    assert len(out) == pytest.approx(SR / speed, rel=0.01)
+    assert _peak_hz(out) == pytest.approx(440 * 2 ** (shift / 12), rel=0.01)
+
+
+def test_volume_and_reverse():
+    ramp = np.linspace(-1000, 1000, SR // 10, dtype=np.float32)[:, None]
+    out = engine.render_standard(ramp, 0.5, 1.0, 0, reverse=True)
+    assert np.allclose(out[:, 0], ramp[::-1, 0] * 0.5)
+
+
+# --- parity with the ffmpeg filter graphs ------------------------------------
+
+needs_ffmpeg = pytest.mark.skipif(
+    shutil.which("ffmpeg") is None, reason="ffmpeg not available"
+)
+
+PARITY_CASES = [
+    (1.0, 0, False),
+    (1.5, 3, False),
+    (0.5, -5, True),
+    (2.0, 12, False),
+    (4.0, -12, False),
+]
+
+
+@pytest.fixture
+def tone_file(tmp_path):
+    # A 44.1kHz source, like most mp3s, so the 48kHz resample is exercised too.
+    path = tmp_path / "tone.wav"
+    sp.run(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            "sine=frequency=440:duration=1",
+            "-ar",
+            "44100",
+            "-ac",
+            "1",
+            str(path),
+        ],
+        check=True,
+    )
+    return path
+
+
+def _assert_parity(ours, theirs):
+    # ffmpeg's atempo flushes a little extra tail per chained filter (4x speed
+    # at -12s is a chain of four), so allow ~20ms on top of 3%.
+    assert len(ours) == pytest.approx(len(theirs), rel=0.03, abs=engine.STRETCH_HOP)
+    assert _peak_hz(ours) == pytest.approx(_peak_hz(theirs), rel=0.01)
+    assert _rms_db(ours) == pytest.approx(_rms_db(theirs), abs=1.0)
+
+
+@needs_ffmpeg
+@pytest.mark.parametrize("speed,shift,reverse", PARITY_CASES)
+def test_parity_with_resample_filter(tone_file, speed, shift, reverse):
+    audio_filter = transform.generate_filter(
+        transform.RESAMPLE_FILTER, 0.8, speed, shift, reverse
+    )
+    theirs = engine.from_pcm(transform.transform_as_pcm_data(tone_file, audio_filter))
+    ours = engine.from_pcm(
+        transform.transform_audio(
+            tone_file, transform.RESAMPLE_FILTER, 0.8, speed, shift, reverse=reverse
+        )
+    )
+    _assert_parity(ours, theirs)
+
+
+@needs_ffmpeg
+@pytest.mark.parametrize("speed,shift,reverse", PARITY_CASES)
+def test_parity_with_standard_filter(tone_file, monkeypatch, speed, shift, reverse):
+    monkeypatch.setattr(transform, "ENGINE", "ffmpeg")
+    theirs = transform.transform_standard_pcm(tone_file, 0.8, speed, shift, reverse)
+    monkeypatch.setattr(transform, "ENGINE", "numpy")
+    ours = transform.transform_standard_pcm(tone_file, 0.8, speed, shift, reverse)
+    _assert_parity(engine.from_pcm(ours, 2), engine.from_pcm(theirs, 2))
+
+
+@needs_ffmpeg
+def test_decode_is_cached_per_file(tone_file, monkeypatch):
+    first = transform.decode_pcm(tone_file)
+    monkeypatch.setattr(sidecar.sp, "run", lambda *a, **k: pytest.fail("re-decoded"))
+    # Served from the sidecar written by the first call, not held in memory.
+    assert bytes(transform.decode_pcm(tone_file)) == bytes(first)
+    assert not any(key[0] == str(tone_file) for key in transform._decoded)
+
+
+@needs_ffmpeg
+def test_decode_is_held_in_memory_if_its_sidecar_cant_be_written(
+    tone_file, monkeypatch
+):
+    monkeypatch.setattr(sidecar, "store", lambda *a, **k: False)
+    first = transform.decode_pcm(tone_file)
+    monkeypatch.setattr(sidecar.sp, "run", lambda *a, **k: pytest.fail("re-decoded"))
+    assert transform.decode_pcm(tone_file) is first
+
+
+@needs_ffmpeg
+def test_variants_share_one_decode(tone_file, monkeypatch):
+    transform.decode_pcm(tone_file)
+    transform.decode_pcm(tone_file, channels=2)
+    decodes = []
+    real = transform.decode_pcm
+    monkeypatch.setattr(
+        transform, "decode_pcm", lambda *a, **k: decodes.append(a) or real(*a, **k)
+    )
+    variants = [(1.0, 0, False, 1.0), (1.5, 3, True, 0.5), (0.5, -7, False, 2.0)]
+    resampled = transform.transform_audio_variants(
+        tone_file, transform.RESAMPLE_FILTER, variants
+    )
+    standard = transform.transform_standard_variants(tone_file, variants)
+    assert len(decodes) == 2
+    for (speed, shift, reverse, volume), a, b in zip(variants, resampled, standard):
+        assert a == transform.transform_audio(
+            tone_file, transform.RESAMPLE_FILTER, volume, speed, shift, reverse=reverse
+        )
+        assert b == transform.transform_standard_pcm(
+            tone_file, volume, speed, shift, reverse
+        )
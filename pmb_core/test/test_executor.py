@@ -0,0 +1,95 @@
+"""Tests for pmb_core.audio.executor — the process-pool render executor.
+
+The pooled tests start real (spawned) worker processes, so the job functions
+are ones a fresh interpreter can import: numpy constructors stand in for a
+render that returns PCM, and ``time.sleep`` for one that's still running when
+it gets cancelled.
+"""
+
+import os
+import time
+
+import numpy as np
+import pytest
+
+from pmb_core.audio import executor
+
+
+@pytest.fixture
+def pool():
+    ex = executor.RenderExecutor(workers=1)
+    yield ex
+    ex.shutdown()
+
+
+def _shm_blocks():
+    try:
+        return {n for n in os.listdir("/dev/shm") if n.startswith("pmb_")}
+    except OSError:
+        return set()
+
+
+def test_result_comes_back_through_shared_memory(pool):
+    before = _shm_blocks()
+    job = pool.submit(np.ones, 4, "<i2")
+    assert job.result(30) == np.ones(4, "<i2").tobytes()
+    assert _shm_blocks() == before  # the parent freed the block
+
+
+def test_list_and_none_results(pool):
+    assert pool.submit(list, [b"ab", b"", b"cde"]).result(30) == [b"ab", b"", b"cde"]
+    assert pool.submit(time.sleep, 0).result(30) is None
+
+
+def test_errors_are_raised_in_the_caller(pool):
+    job = pool.submit(int, "not a number")
+    with pytest.raises(executor.RenderError, match="ValueError"):
+        job.result(30)
+    # The worker survives a failed job.
+    assert pool.submit(bytes, 3).result(30) == b"\x00\x00\x00"
+    assert pool.stats()["failed"] == 1
+
+
+def test_cancel_running_and_queued_jobs_by_tag(pool):
+    running = pool.submit(time.sleep, 30, tag="song")
+    queued = pool.submit(time.sleep, 30, tag="song")
+    other = pool.submit(bytes, 2, tag="clip")
+    deadline = time.monotonic() + 30
+    while pool.stats()["running"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    t0 = time.monotonic()
+    assert pool.cancel("song") == 2
+    with pytest.raises(executor.CancelledError):
+        running.result(5)
+    assert queued.cancelled()
+    # The busy worker was killed and replaced, so the next job runs promptly.
+    assert other.result(30) == b"\x00\x00"
+    assert time.monotonic() - t0 < 20
+
+    stats = pool.stats()
+    assert (stats["queued"], stats["running"], stats["cancelled"]) == (0, 0, 2)
+
+
+def test_cancel_after_finish_is_a_no_op(pool):
+    job = pool.submit(bytes, 1, tag="song")
+    job.result(30)
+    assert pool.cancel("song") == 0
+    assert job.result() == b"\x00"
+
+
+def test_inline_mode_runs_on_the_calling_thread():
+    ex = executor.RenderExecutor(workers=0)
+    job = ex.submit(np.zeros, 2, "<i2")
+    assert job.done() and job.result() == b"\x00" * 4
+    with pytest.raises(executor.RenderError, match="ValueError") as info:
+        ex.submit(int, "x").result()
+    assert isinstance(info.value.__cause__, ValueError)
+    assert ex.stats() == {
+        "workers": 0,
+        "queued": 0,
+        "running": 0,
+        "completed": 1,
+        "cancelled": 0,
+        "failed": 1,
+    }
@@ -0,0 +1,28 @@
+"""Tests for pmb_core.db.latency, the bots' side of command latency traces."""
+
+import mongomock
+
+from pmb_core.db import latency
+
+
+def test_a_trace_keeps_first_stamps_and_is_written_once_on_its_first_frame():
+    db = mongomock.MongoClient()["voice_clips"]
+    writer = latency.Writer(db)
+    command = {"type": "play", "trace": latency.start(accepted=1.0)}
+    trace = latency.Trace(command, "mumble", writer, via="direct")
+    trace.mark("claimed", 2.0).mark("claimed", 3.0).mark("resolved", 4.0)
+
+    trace.started()
+    trace.started()  # a second voice of the same clip, say
+    assert writer.drain() == 1
+    (doc,) = db.latency_log.find()
+    assert doc["trace"] == command["trace"]["id"]
+    assert (doc["side"], doc["via"], doc["type"]) == ("mumble", "direct", "play")
+    assert (doc["claimed"], doc["resolved"]) == (2.0, 4.0)
+    assert doc["first_frame"] >= 4.0
+
+
+def test_an_untraced_command_is_never_written():
+    writer = latency.Writer(mongomock.MongoClient()["voice_clips"])
+    latency.Trace({"type": "play"}, "discord", writer).started()
+    assert writer.drain() == 0
@@ -0,0 +1,148 @@
+"""Tests for pmb_core.audio.loudness — the song finalize stage."""
+
+import re
+import shutil
+import subprocess as sp
+
+import numpy as np
+import pytest
+
+from pmb_core.audio import loudness
+
+SR = loudness.SAMPLE_RATE
+
+needs_ffmpeg = pytest.mark.skipif(
+    shutil.which("ffmpeg") is None, reason="ffmpeg not available"
+)
+
+
+def _song(seconds=8.0, amplitude=3000):
+    t = np.arange(int(SR * seconds)) / SR
+    return (amplitude * np.sin(2 * np.pi * 330 * t)).astype("<i2").tobytes()
+
+
+def _notes(seconds=12.0, channels=2, amplitude=3000, seed=0):
+    """Decaying harmonic notes at random pitches — something song-shaped."""
+    rng = np.random.default_rng(seed)
+    out = np.zeros((int(SR * seconds), channels))
+    t = np.arange(SR // 2) / SR
+    for _ in range(int(seconds * 4)):
+        freq = 110 * 2 ** (rng.integers(0, 36) / 12)
+        tone = sum(np.sin(2 * np.pi * freq * k * t) / k for k in range(1, 8))
+        start = rng.integers(0, len(out) - len(t))
+        out[start : start + len(t)] += (amplitude * tone * np.exp(-4 * t))[:, None]
+    return np.clip(out, -32768, 32767).astype("<i2").tobytes()
+
+
+def _windows(pcm, size):
+    return [pcm[i : i + size] for i in range(0, len(pcm), size)]
+
+
+def test_measures_a_sine_like_bs1770():
+    # A 997Hz sine at -6dBFS in one channel reads -6 - 3.01 LUFS.
+    t = np.arange(SR * 5) / SR
+    pcm = (16384 * np.sin(2 * np.pi * 997 * t)).astype("<i2").tobytes()
+    assert loudness.integrated_loudness(pcm) == pytest.approx(-9.03, abs=0.05)
+    assert loudness.integrated_loudness(bytes(len(pcm))) is None
+
+
+def test_normalises_to_the_target_loudness():
+    for amplitude in (300, 3000, 30000):
+        out = loudness.finalize(_notes(amplitude=amplitude), 1.0, channels=2)
+        assert loudness.integrated_loudness(out, 2) == pytest.approx(
+            loudness.TARGET_LUFS, abs=0.5
+        )
+
+
+def test_true_peak_is_limited():
+    # Quiet noise with loud clicks: the gain that brings the noise up to the
+    # target would take the clicks far over the ceiling.
+    rng = np.random.default_rng(1)
+    samples = rng.standard_normal(SR * 6) * 1500
+    samples[SR // 2 :: SR // 3] = 30000
+    out = loudness.finalize(samples.astype("<i2").tobytes(), 1.0)
+    peaks = loudness._true_peaks(np.frombuffer(out, "<i2")[:, None].astype(float))
+    ceiling = 32768 * 10 ** (loudness.TARGET_TRUE_PEAK / 20)
+    assert peaks.max() <= ceiling * 1.01
+
+
+def test_stream_matches_whole_buffer():
+    pcm = _notes()
+    whole = loudness.finalize(pcm, 0.5, channels=2)
+    assert len(whole) == len(pcm)
+    streamed = b"".join(
+        loudness.finalize_stream(_windows(pcm, 7777 * 4), len(pcm) // 4, 0.5, 2)
+    )
+    assert streamed == whole
+
+
+def test_volume_applies_after_normalising_and_the_end_fades():
+    pcm = _song()
+    full = np.frombuffer(loudness.finalize(pcm, 1.0), "<i2").astype(int)
+    half = np.frombuffer(loudness.finalize(pcm, 0.5), "<i2").astype(int)
+    assert np.abs(half - full // 2).max() <= 1
+    assert np.abs(full[-10:]).max() < 1000 < np.abs(full[-SR // 10 :]).max()
+
+
+def test_closing_early_stops_pulling_windows():
+    pcm = _song(seconds=20.0)
+    pulled = []
+
+    def windows():
+        for w in _windows(pcm, SR * 2):
+            pulled.append(w)
+            yield w
+
+    chunks = loudness.finalize_stream(windows(), len(pcm) // 2, 1.0)
+    next(chunks)
+    chunks.close()
+    assert len(pulled) < len(_windows(pcm, SR * 2))
+
+
+@needs_ffmpeg
+def test_output_measures_on_target_with_ffmpeg():
+    out = loudness.finalize(_notes(), 1.0, channels=2)
+    proc = sp.run(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-nostats",
+            "-f",
+            "s16le",
+            "-ar",
+            str(SR),
+            "-ac",
+            "2",
+            "-i",
+            "pipe:0",
+            "-af",
+            "ebur128=peak=true",
+            "-f",
+            "null",
+            "-",
+        ],
+        input=out,
+        capture_output=True,
+        check=True,
+    )
+    report = proc.stderr.decode()
+    measured = float(re.findall(r"I:\s+(-?[\d.]+) LUFS", report)[-1])
+    true_peak = float(re.findall(r"Peak:\s+(-?[\d.]+) dBFS", report)[-1])
+    assert measured == pytest.approx(loudness.TARGET_LUFS, abs=0.5)
+    assert true_peak <= loudness.TARGET_TRUE_PEAK + 0.2
+
+
+def test_the_running_gate_matches_measuring_each_prefix_afresh():
+    rng = np.random.default_rng(2)
+    # Loud, quiet and silent stretches, so both gates have work to do.
+    powers = np.concatenate(
+        [rng.uniform(1e-3, 1e-1, 80), rng.uniform(1e-6, 1e-5, 40), np.zeros(30)]
+    )
+    gate = loudness._Gate()
+    for n, power in enumerate(powers, 1):
+        gate.add(power)
+        expected = loudness._integrated(powers[:n])
+        if expected is None:
+            assert gate.loudness() is None
+        else:
+            assert gate.loudness() == pytest.approx(expected, abs=1e-9)
@@ -14,8 +14,10 @@ import pytest
 
 from pmb_core.audio.midi import (
     DRUM_CHANNEL,
+    NoteTable,
     gm_instrument_name,
     parse_midi,
+    parse_midi_table,
     song_lines,
     summarize_midi,
 )
@@ -166,3 +168,74 @@ def test_summarize_midi_shape(tmp_path):
     assert meta["note_count"] == 1
     assert meta["track_count"] == 1
     assert meta["duration_s"] == pytest.approx(0.5, abs=0.05)
+
+
+# --- columnar note table -----------------------------------------------------
+
+def _busy_midi(tmp_path):
+    """A few lines on several channels, with chords, a repeated pitch and a
+    hanging note, emitted out of start order."""
+    msgs = [
+        mido.Message("program_change", program=40, channel=0, time=0),
+        mido.Message("program_change", program=40, channel=3, time=0),
+        mido.Message("program_change", program=0, channel=1, time=0),
+    ]
+    for i in range(12):
+        ch = (0, 1, 3)[i % 3]
+        msgs += [
+            mido.Message("note_on", note=50 + i % 5, velocity=60 + i, time=0, channel=ch),
+            mido.Message("note_on", note=62, velocity=90, time=0, channel=1),
+            mido.Message("note_off", note=50 + i % 5, velocity=0, time=TPB // 2, channel=ch),
+            mido.Message("note_off", note=62, velocity=0, time=TPB // 4, channel=1),
+        ]
+    msgs.append(mido.Message("note_on", note=70, velocity=100, time=0, channel=3))
+    msgs.append(mido.Message("note_on", note=38, velocity=100, time=TPB, channel=DRUM_CHANNEL))
+    msgs.append(mido.Message("note_off", note=38, velocity=0, time=TPB, channel=DRUM_CHANNEL))
+    return _write_midi(tmp_path, msgs)
+
+
+def test_table_matches_note_list(tmp_path):
+    path = _busy_midi(tmp_path)
+    table = parse_midi_table(path)
+    notes, duration = parse_midi(path)
+
+    assert isinstance(table, NoteTable)
+    assert len(table) == len(notes) > 12
+    assert table.end == pytest.approx(duration)
+    for n, t in zip(notes, table):
+        assert (n.pitch, n.start, n.duration, n.velocity, n.channel, n.program) == (
+            t.pitch, t.start, t.duration, t.velocity, t.channel, t.program
+        )
+    assert list(zip(table.start, table.pitch)) == sorted(zip(table.start, table.pitch))
+    assert DRUM_CHANNEL not in table.channel.tolist()
+    assert DRUM_CHANNEL in parse_midi_table(path, include_drums=True).channel.tolist()
+
+
+def test_table_shim_and_aggregates(tmp_path):
+    table = parse_midi_table(_busy_midi(tmp_path))
+    first = table[0]
+    assert first.pitch == int(table.pitch[0]) and isinstance(first.start, float)
+    assert "MidiNote(pitch=" in repr(first)
+    pitches = sorted(table.pitch.tolist())
+    assert table.median_pitch() == int(
+        (pitches[(len(pitches) - 1) // 2] + pitches[len(pitches) // 2]) / 2
+    )
+    assert table.track_count == 1
+
+
+def test_table_lines_match_per_note_grouping(tmp_path):
+    table = parse_midi_table(_busy_midi(tmp_path))
+    by_prog = {}
+    for n in table:
+        by_prog.setdefault(n.program, []).append(n.channel)
+    lines = table.lines()
+    assert [ln["program"] for ln in lines] == [0, 40]  # 0 has the most notes
+    for ln in lines:
+        assert ln["note_count"] == len(by_prog[ln["program"]])
+        assert ln["channels"] == sorted(set(by_prog[ln["program"]]))
+
+
+def test_empty_table(tmp_path):
+    table = parse_midi_table(_write_midi(tmp_path, []))
+    assert len(table) == 0 and table.end == 0.0
+    assert table.lines() == [] and list(table) == []
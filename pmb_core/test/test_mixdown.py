@@ -0,0 +1,65 @@
+"""Tests for pmb_core.audio.mixdown — the song canvas mixer both bots use."""
+
+import numpy as np
+
+from pmb_core.audio import mixdown
+
+
+def _pcm(values):
+    return np.array(values, dtype="<i2").tobytes()
+
+
+def _samples(pcm):
+    return np.frombuffer(pcm, dtype="<i2").tolist()
+
+
+def test_places_prefixes_and_sums_overlaps():
+    a, b = _pcm([1, 2, 3, 4]), _pcm([10, 20])
+    out = mixdown.mix([a, b], [0, 1, 0], [0, 1, 5], [3, 9, 2])
+    # a[:3] at 0, b (only 2 frames long) at 1, a[:2] at 5.
+    assert _samples(out) == [1, 12, 23, 0, 0, 1, 2]
+
+
+def test_saturates_once_at_the_end():
+    # 30000 + 30000 - 20000: 16-bit saturating adds would clip to 32767 after
+    # the second note and then drop to 12767; summing first keeps it at 40000.
+    sources = [_pcm([30000, -30000]), _pcm([-20000, 20000])]
+    out = mixdown.mix(sources, [0, 0, 1], [0, 0, 0], [2, 2, 2])
+    assert _samples(out) == [32767, -32768]
+    out = mixdown.mix([_pcm([30000]), _pcm([-30000])], [0, 0, 1, 1], [0] * 4, [1] * 4)
+    assert _samples(out) == [0]
+
+
+def test_limit_cuts_off_ringing_notes():
+    a = _pcm([1] * 10)
+    out = mixdown.mix([a], [0, 0], [0, 4], [10, 10], limit=6)
+    assert _samples(out) == [1, 1, 1, 1, 2, 2]
+
+
+def test_stereo_frames():
+    a = _pcm([1, -1, 2, -2])  # two stereo frames
+    out = mixdown.mix([a], [0, 0], [0, 1], [2, 2], channels=2)
+    assert _samples(out) == [1, -1, 3, -3, 2, -2]
+
+
+def test_nothing_to_place():
+    assert mixdown.mix([], [], [], []) == b""
+    assert mixdown.mix([b""], [0], [0], [5]) == b""
+    assert mixdown.mix([_pcm([1])], [0], [3], [1], limit=2) == b""
+
+
+def test_windows_match_whole_mix_however_cut():
+    rng = np.random.default_rng(0)
+    sources = [
+        rng.integers(-20000, 20000, n).astype("<i2").tobytes() for n in (50, 7, 300)
+    ]
+    ids = rng.integers(0, 3, 200)
+    offsets = rng.integers(0, 2000, 200)
+    lengths = rng.integers(1, 400, 200)
+    mix = mixdown.Mixdown(sources, ids, offsets, lengths, limit=1900)
+    whole = mix.render()
+    assert len(whole) == mix.frames * 2
+    for window in (1, 64, 333, 5000):
+        chunks = list(mix.windows(window))
+        assert all(len(c) == window * 2 for c in chunks[:-1])
+        assert b"".join(chunks) == whole
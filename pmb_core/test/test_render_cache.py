@@ -0,0 +1,248 @@
+"""Tests for pmb_core.audio.render_cache — the shared on-disk render cache.
+
+The cache mechanics (keys, LRU eviction, atomic writes) are tested with fake
+PCM; the end-to-end ``render`` tests need ffmpeg to decode a real clip.
+"""
+
+import os
+import shutil
+import subprocess as sp
+import time
+
+import numpy as np
+import pytest
+
+from pmb_core.audio import engine, render_cache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return render_cache.RenderCache(tmp_path / ".render_cache", max_bytes=1000)
+
+
+def _age(cache, key, seconds):
+    path = cache._path(key)
+    t = time.time() - seconds
+    os.utime(path, (t, t))
+
+
+def test_key_depends_on_every_param():
+    base = ("abc", render_cache.STANDARD, 1.5, 3, False, 2)
+    keys = {render_cache.RenderCache.key(*base)}
+    for i, changed in enumerate(["abd", render_cache.RESAMPLE, 1.25, 4, True, 1]):
+        args = list(base)
+        args[i] = changed
+        keys.add(render_cache.RenderCache.key(*args))
+    assert len(keys) == 7
+    # ...but not on how a number was spelled (the web sends ints, bots floats).
+    assert render_cache.RenderCache.key("abc", "standard", 1, 3.0) == (
+        render_cache.RenderCache.key("abc", "standard", 1.0, 3)
+    )
+
+
+def test_content_hash_follows_content_not_name(tmp_path):
+    a, b = tmp_path / "a.mp3", tmp_path / "b.mp3"
+    a.write_bytes(b"same")
+    b.write_bytes(b"same")
+    assert render_cache.content_hash(a) == render_cache.content_hash(b)
+    b.write_bytes(b"different!")
+    assert render_cache.content_hash(a) != render_cache.content_hash(b)
+    assert render_cache.content_hash(tmp_path / "missing.mp3") is None
+
+
+def test_put_then_get(cache):
+    assert cache.get("k") is None
+    cache.put("k", b"\x01\x02")
+    assert cache.get("k") == b"\x01\x02"
+    assert [p.name for p in cache.directory.iterdir()] == ["k.s16le"]  # no temps
+
+
+def test_writer_streams_an_entry_in_and_map_reads_it_out(cache):
+    writer = cache.open_writer("k")
+    writer.write(b"\x01\x02")
+    writer.write(b"\x03\x04")
+    assert cache.map("k") is None  # not visible until committed
+    writer.commit()
+    mapped = cache.map("k")
+    assert mapped[:] == b"\x01\x02\x03\x04" == cache.get("k")
+    mapped.close()
+
+    dropped = cache.open_writer("gone")
+    dropped.write(b"\x05\x06")
+    dropped.discard()
+    empty = cache.open_writer("empty")
+    empty.commit()
+    assert cache.map("gone") is None and cache.map("empty") is None
+    assert [p.name for p in cache.directory.iterdir()] == ["k.s16le"]
+
+
+def test_evicts_least_recently_used_over_budget(cache):
+    for i, key in enumerate("abc"):
+        cache.put(key, b"x" * 400)
+        _age(cache, key, 100 - i)  # a oldest, c newest
+    # a and b fit; c pushed it over, so the oldest (a) went.
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    assert cache.bytes_used == 800
+
+    _age(cache, "c", 200)  # c is now the least recently used...
+    cache.get("b")  # ...and a hit refreshes b
+    cache.put("d", b"x" * 400)
+    assert cache.get("c") is None
+    assert cache.get("b") is not None and cache.get("d") is not None
+
+
+def test_eviction_sees_other_processes_entries(tmp_path):
+    directory = tmp_path / ".render_cache"
+    ours = render_cache.RenderCache(directory, max_bytes=1000)
+    theirs = render_cache.RenderCache(directory, max_bytes=1000)
+    theirs.put("old", b"x" * 600)
+    _age(theirs, "old", 100)
+    ours.put("new", b"x" * 600)
+    assert ours.get("old") is None
+    assert ours.get("new") is not None
+
+
+def test_stale_temp_files_are_cleaned_up(cache):
+    cache.put("k", b"x")
+    stale = cache.directory / ".k.dead.tmp"
+    stale.write_bytes(b"half a render")
+    old = time.time() - 2 * 3600
+    os.utime(stale, (old, old))
+    cache.evict()
+    assert not stale.exists()
+
+
+def test_apply_volume():
+    pcm = np.array([1000, -1000, 30000], dtype="<i2").tobytes()
+    assert engine.apply_volume(pcm, 1.0) is pcm
+    out = np.frombuffer(engine.apply_volume(pcm, 2.0), dtype="<i2")
+    assert out.tolist() == [2000, -2000, 32767]
+
+
+# --- end to end ---------------------------------------------------------------
+
+needs_ffmpeg = pytest.mark.skipif(
+    shutil.which("ffmpeg") is None, reason="ffmpeg not available"
+)
+
+
+@pytest.fixture
+def clip(tmp_path):
+    path = tmp_path / "tone.wav"
+    sp.run(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            "sine=frequency=440:duration=0.5",
+            str(path),
+        ],
+        check=True,
+    )
+    return path
+
+
+@needs_ffmpeg
+def test_render_hits_across_volumes(tmp_path, clip):
+    cache = render_cache.for_audio_dir(tmp_path)
+    assert cache is render_cache.for_audio_dir(tmp_path)
+
+    quiet, hit = cache.render(clip, render_cache.STANDARD, 0.5, 1.5, 3, channels=2)
+    assert not hit
+    loud, hit = cache.render(clip, render_cache.STANDARD, 1.0, 1.5, 3, channels=2)
+    assert hit
+    assert len(quiet) == len(loud) == pytest.approx(24000 / 1.5 * 4, rel=0.02)
+    assert abs(np.frombuffer(quiet, "<i2")).max() == pytest.approx(
+        abs(np.frombuffer(loud, "<i2")).max() / 2, abs=1
+    )
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+@needs_ffmpeg
+def test_render_kinds_are_separate_entries(tmp_path, clip):
+    cache = render_cache.RenderCache(tmp_path / "cache")
+    cache.render(clip, render_cache.RESAMPLE, 1.0, 1.0, 5)
+    _pcm, hit = cache.render(clip, render_cache.STANDARD, 1.0, 1.0, 5)
+    assert not hit
+
+
+@needs_ffmpeg
+def test_pitch_kind_renders_sampler_style(tmp_path, clip, monkeypatch):
+    cache = render_cache.RenderCache(tmp_path / "cache")
+    variants = [(1.0, 12, False, 1.0), (1.0, -12, False, 0.5)]
+    up, down = cache.render_many(clip, render_cache.PITCH, variants, channels=2)
+    assert not up[1] and not down[1]
+    # An octave up is half as long, an octave down twice as long.
+    assert len(up[0]) == 24000 // 2 * 4
+    assert len(down[0]) == 24000 * 2 * 4
+    # Each interpolator gets its own entries.
+    assert cache.render_many(clip, render_cache.PITCH, variants, 2)[0][1]
+    monkeypatch.setattr(render_cache.transform, "PITCH_RESAMPLER", "sinc")
+    assert not cache.render_many(clip, render_cache.PITCH, variants, 2)[0][1]
+
+
+def test_render_of_missing_clip_is_empty(tmp_path):
+    cache = render_cache.RenderCache(tmp_path / "cache")
+    assert cache.render(tmp_path / "gone.mp3", render_cache.STANDARD, 1, 1, 0) == (
+        b"",
+        False,
+    )
+
+
+@needs_ffmpeg
+def test_render_many_decodes_once_and_dedupes(tmp_path, clip, monkeypatch):
+    cache = render_cache.RenderCache(tmp_path / "cache")
+    cache.render(clip, render_cache.STANDARD, 1.0, 1.0, 0, channels=2)  # warm one
+
+    calls = []
+    real = render_cache.transform.transform_standard_variants
+
+    def spy(file, variants, channels=2):
+        calls.append(list(variants))
+        return real(file, variants, channels)
+
+    monkeypatch.setattr(render_cache.transform, "transform_standard_variants", spy)
+    variants = [
+        (1.0, 0, False, 1.0),  # cached
+        (1.5, 3, False, 1.0),
+        (1.5, 3, False, 0.5),  # same render, different volume
+        (0.75, -2, True, 1.0),
+    ]
+    results = cache.render_many(clip, render_cache.STANDARD, variants, channels=2)
+    assert [hit for _pcm, hit in results] == [True, False, False, False]
+    assert calls == [[(1.5, 3, False, 1.0), (0.75, -2, True, 1.0)]]
+    assert len(results[1][0]) == len(results[2][0])
+    assert results[2][0] == engine.apply_volume(results[1][0], 0.5)
+
+
+@needs_ffmpeg
+@pytest.mark.parametrize("engine_name", ["numpy", "ffmpeg"])
+def test_stream_yields_chunks_then_caches(tmp_path, clip, monkeypatch, engine_name):
+    monkeypatch.setattr(render_cache.transform, "ENGINE", engine_name)
+    cache = render_cache.RenderCache(tmp_path / "cache")
+    whole = render_cache.transform.transform_standard_pcm(clip, 0.5, 1.25, 2)
+
+    chunks = list(cache.stream(clip, render_cache.STANDARD, 0.5, 1.25, 2, channels=2))
+    assert len(chunks) > 1
+    assert all(len(c) % 4 == 0 for c in chunks)  # whole stereo frames
+    assert len(b"".join(chunks)) == pytest.approx(len(whole), abs=8)
+
+    again = list(cache.stream(clip, render_cache.STANDARD, 0.5, 1.25, 2, channels=2))
+    assert again == [b"".join(chunks)]  # now a single cached hit
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+@needs_ffmpeg
+def test_abandoned_stream_is_not_cached(tmp_path, clip, monkeypatch):
+    monkeypatch.setattr(render_cache.transform, "ENGINE", "ffmpeg")
+    cache = render_cache.RenderCache(tmp_path / "cache")
+    chunks = cache.stream(clip, render_cache.RESAMPLE, 1.0, 1.0, 3)
+    next(chunks)
+    chunks.close()  # e.g. the voice was replaced mid-render
+    _pcm, hit = cache.render(clip, render_cache.RESAMPLE, 1.0, 1.0, 3)
+    assert not hit
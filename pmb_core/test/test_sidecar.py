@@ -0,0 +1,154 @@
+"""Tests for pmb_core.audio.sidecar — the decoded-PCM files next to each clip.
+
+The freshness rules are what keep a trimmed/reverted clip from playing its old
+audio, so they're covered without ffmpeg (the clip "decode" is faked by writing
+bytes directly); the ingest/backfill tests need ffmpeg to decode a real file.
+"""
+
+import os
+import shutil
+import subprocess as sp
+
+import numpy as np
+import pytest
+
+from pmb_core.audio import sidecar, transform
+
+
+@pytest.fixture
+def clip(tmp_path):
+    path = tmp_path / "clip.mp3"
+    path.write_bytes(b"not really an mp3")
+    return path
+
+
+def _pcm(*samples):
+    return np.array(samples, dtype="<i2").tobytes()
+
+
+def test_sidecar_path_is_hidden_next_to_clip(clip):
+    assert sidecar.sidecar_path(clip) == clip.with_name(".pcm_clip.mp3.1ch.s16le")
+    assert sidecar.sidecar_path(clip, 2).name == ".pcm_clip.mp3.2ch.s16le"
+
+
+def test_store_then_load_maps_the_pcm(clip):
+    assert sidecar.load(clip) is None
+    assert sidecar.store(clip, _pcm(1, -2, 3))
+    mapped = sidecar.load(clip)
+    assert isinstance(mapped, np.memmap)
+    assert mapped.tolist() == [1, -2, 3]
+    assert sidecar.load(clip, 2) is None  # channel counts are separate files
+
+
+def test_empty_sidecar_loads_empty(clip):
+    sidecar.store(clip, b"")
+    assert len(sidecar.load(clip)) == 0
+
+
+def test_rewriting_the_clip_makes_the_sidecar_stale(clip):
+    sidecar.store(clip, _pcm(1))
+    st = os.stat(clip)
+    os.utime(clip, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))  # a trim
+    assert not sidecar.is_fresh(clip)
+    assert sidecar.load(clip) is None
+
+
+def test_restoring_an_older_file_makes_the_sidecar_stale(clip):
+    # revert copies the backup with copy2, which brings its *older* mtime along.
+    sidecar.store(clip, _pcm(1))
+    st = os.stat(clip)
+    os.utime(clip, ns=(st.st_atime_ns, st.st_mtime_ns - 1_000_000_000))
+    assert sidecar.load(clip) is None
+
+
+def test_store_stamps_the_mtime_seen_before_decoding(clip):
+    before = sidecar.source_mtime(clip)
+    st = os.stat(clip)
+    os.utime(clip, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))  # mid-decode
+    sidecar.store(clip, _pcm(1), mtime_ns=before)
+    assert sidecar.load(clip) is None
+
+
+def test_store_leaves_no_temp_files(clip):
+    sidecar.store(clip, _pcm(1, 2))
+    assert sorted(p.name for p in clip.parent.iterdir()) == [
+        ".pcm_clip.mp3.1ch.s16le",
+        "clip.mp3",
+    ]
+
+
+def test_move_and_remove(clip):
+    sidecar.store(clip, _pcm(1))
+    sidecar.store(clip, _pcm(1, 1), channels=2)
+    renamed = clip.with_name("renamed.mp3")
+    clip.rename(renamed)
+    sidecar.move(clip, renamed)
+    assert sidecar.load(renamed).tolist() == [1]
+    assert sidecar.load(renamed, 2).tolist() == [1, 1]
+    sidecar.remove(renamed)
+    sidecar.remove(renamed)  # already gone is fine
+    assert [p.name for p in clip.parent.iterdir()] == ["renamed.mp3"]
+
+
+def test_decode_pcm_prefers_the_sidecar(clip, monkeypatch):
+    sidecar.store(clip, _pcm(7, 8))
+    monkeypatch.setattr(sidecar, "decode", lambda *a, **k: pytest.fail("decoded"))
+    assert bytes(transform.decode_pcm(clip)) == _pcm(7, 8)
+
+
+# --- ingest / backfill (real decodes) ----------------------------------------
+
+needs_ffmpeg = pytest.mark.skipif(
+    shutil.which("ffmpeg") is None, reason="ffmpeg not available"
+)
+
+
+def _make_tone(path, seconds=0.5):
+    sp.run(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-loglevel",
+            "error",
+            "-f",
+            "lavfi",
+            "-i",
+            "sine=frequency=440:duration={0}".format(seconds),
+            "-ar",
+            "44100",
+            str(path),
+        ],
+        check=True,
+    )
+
+
+@needs_ffmpeg
+def test_write_decodes_to_48k(tmp_path):
+    path = tmp_path / "tone.wav"
+    _make_tone(path)
+    assert sidecar.write(path, stereo=True)
+    assert len(sidecar.load(path)) == 24000
+    assert len(sidecar.load(path, 2)) == 48000
+
+
+@needs_ffmpeg
+def test_write_fails_cleanly_on_unreadable_clip(clip):
+    assert not sidecar.write(clip)
+    assert sidecar.load(clip) is None
+
+
+@needs_ffmpeg
+def test_backfill_skips_fresh_and_hidden_files(tmp_path):
+    for name in ("a.wav", "b.wav", ".orig_a.wav"):
+        _make_tone(tmp_path / name)
+    (tmp_path / "notes.txt").write_text("ignored")
+    sidecar.write(tmp_path / "a.wav", stereo=False)
+
+    assert sidecar.backfill(tmp_path, stereo=False) == {
+        "written": 1,
+        "skipped": 1,
+        "failed": 0,
+    }
+    assert sidecar.is_fresh(tmp_path / "b.wav")
+    assert not sidecar.is_fresh(tmp_path / ".orig_a.wav")
+    assert sidecar.backfill(tmp_path, stereo=False)["skipped"] == 2
@@ -0,0 +1,74 @@
+"""Tests for pmb_core.audio.song_cache — parsed MIDI songs cached on disk."""
+
+import mido
+import pytest
+
+from pmb_core.audio import midi, song_cache
+
+TPB = 480
+
+
+@pytest.fixture
+def song(tmp_path):
+    mid = mido.MidiFile(ticks_per_beat=TPB)
+    track = mido.MidiTrack()
+    track.append(mido.Message("program_change", program=56, channel=1, time=0))
+    for i in range(6):
+        ch = i % 2
+        track.append(
+            mido.Message("note_on", note=60 + i, velocity=90, time=0, channel=ch)
+        )
+        track.append(
+            mido.Message("note_off", note=60 + i, velocity=0, time=TPB, channel=ch)
+        )
+    mid.tracks.append(track)
+    path = tmp_path / "tune.mid"
+    mid.save(str(path))
+    return path
+
+
+def test_parse_caches_and_round_trips(song, monkeypatch):
+    expected_lines = midi.song_lines(song)
+    assert song_cache.load(song) is None
+    first = song_cache.parse(song)
+    assert song_cache.cache_path(song).exists()
+
+    monkeypatch.setattr(midi, "parse_midi_table", lambda *a: pytest.fail("re-parsed"))
+    again = song_cache.parse(song)
+    assert (again.notes.notes == first.notes.notes).all()
+    assert again.notes.notes.dtype == midi.NOTE_DTYPE
+    assert again.lines == first.lines == expected_lines
+    assert again.summary == first.summary
+    assert again.summary["note_count"] == 6 and again.notes.track_count == 1
+
+
+def test_entry_follows_content(song, tmp_path):
+    song_cache.parse(song)
+    copy = tmp_path / "renamed.mid"
+    copy.write_bytes(song.read_bytes())
+    assert song_cache.load(copy) is not None  # same content, same entry
+
+    song.write_bytes(song.read_bytes() + b"\0")  # different content -> miss
+    assert song_cache.load(song) is None
+
+
+def test_remove(song):
+    song_cache.parse(song)
+    song_cache.remove(song)
+    assert song_cache.load(song) is None
+    song_cache.remove(song)  # already gone is fine
+    assert [p.name for p in song.parent.joinpath(song_cache.DIR_NAME).iterdir()] == []
+
+
+def test_corrupt_entry_is_a_miss(song):
+    song_cache.parse(song)
+    song_cache.cache_path(song).write_bytes(b"not an npz")
+    assert song_cache.load(song) is None
+    assert song_cache.parse(song).summary["note_count"] == 6  # and gets rewritten
+    assert song_cache.load(song) is not None
+
+
+def test_missing_file(tmp_path):
+    assert song_cache.load(tmp_path / "gone.mid") is None
+    with pytest.raises(OSError):
+        song_cache.parse(tmp_path / "gone.mid")
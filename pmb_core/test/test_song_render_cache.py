@@ -0,0 +1,89 @@
+"""Tests for pmb_core.audio.song_render_cache — finished songs, on disk."""
+
+import numpy as np
+import pytest
+
+from pmb_core.audio import render_cache, song_render_cache
+
+
+@pytest.fixture
+def files(tmp_path):
+    song, clip = tmp_path / "song.mid", tmp_path / "clip.wav"
+    song.write_bytes(b"MThd song")
+    clip.write_bytes(b"RIFF clip")
+    return song, clip
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return song_render_cache.for_audio_dir(tmp_path)
+
+
+def _key(song, clip, **params):
+    return song_render_cache.key(song, [clip], render_cache.RESAMPLE, 1, params)
+
+
+def test_key_follows_content_and_params(files, tmp_path):
+    song, clip = files
+    base = _key(song, clip, speed=1.0, transpose=0)
+    assert _key(song, clip, transpose=0, speed=1.0) == base  # order-insensitive
+    assert _key(song, clip, speed=1.0, transpose=2) != base
+    assert (
+        song_render_cache.key(
+            song, [clip], render_cache.STANDARD, 2, {"speed": 1.0, "transpose": 0}
+        )
+        != base
+    )
+    clip.write_bytes(b"RIFF another clip")
+    assert _key(song, clip, speed=1.0, transpose=0) != base
+    assert _key(song, tmp_path / "gone.wav", speed=1.0) is None
+
+
+def test_miss_records_then_hit_plays_at_any_volume(files, cache):
+    song, clip = files
+    key = _key(song, clip, speed=1.0)
+    unit = [np.full(6, 1000, "<i2").tobytes(), np.full(4, -2000, "<i2").tobytes()]
+
+    assert song_render_cache.play(cache, key, 1.0, 8) == (None, 0)
+    played = list(song_render_cache.record(cache, key, iter(unit), 0.5))
+    assert b"".join(played) == np.array([500] * 6 + [-1000] * 4, "<i2").tobytes()
+
+    chunks, size = song_render_cache.play(cache, key, 2.0, 8)
+    assert size == 20
+    out = list(chunks)
+    assert [len(c) for c in out] == [8, 8, 4]
+    assert np.frombuffer(b"".join(out), "<i2").tolist() == [2000] * 6 + [-4000] * 4
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_recording_goes_to_disk_as_it_plays(files, cache):
+    song, clip = files
+    key = _key(song, clip, speed=1.0)
+    window = b"\x01\x00" * 65536
+    chunks = song_render_cache.record(cache, key, iter([window] * 3), 1.0)
+    next(chunks)
+    next(chunks)
+    (partial,) = cache.directory.iterdir()
+    assert partial.name.startswith(".") and partial.stat().st_size >= len(window)
+    assert len(list(chunks)) == 1
+    assert [p.name for p in cache.directory.iterdir()] == [key + ".s16le"]
+
+
+def test_skipped_song_is_not_recorded(files, cache):
+    song, clip = files
+    key = _key(song, clip, speed=1.0)
+    closed = []
+
+    def finalized():
+        try:
+            yield b"\x01\x00" * 4
+            yield b"\x02\x00" * 4
+        finally:
+            closed.append(True)
+
+    chunks = song_render_cache.record(cache, key, finalized(), 1.0)
+    next(chunks)
+    chunks.close()
+    assert closed == [True]  # the finalize stage was stopped too
+    assert song_render_cache.play(cache, key, 1.0, 8) == (None, 0)
+    assert not list(cache.directory.iterdir())  # the partial write is gone
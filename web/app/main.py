@@ -1,9 +1,12 @@
 import os
+import time
 from pathlib import Path
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
+from pmb_core.db import latency
+from pmb_core.db.commands import ensure_signals
 from slowapi import _rate_limit_exceeded_handler
 from slowapi.errors import RateLimitExceeded
 from app.limiter import limiter
@@ -18,6 +21,7 @@ from app.routers import (
     voice,
 )
 from app.database import get_db
+from app.services.commands import request_started
 
 PENDING_COMMANDS_TTL_SECONDS = 30 * 24 * 60 * 60  # 30 days
 
@@ -29,6 +33,13 @@ app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 def create_indexes():
     db = get_db()
     db.pending_commands.create_index("created_at", expireAfterSeconds=PENDING_COMMANDS_TTL_SECONDS)
+    # The bots' claim: control commands first, then oldest first.
+    db.pending_commands.create_index([("status", 1), ("priority", -1), ("created_at", 1)])
+    # Capped doorbell the bots tail when change streams aren't available; it must
+    # exist (capped) before the first ring, or the insert would make it uncapped.
+    ensure_signals(db)
+    # Capped log of per-command latency traces, for /api/stats/latency.
+    latency.ensure_log(db)
     # play_log is the durable, append-only stats source (no TTL).
     db.play_log.create_index("played_at")
     # song_log: durable record of MIDI-song plays (separate from play_log).
@@ -59,6 +70,16 @@ def _backfill_play_log(db):
     if docs:
         db.play_log.insert_many(docs)
 
+@app.middleware("http")
+async def stamp_request_start(request: Request, call_next):
+    # The first stamp of any command this request queues (see pmb_core.db.latency).
+    token = request_started.set(time.time())
+    try:
+        return await call_next(request)
+    finally:
+        request_started.reset(token)
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
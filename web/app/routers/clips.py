@@ -2,7 +2,7 @@ from pathlib import Path
 from typing import List, Optional
 
 from fastapi import APIRouter, Depends, File, Form, HTTPException, UploadFile
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, Response
 from pydantic import BaseModel
 
 from app.auth import get_current_user
@@ -164,8 +164,8 @@ def clip_audio(
         return FileResponse(path, media_type=media_type)
 
     # Otherwise render it exactly as the bot would play it.
-    out = clips_service.render_preview(clip, pitch, speed, reverse)
-    return FileResponse(out, media_type="audio/wav")
+    wav = clips_service.render_preview(clip, pitch, speed, reverse)
+    return Response(wav, media_type="audio/wav")
 
 
 @router.delete("/{identifier}")
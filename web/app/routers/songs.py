@@ -28,6 +28,8 @@ class LineInstrument(BaseModel):
     program: int = Field(ge=0, le=127)
     clip_ref: str
     gain: float = Field(default=0.0, ge=-30.0, le=30.0)
+    # Stereo placement on Discord (-1 left .. 1 right); 0 keeps the song mono.
+    pan: float = Field(default=0.0, ge=-1.0, le=1.0)
 
 
 class PlaySongRequest(BaseModel):
@@ -140,6 +142,7 @@ def play_song(
                 "clip_ref": ins.clip_ref,
                 "clip_name": line_clip["name"],
                 "gain": ins.gain,
+                "pan": ins.pan,
             }
         )
 
@@ -35,6 +35,14 @@ def get_clip_stats(
     return StatsService().get_clip_stats(name, period=period, tz_offset=tz_offset)
 
 
+@router.get("/latency/")
+def get_latency_stats(
+    period: str = "24h",
+    current_user: str = Depends(get_current_user),
+):
+    return StatsService().get_latency_stats(period=period)
+
+
 # -- song stats (read from song_log) --------------------------------------
 
 
@@ -1,4 +1,3 @@
-import hashlib
 import io
 import os
 import re
@@ -11,13 +10,16 @@ from typing import List, Optional
 
 import pymongo
 from fastapi import HTTPException
+from pmb_core.audio import render_cache, sidecar
 
 from app.database import get_db
 
 AUDIO_DIR = Path(os.getenv("AUDIO_DIR", "/app/audio"))
-# Pitch/speed-shifted preview renders are cached here. /tmp is ephemeral, so it
-# self-cleans on container restart and never touches the real audio volume.
-PREVIEW_CACHE_DIR = Path("/tmp/pmb_preview_cache")
+# Preview renders use the same semantics as this stack's bot, so they share its
+# render cache entries: the Discord stack (stereo sidecars on) plays true 48kHz
+# stereo, the Mumble stack an off-rate mono stream reinterpreted at 48kHz.
+_PREVIEW_KIND = render_cache.STANDARD if sidecar.STEREO else render_cache.RESAMPLE
+_PREVIEW_CHANNELS = 2 if sidecar.STEREO else 1
 MAX_SIZE_BYTES = 100 * 1024 * 1024  # 100 MB (headroom for a 5-min WAV source)
 MAX_DURATION_SECONDS = 10
 # A longer source may be uploaded so it can be trimmed down in the browser; the
@@ -174,6 +176,7 @@ class ClipsService:
                 tmp.unlink()
             return False
         os.replace(tmp, path)  # atomic — a concurrent play gets old or new, never half
+        sidecar.write(path)
 
         self.db.clips.update_one(
             {"identifier": clip["identifier"]},
@@ -288,6 +291,8 @@ class ClipsService:
             os.replace(tmp, dest)
         elif NORMALIZE_UPLOADS:
             _normalize_loudness(dest)
+        # Decode once now so neither bot nor preview has to decode the mp3.
+        sidecar.write(dest)
 
         doc = {
             "identifier": identifier,
@@ -346,6 +351,7 @@ class ClipsService:
             old_path = AUDIO_DIR / clip["file"]
             if old_path.exists():
                 old_path.rename(new_path)
+                sidecar.move(old_path, new_path)
             updates["name"] = name
             updates["file"] = new_filename
 
@@ -403,6 +409,7 @@ class ClipsService:
                 tmp.unlink()
             raise HTTPException(500, "Trim failed")
         os.replace(tmp, path)
+        sidecar.write(path)
 
         self.db.clips.update_one(
             {"identifier": identifier},
@@ -430,6 +437,7 @@ class ClipsService:
 
         dest = AUDIO_DIR / clip["file"]
         shutil.copy2(backup, dest)
+        sidecar.write(dest)
         self.db.clips.update_one(
             {"identifier": identifier}, {"$set": {"duration_s": _probe_duration(dest)}}
         )
@@ -451,70 +459,31 @@ class ClipsService:
         )
         return self.db.clips.find_one({"identifier": identifier}, {"_id": 0})
 
-    @staticmethod
-    def _atempo_chain(tempo: float) -> str:
-        # ffmpeg's atempo only accepts 0.5–2.0, so chain factors to reach values
-        # outside that range (their product equals the requested tempo).
-        factors = []
-        t = tempo
-        while t < 0.5:
-            factors.append(0.5)
-            t /= 0.5
-        while t > 2.0:
-            factors.append(2.0)
-            t /= 2.0
-        factors.append(round(t, 4))
-        return ",".join(f"atempo={f}" for f in factors)
-
     def render_preview(
         self, clip: dict, pitch: int, speed: float, reverse: bool = False
-    ) -> Path:
-        # Render the clip through the SAME pitch/speed/reverse filter the bots use
-        # (asetrate shifts pitch, atempo corrects tempo → independent pitch/speed),
-        # so the browser preview is exactly what playback will sound like. The
-        # clip's gain is applied too; result is cached on disk by content+params.
+    ) -> bytes:
+        # Render the clip through the SAME pitch/speed/reverse engine the bots use,
+        # via the shared render cache, so the browser preview is exactly what
+        # playback will sound like (and is already warm when it's played in
+        # voice). The clip's gain is applied too. Returns a WAV.
         path = AUDIO_DIR / clip["file"]
         if not path.exists():
             raise HTTPException(404, "Audio file not found")
 
         gain = 10 ** ((clip.get("gain_db", 0) or 0) / 20)
-        ratio = 2 ** (pitch / 12)
-        set_rate = int(round(48000 * ratio))
-        parts = [
-            "aresample=48000",
-            f"asetrate={set_rate}",
-            "aresample=48000",
-            self._atempo_chain(speed / ratio),
-            f"volume={gain:.4f}",
-        ]
-        if reverse:
-            parts.append("areverse")
-        audio_filter = ",".join(parts)
-
-        mtime = path.stat().st_mtime
-        key = hashlib.sha1(
-            f"{clip['file']}|{mtime}|{pitch}|{speed}|{gain:.4f}|{reverse}".encode()
-        ).hexdigest()
-        PREVIEW_CACHE_DIR.mkdir(parents=True, exist_ok=True)
-        out = PREVIEW_CACHE_DIR / f"{key}.wav"
-        if out.exists():
-            return out
-
-        tmp = out.with_suffix(".tmp.wav")
-        result = subprocess.run(
-            [
-                "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
-                "-i", str(path), "-af", audio_filter, "-ar", "48000", str(tmp),
-            ],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
+        pcm, _hit = render_cache.for_audio_dir(AUDIO_DIR).render(
+            path, _PREVIEW_KIND, gain, speed, pitch, reverse,
+            channels=_PREVIEW_CHANNELS,
         )
-        if result.returncode != 0 or not tmp.exists():
-            if tmp.exists():
-                tmp.unlink()
+        if not pcm:
             raise HTTPException(500, "Preview render failed")
-        os.replace(tmp, out)
-        return out
+        out = io.BytesIO()
+        with wave.open(out, "wb") as f:
+            f.setnchannels(_PREVIEW_CHANNELS)
+            f.setsampwidth(2)
+            f.setframerate(48000)
+            f.writeframes(pcm)
+        return out.getvalue()
 
     def delete_clip(self, identifier: str) -> None:
         clip = self.db.clips.find_one({"identifier": identifier})
@@ -524,6 +493,7 @@ class ClipsService:
         audio_file = AUDIO_DIR / clip["file"]
         if audio_file.exists():
             audio_file.unlink()
+        sidecar.remove(audio_file)
         if clip.get("original_file"):
             backup = AUDIO_DIR / clip["original_file"]
             if backup.exists():
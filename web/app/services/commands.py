@@ -1,12 +1,24 @@
+import contextvars
+import time
 from datetime import datetime, timedelta
 from typing import List, Optional
 
 import pymongo
+from pmb_core.db import channel, latency
+from pmb_core.db.commands import STOPPABLE_TYPES, priority, ring
+from pymongo.errors import PyMongoError
 
 from app.database import get_db
 
 HISTORY_LIMIT = 250
 
+# Sends queued commands straight to bots on this host (see pmb_core.db.channel).
+_direct = channel.Sender()
+
+# When the web started handling the current request (set by a middleware in
+# main): the `accepted` stamp of the commands it queues (see pmb_core.db.latency).
+request_started = contextvars.ContextVar("request_started", default=None)
+
 
 class CommandsService:
     def __init__(self):
@@ -37,6 +49,42 @@ class CommandsService:
             for e in entries
         ]
 
+    def _enqueue(self, *commands: dict) -> None:
+        """Queue commands for the bot, send them straight to it if it's on this
+        host (the inserts have given them their ``_id``s, which the bot
+        de-duplicates by), and ring its doorbell, which wakes a bot that can't
+        use a change stream (see pmb_core.db.commands). Each command carries
+        its priority lane, so a stop is claimed ahead of a backlog of plays, and
+        a latency trace; the web's stamps are logged once the bot has them."""
+        accepted = request_started.get() or time.time()
+        for command in commands:
+            command["priority"] = priority(command["type"])
+            command["trace"] = latency.start(accepted)
+        if len(commands) == 1:
+            self.db.pending_commands.insert_one(commands[0])
+        else:
+            self.db.pending_commands.insert_many(list(commands))
+        inserted = time.time()
+        _direct.send(self.db, commands)
+        ring(self.db)
+        self._log_latency(commands, accepted, inserted)
+
+    def _log_latency(self, commands, accepted, inserted):
+        try:
+            self.db[latency.LATENCY_LOG].insert_many(
+                [
+                    latency.record(
+                        c["trace"]["id"],
+                        "web",
+                        c["type"],
+                        {"accepted": accepted, "inserted": inserted},
+                    )
+                    for c in commands
+                ]
+            )
+        except PyMongoError:
+            pass  # tracing is best-effort
+
     def _log_play(self, clip_ref, clip_name, requested_by, pitch, speed, played_at):
         # Durable, append-only record for stats (pending_commands is TTL'd).
         self.db.play_log.insert_one(
@@ -63,7 +111,7 @@ class CommandsService:
             "speed": speed,
             "reverse": reverse,
         }
-        self.db.pending_commands.insert_one(command)
+        self._enqueue(command)
         self._log_play(clip_ref, clip_name, requested_by, pitch, speed, now)
         return command
 
@@ -108,7 +156,7 @@ class CommandsService:
                 "speed": item.get("speed", 1.0),
                 "played_at": played_at,
             })
-        self.db.pending_commands.insert_many(docs)
+        self._enqueue(*docs)
         if log_docs:
             self.db.play_log.insert_many(log_docs)
 
@@ -147,7 +195,7 @@ class CommandsService:
                 "played_at": now,
             }
         )
-        self.db.pending_commands.insert_many([
+        self._enqueue(
             {
                 "type": "announce",
                 "message": f"<b>{requested_by}</b> queued 🎵 {song_name} on {clip_name}{extra}",
@@ -169,10 +217,10 @@ class CommandsService:
                 "status": "pending",
                 "created_at": now + timedelta(microseconds=1),
             },
-        ])
+        )
 
     def enqueue_skip_song(self, requested_by: str) -> None:
-        self.db.pending_commands.insert_one(
+        self._enqueue(
             {
                 "type": "skip_song",
                 "requested_by": requested_by,
@@ -187,7 +235,7 @@ class CommandsService:
         # "Clip that": ask the bot to dump the last `duration` seconds of
         # `target_voice`'s rolling buffer into a pending capture for review. The
         # bot announces success/failure itself, so there's no announce doc here.
-        self.db.pending_commands.insert_one(
+        self._enqueue(
             {
                 "type": "clip_capture",
                 "target_voice": target_voice,
@@ -221,15 +269,13 @@ class CommandsService:
 
     def enqueue_stop(self, requested_by: str) -> None:
         # Cancel anything still queued so it won't start, then tell the bot to
-        # clear whatever is currently playing.
+        # clear whatever is currently playing. The stop jumps the queue, and the
+        # bot drops anything queued before it that it had already claimed.
         self.db.pending_commands.update_many(
-            {
-                "status": "pending",
-                "type": {"$in": ["play", "queue_play", "play_song", "clip_capture"]},
-            },
+            {"status": "pending", "type": {"$in": list(STOPPABLE_TYPES)}},
             {"$set": {"status": "done"}},
         )
-        self.db.pending_commands.insert_one(
+        self._enqueue(
             {
                 "type": "stop",
                 "requested_by": requested_by,
@@ -253,13 +299,10 @@ class CommandsService:
         # Cancel anything still queued (it shouldn't fire on a freshly-restarted
         # bot), then ask the bot to exit so Docker restarts it and it rejoins.
         self.db.pending_commands.update_many(
-            {
-                "status": "pending",
-                "type": {"$in": ["play", "queue_play", "play_song", "clip_capture"]},
-            },
+            {"status": "pending", "type": {"$in": list(STOPPABLE_TYPES)}},
             {"$set": {"status": "done"}},
         )
-        self.db.pending_commands.insert_one(
+        self._enqueue(
             {
                 "type": "restart",
                 "requested_by": requested_by,
@@ -269,7 +312,7 @@ class CommandsService:
         )
 
     def enqueue_join(self, channel_id: str, requested_by: str) -> None:
-        self.db.pending_commands.insert_one(
+        self._enqueue(
             {
                 "type": "join",
                 "channel_id": channel_id,
@@ -280,7 +323,7 @@ class CommandsService:
         )
 
     def enqueue_leave(self, requested_by: str) -> None:
-        self.db.pending_commands.insert_one(
+        self._enqueue(
             {
                 "type": "leave",
                 "requested_by": requested_by,
@@ -1,8 +1,10 @@
 """MIDI song library — shareable .mid files played through a clip "instrument".
 
-Parsing/metadata uses `mido` directly here (the web image does not bundle
-pmb_core). The bots do the actual rendering; this service just stores the files
-(in the shared audio volume, under music/) and their metadata.
+The bots do the actual rendering; this service just stores the files (in the shared
+audio volume, under music/) and their metadata. Parsing goes through pmb_core's MIDI
+reader, and each upload is written to the shared parsed-song cache
+(pmb_core.audio.song_cache), so neither the lines endpoint nor the bots have to run
+mido on it again.
 """
 
 import io
@@ -14,6 +16,8 @@ from typing import List, Optional
 
 import mido
 from fastapi import HTTPException
+from pmb_core.audio import song_cache
+from pmb_core.audio.midi import NoteTable, parse_midi_table
 
 from app.database import get_db
 
@@ -21,7 +25,6 @@ AUDIO_DIR = Path(os.getenv("AUDIO_DIR", "/app/audio"))
 SONGS_DIR = AUDIO_DIR / "music"
 MAX_SIZE_BYTES = 2 * 1024 * 1024  # 2 MB — MIDI files are tiny
 _NAME_RE = re.compile(r"[^a-z0-9_-]+")
-DRUM_CHANNEL = 9
 
 
 def _slugify(name: str) -> str:
@@ -29,78 +32,37 @@ def _slugify(name: str) -> str:
     return slug or "song"
 
 
-def _summarize(contents: bytes) -> dict:
-    """Validate the upload is a real MIDI and pull out light metadata."""
+def _parse(contents: bytes) -> NoteTable:
+    """Validate the upload is a real MIDI with something to play, and parse it."""
     try:
         mid = mido.MidiFile(file=io.BytesIO(contents))
     except Exception:
         raise HTTPException(400, "Not a valid MIDI file")
-
-    now = 0.0
-    open_notes = {}
-    note_count = 0
-    duration = 0.0
     try:
-        for msg in mid:
-            now += msg.time
-            if getattr(msg, "channel", 0) == DRUM_CHANNEL:
-                continue
-            if msg.type == "note_on" and msg.velocity > 0:
-                open_notes[(msg.channel, msg.note)] = open_notes.get((msg.channel, msg.note), 0) + 1
-            elif msg.type == "note_off" or (msg.type == "note_on" and msg.velocity == 0):
-                if open_notes.get((msg.channel, msg.note)):
-                    open_notes[(msg.channel, msg.note)] -= 1
-                    note_count += 1
-                    duration = now
+        notes = parse_midi_table(mid)
     except Exception:
         raise HTTPException(400, "Could not read MIDI file")
-
-    if note_count == 0:
+    if not len(notes):
         raise HTTPException(400, "MIDI file has no playable (non-drum) notes")
+    return notes
 
+
+def _summarize(contents: bytes) -> dict:
+    """Validate the upload and pull out light metadata."""
+    notes = _parse(contents)
     return {
-        "duration_s": round(duration, 2),
-        "note_count": note_count,
-        "track_count": len(mid.tracks),
+        **notes.summary(),
         # How many distinct instrument "lines" can be voiced separately.
-        "instrument_count": len(_extract_lines(contents)),
+        "instrument_count": len(notes.lines()),
     }
 
 
 def _extract_lines(contents: bytes) -> list:
     """Group a song's notes into instrument "lines" by General MIDI program,
     merging channels that share a program (e.g. two Alto Sax channels → one
-    line). Returns ``[{"program", "note_count", "channels"}]`` sorted busiest
-    first. Program → friendly name is done client-side. No tempo maths needed —
-    we only count note-ons and read the program active on each channel."""
-    try:
-        mid = mido.MidiFile(file=io.BytesIO(contents))
-    except Exception:
-        raise HTTPException(400, "Not a valid MIDI file")
-    programs = {}
-    lines = {}
-    for msg in mid:
-        if msg.type == "program_change":
-            programs[msg.channel] = msg.program
-        elif msg.type == "note_on" and msg.velocity > 0:
-            if getattr(msg, "channel", 0) == DRUM_CHANNEL:
-                continue
-            prog = programs.get(msg.channel, 0)
-            line = lines.setdefault(
-                prog, {"program": prog, "note_count": 0, "channels": set()}
-            )
-            line["note_count"] += 1
-            line["channels"].add(msg.channel)
-    out = [
-        {
-            "program": ln["program"],
-            "note_count": ln["note_count"],
-            "channels": sorted(ln["channels"]),
-        }
-        for ln in lines.values()
-    ]
-    out.sort(key=lambda ln: ln["note_count"], reverse=True)
-    return out
+    line). Returns ``[{"program", "instrument", "note_count", "channels"}]``
+    sorted busiest first."""
+    return _parse(contents).lines()
 
 
 class SongsService:
@@ -115,7 +77,7 @@ class SongsService:
             if song.get("instrument_count") is None:
                 path = SONGS_DIR / song["filename"]
                 try:
-                    count = len(_extract_lines(path.read_bytes())) if path.exists() else 0
+                    count = len(song_cache.parse(path).lines) if path.exists() else 0
                 except Exception:
                     count = 0
                 self.db.songs.update_one(
@@ -128,15 +90,19 @@ class SongsService:
         return self.db.songs.find_one({"id": song_id}, {"_id": 0})
 
     def get_lines(self, song_id: str) -> List[dict]:
-        """Instrument lines for a song (for per-line clip assignment), read from
-        the stored .mid on demand. A single-instrument song returns one line."""
+        """Instrument lines for a song (for per-line clip assignment), from the
+        parsed-song cache (parsing the stored .mid if it isn't cached yet). A
+        single-instrument song returns one line."""
         song = self.db.songs.find_one({"id": song_id}, {"_id": 0})
         if not song:
             raise HTTPException(404, f"Song '{song_id}' not found")
         path = SONGS_DIR / song["filename"]
         if not path.exists():
             raise HTTPException(404, "Song file missing")
-        return _extract_lines(path.read_bytes())
+        try:
+            return song_cache.parse(path).lines
+        except Exception:
+            raise HTTPException(400, "Could not read MIDI file")
 
     def upload_song(self, filename: str, contents: bytes, uploaded_by: str) -> dict:
         ext = Path(filename).suffix.lower()
@@ -145,7 +111,8 @@ class SongsService:
         if len(contents) > MAX_SIZE_BYTES:
             raise HTTPException(413, f"File too large — max {MAX_SIZE_BYTES // (1024 * 1024)} MB")
 
-        meta = _summarize(contents)
+        notes = _parse(contents)
+        meta = notes.summary()
 
         name = Path(filename).stem
         song_id = _slugify(name)
@@ -158,6 +125,7 @@ class SongsService:
         if dest.exists():
             raise HTTPException(409, f"File '{stored_filename}' already exists on disk")
         dest.write_bytes(contents)
+        lines = song_cache.store(dest, notes).lines
 
         doc = {
             "id": song_id,
@@ -167,7 +135,7 @@ class SongsService:
             "duration_s": meta["duration_s"],
             "note_count": meta["note_count"],
             "track_count": meta["track_count"],
-            "instrument_count": meta["instrument_count"],
+            "instrument_count": len(lines),
             "created_at": datetime.utcnow(),
         }
         self.db.songs.insert_one(doc)
@@ -199,6 +167,7 @@ class SongsService:
         if not is_admin and song.get("uploaded_by") != requested_by:
             raise HTTPException(403, "You can only delete songs you uploaded")
         path = SONGS_DIR / song["filename"]
+        song_cache.remove(path)  # keyed by content, so before the file goes
         try:
             path.unlink(missing_ok=True)
         except OSError:
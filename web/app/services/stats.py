@@ -1,6 +1,9 @@
+import math
 from collections import Counter, defaultdict
 from datetime import datetime, timedelta
 
+from pmb_core.db import latency
+
 from app.database import get_db
 
 WEEKDAYS = [
@@ -383,6 +386,57 @@ class StatsService:
             "timeline": self._timeline(records, period, now, tz_offset),
         }
 
+    # -- latency (read from latency_log) -----------------------------------
+
+    def get_latency_stats(self, period: str = "24h") -> dict:
+        """p50/p95/p99 (in ms) of each stage of a command's trip, from the web
+        accepting the request to the mixer's first frame of it: each stage is
+        the time from the previous one (see pmb_core.db.latency). ``total`` is
+        accepted to first frame, for the traces that got that far."""
+        if period not in _PERIODS:
+            period = "24h"
+        query = {}
+        delta = _PERIODS[period]
+        if delta is not None:
+            query["at"] = {"$gte": datetime.utcnow() - delta}
+        traces = defaultdict(dict)
+        via = Counter()
+        for doc in self.db[latency.LATENCY_LOG].find(query, {"_id": 0}):
+            traces[doc["trace"]].update(
+                {k: doc[k] for k in latency.STAGES if k in doc}
+            )
+            if doc.get("via"):
+                via[doc["via"]] += 1
+
+        spans = [
+            (stage, previous, stage)
+            for previous, stage in zip(latency.STAGES, latency.STAGES[1:])
+        ]
+        spans.append(("total", latency.STAGES[0], latency.STAGES[-1]))
+        stages = []
+        for name, start, end in spans:
+            ms = sorted(
+                (t[end] - t[start]) * 1000
+                for t in traces.values()
+                if start in t and end in t
+            )
+            stages.append(
+                {
+                    "stage": name,
+                    "from": start,
+                    "count": len(ms),
+                    "p50_ms": _percentile(ms, 50),
+                    "p95_ms": _percentile(ms, 95),
+                    "p99_ms": _percentile(ms, 99),
+                }
+            )
+        return {
+            "period": period,
+            "traces": len(traces),
+            "via": dict(via),
+            "stages": stages,
+        }
+
     # -- timeline ----------------------------------------------------------
 
     def _timeline(self, records, period, now, tz_offset):
@@ -428,3 +482,11 @@ class StatsService:
         return [
             {"label": d.strftime("%d %b"), "count": counts.get(d, 0)} for d in days
         ]
+
+
+def _percentile(sorted_values, pct):
+    """Nearest-rank percentile of an ascending list (None if it's empty)."""
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return round(sorted_values[rank - 1], 2)
@@ -6,8 +6,13 @@ This is the exact surface where the queue regression happened: the web enqueues
 filters, so a future change can't silently stop queues (or songs) from playing.
 """
 
+import socket
 from datetime import datetime, timedelta
 
+from pmb_core.db import channel
+from pmb_core.db.commands import CONTROL, NORMAL
+
+from app.services import commands
 from app.services.commands import CommandsService
 
 
@@ -152,6 +157,15 @@ def test_enqueue_stop_cancels_pending_playables_and_inserts_stop(db):
     assert any(d["status"] == "pending" for d in _pending(db, type="announce"))
 
 
+def test_control_commands_are_queued_in_the_control_lane(db):
+    svc = CommandsService()
+    svc.enqueue_play("a0", "alpha", "winneh")
+    svc.enqueue_skip_song("winneh")
+    svc.enqueue_stop("winneh")
+    lanes = {d["type"]: d["priority"] for d in db.pending_commands.find()}
+    assert lanes == {"play": NORMAL, "skip_song": CONTROL, "stop": CONTROL}
+
+
 def test_enqueue_stop_leaves_already_done_and_other_pending_untouched(db):
     svc = CommandsService()
     db.pending_commands.insert_one(
@@ -181,6 +195,48 @@ def test_enqueue_join_and_leave(db):
     assert len(_pending(db, type="leave")) == 1
 
 
+def test_every_enqueue_rings_the_bot_doorbell(db):
+    svc = CommandsService()
+    svc.enqueue_play("dm0", "dry_fart", "winneh")
+    svc.enqueue_queue([{"clip_ref": "a0"}, {"clip_ref": "b1"}], "winneh", "q")
+    svc.enqueue_stop("winneh")
+    assert db.command_signals.count_documents({}) == 3  # one per enqueue call
+
+
+def test_an_enqueue_is_sent_straight_to_an_announced_bot(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(commands, "_direct", channel.Sender())
+    bot = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    bot.bind(str(tmp_path / "bot.sock"))
+    db.command_channels.insert_one({"_id": "mumble", "path": str(tmp_path / "bot.sock")})
+
+    svc = CommandsService()
+    svc.enqueue_queue([{"clip_ref": "a0"}, {"clip_ref": "b1"}], "winneh", "q")
+    sent = channel.decode(bot.recv(channel.MAX_DATAGRAM))
+    # One datagram per enqueue, carrying the durable docs' ids.
+    assert [c["type"] for c in sent] == ["announce", "queue_play", "queue_play"]
+    assert [c["_id"] for c in sent] == [d["_id"] for d in _pending(db)]
+
+    bot.close()  # the bot goes away: enqueues still land in Mongo
+    svc.enqueue_play("dm0", "dry_fart", "winneh")
+    assert len(_pending(db, type="play")) == 1
+
+
+def test_every_command_carries_a_trace_and_the_web_logs_its_stamps(db):
+    svc = CommandsService()
+    token = commands.request_started.set(100.0)
+    try:
+        svc.enqueue_queue([{"clip_ref": "a0"}, {"clip_ref": "b1"}], "winneh", "q")
+    finally:
+        commands.request_started.reset(token)
+
+    traces = [d["trace"] for d in _pending(db)]
+    assert len({t["id"] for t in traces}) == 3
+    assert all(t["accepted"] == 100.0 for t in traces)
+    logged = list(db.latency_log.find({"side": "web"}))
+    assert {d["trace"] for d in logged} == {t["id"] for t in traces}
+    assert all(d["accepted"] == 100.0 < d["inserted"] for d in logged)
+
+
 def test_get_next_pending_and_mark_done_roundtrip(db):
     svc = CommandsService()
     svc.enqueue_play("a0", "alpha", "winneh")
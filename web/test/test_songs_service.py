@@ -5,7 +5,9 @@ fixture files are needed."""
 import io
 
 import mido
+from pmb_core.audio import song_cache
 
+from app.services import songs as songs_module
 from app.services.commands import CommandsService
 from app.services.songs import SongsService, _extract_lines, _summarize
 
@@ -75,3 +77,20 @@ def test_history_remembers_per_line_instruments(db):
     assert len(hist) == 1
     assert hist[0]["instruments"] == instruments
     assert hist[0]["gain"] == -6
+
+
+def test_upload_caches_parse_and_delete_drops_it(db, tmp_path, monkeypatch):
+    monkeypatch.setattr(songs_module, "SONGS_DIR", tmp_path)
+    svc = SongsService()
+    doc = svc.upload_song("Tune.mid", _midi([(56, 0, 3), (32, 1, 5)]), uploaded_by="winneh")
+    path = tmp_path / doc["filename"]
+    assert song_cache.load(path) is not None
+    assert doc["instrument_count"] == 2 and doc["note_count"] == 8
+
+    # Lines come from the cache; mido isn't touched.
+    monkeypatch.setattr(songs_module.song_cache.midi, "parse_midi_table", None)
+    assert [ln["program"] for ln in svc.get_lines(doc["id"])] == [32, 56]
+
+    svc.delete_song(doc["id"], requested_by="winneh", is_admin=False)
+    assert not path.exists()
+    assert list((tmp_path / song_cache.DIR_NAME).iterdir()) == []
@@ -79,3 +79,32 @@ def test_song_stats_counts_songs_and_instruments(db):
     instruments = {i["name"]: i["count"] for i in stats["top_instruments"]}
     assert instruments["dry_fart"] == 3
     assert stats["song_of_week"] == {"name": "GSTQ", "count": 2}
+
+
+def test_latency_stats_join_each_trace_across_web_and_bot(db):
+    # Web and bot write their own halves of a trace; stages are the gaps.
+    for i in range(1, 101):
+        db.latency_log.insert_one(
+            {"trace": i, "side": "web", "at": datetime.utcnow(),
+             "accepted": 0.0, "inserted": 0.001})
+        db.latency_log.insert_one(
+            {"trace": i, "side": "mumble", "via": "direct", "at": datetime.utcnow(),
+             "claimed": 0.002, "resolved": 0.002, "render_start": 0.002,
+             "render_end": 0.002 + i / 1000, "first_frame": 0.01 + i / 1000})
+    db.latency_log.insert_one(  # a stop: no bot stages past claimed
+        {"trace": "stop", "side": "web", "at": datetime.utcnow(),
+         "accepted": 0.0, "inserted": 0.001})
+
+    stats = StatsService().get_latency_stats()
+    assert stats["traces"] == 101 and stats["via"] == {"direct": 100}
+    stages = {s["stage"]: s for s in stats["stages"]}
+    assert stages["inserted"]["count"] == 101 and stages["inserted"]["p50_ms"] == 1.0
+    render = stages["render_end"]
+    assert (render["p50_ms"], render["p95_ms"], render["p99_ms"]) == (50, 95, 99)
+    assert stages["total"]["count"] == 100 and stages["total"]["p99_ms"] == 109.0
+
+
+def test_latency_stats_empty(db):
+    stats = StatsService().get_latency_stats(period="7d")
+    assert stats["traces"] == 0
+    assert all(s["p50_ms"] is None for s in stats["stages"])